@@ -1,5 +1,5 @@
 import json
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import ThreadingHTTPServer
 import urllib.parse
 import threading
 import requests
@@ -7,6 +7,11 @@ import os
 import threading
 from collections import OrderedDict
 import csv
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.http_server import KeepAliveHandler
+from common.invalidation_subscriber import InvalidationSubscriber
 
 #initializing front_end_service host and port
 FRONT_END_LOG_FILE= "Front_end_log/Front_end_log.csv"
@@ -14,6 +19,8 @@ FRONT_END_PORT = int(os.getenv('FRONTEND_LISTENING_PORT',12503))
 CATALOG_PORT = int(os.getenv('CATALOG_PORT',12501))
 FRONTEND_HOST = os.getenv('FRONTEND_HOST', '0.0.0.0')
 CATALOG_HOST = os.getenv('CATALOG_HOST', 'localhost')
+# "stream": subscribe to the catalog's invalidation stream, "post": wait for the catalog to POST invalidations
+INVALIDATION_MODE = os.getenv('INVALIDATION_MODE', 'stream')
 LEADER_ID=0
 LEADER_TERM=0
 LOCK = threading.Lock()
@@ -144,15 +151,34 @@ class LRUCache:
             if len(self.cache) > self.capacity:
                 self.cache.popitem(last=False)  # Remove least recently used item
 
-    def invalidate(self, key):
+    def invalidate(self, key, version=None):
+        """Drop key, unless version is given and the cached entry is already at that version or a later one."""
         with self.lock:  # Use the lock when modifying the cache
-            if key in self.cache:
+            if version is not None and key in self.cache and self.cache[key].get("version", -1) >= version:
+                print(f"Cache entry for {key} is already at version {self.cache[key]['version']}")
+            elif key in self.cache:
                 del self.cache[key]
                 print(f"Cache successfully invalidated for {key}")
             else:
                 print(f"No cache entry found for {key} to invalidate.")
 
-class FrontendHandler(BaseHTTPRequestHandler):
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            print("Cache cleared")
+
+def apply_invalidation_batch(cache, batch):
+    """Apply a batch of invalidations from the catalog, posted or streamed: {"names": [...], "versions": [...]}
+    or {"all": true}."""
+    if batch.get("all"):
+        cache.clear()
+    names = batch.get("names", [])
+    for product_name, version in zip(names, batch.get("versions") or [None] * len(names)):
+        cache.invalidate(product_name, version)
+
+invalidation_subscriber = InvalidationSubscriber(0, CATALOG_HOST, CATALOG_PORT)
+
+class FrontendHandler(KeepAliveHandler):
     #method to handle all get requests from client. requests forwarded to catalog service
 
     cache = LRUCache()  # Initialize the cache
@@ -247,10 +273,16 @@ class FrontendHandler(BaseHTTPRequestHandler):
             try:
                 order_info = requests.post(f"http://{leader['host']}:{leader['port']}/orders", json=order_data)
                 if order_info.status_code==200: #sends order info in data label if query was successful
+                    order_response = order_info.json()
+                    # the catalog returned the product's new quantity and version, update the cache instead of refetching
+                    for product in order_response.pop("products", []):
+                        cached = self.cache.get(product["name"])
+                        if cached is None or cached.get("version", -1) < product["version"]:
+                            self.cache.put(product["name"], product)
                     self.send_response(200)
                     self.send_header("Content-type", "application/json")
                     self.end_headers()
-                    self.wfile.write(json.dumps({"data": order_info.json()}).encode('utf-8'))
+                    self.wfile.write(json.dumps({"data": order_response}).encode('utf-8'))
                 else:   #sends error code in error label with corresponding message
                     self.send_response(order_info.status_code)
                     self.send_header("Content-type", "application/json")
@@ -266,6 +298,10 @@ class FrontendHandler(BaseHTTPRequestHandler):
         # handle invalidate requests
         elif parsed_path.path.startswith("/invalidate/"):
             product_name = parsed_path.path.split("/")[-1]
+            if not product_name:
+                # POST /invalidate/ carries a batch from the catalog
+                self.handle_invalidation_batch()
+                return
             try:
                 self.cache.invalidate(product_name)
                 self.send_response(200)
@@ -286,8 +322,26 @@ class FrontendHandler(BaseHTTPRequestHandler):
                 error_message = json.dumps({"error": {"code": 500, "message": f"An error occurred while invalidating the cache for {product_name}: {str(e)}"}})
                 self.wfile.write(error_message.encode('utf-8'))
 
+    def handle_invalidation_batch(self):
+        """Handle a batch of invalidations from the catalog: {"names": [...], "versions": [...]} or {"all": true}."""
+        try:
+            batch = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
+            apply_invalidation_batch(self.cache, batch)
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"data": "Cache successfully invalidated"}).encode('utf-8'))
+        except Exception as e:
+            self.send_response(400)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            error_message = json.dumps({"error": {"code": 400, "message": f"Invalid invalidation batch: {str(e)}"}})
+            self.wfile.write(error_message.encode('utf-8'))
+
 def start_front_end_service():
     frontend_server = ThreadingHTTPServer((FRONTEND_HOST, FRONT_END_PORT), FrontendHandler)
+    if INVALIDATION_MODE == "stream":
+        invalidation_subscriber.start(lambda batch: apply_invalidation_batch(FrontendHandler.cache, batch))
     print(f'Starting front-end server on {FRONTEND_HOST}:{FRONT_END_PORT}...')
     frontend_server.serve_forever()
 
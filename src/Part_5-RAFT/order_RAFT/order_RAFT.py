@@ -1,10 +1,15 @@
 import json
 import threading
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import ThreadingHTTPServer
 import urllib.parse
 import requests
 import csv
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..'))
+from common.http_client import PooledClient
+from common.http_server import KeepAliveHandler
 
 # Initializing order service host and port, lock, order file
 Replica_id=int(os.getenv('Replica_id',1))
@@ -15,6 +20,8 @@ RAFT_FILE=f"raft_data/raft_log_{str(Replica_id)}.csv"
 LOCK = threading.Lock()
 CATALOG_HOST = os.getenv('CATALOG_HOST', 'localhost')
 ORDER_HOST = os.getenv('ORDER_HOST', 'localhost')
+# Keep-alive connections to the catalog and the other replicas, shared by all handler threads
+http_client = PooledClient()
 #ORDER_NODES = os.getenv('ORDER_NODES', "localhost:12502,localhost:12504,localhost:12505")  # "host1:port1,host2:port2"
 ORDER_NODES = {
     os.getenv('REPLICA1_ID', 1): {"id":1,"host": os.getenv('REPLICA1_HOST', 'localhost'), "port": int(os.getenv('REPLICA1_PORT', 12502))},
@@ -57,7 +64,7 @@ def send_data(follower, data):
     """Function to send data to a single follower."""
     url = f"http://{follower['host']}:{follower['port']}/replicate_order"
     try:
-        response = requests.post(url, json=data)
+        response = http_client.post(url, json=data)
         response.raise_for_status()  # This will raise an exception for HTTP errors.
         print(f"Successfully propagated to {url}")
     except requests.RequestException as e:
@@ -67,7 +74,7 @@ def send_raft_data(follower, data):
     """Function to send data to a single follower."""
     url = f"http://{follower['host']}:{follower['port']}/replicate_raft"
     try:
-        response = requests.post(url, json=data)
+        response = http_client.post(url, json=data)
         response.raise_for_status()  # This will raise an exception for HTTP errors.
         print(f"Successfully propagated raft entry to {url}")
         return 200
@@ -79,7 +86,7 @@ def send_invalidate_raft_index(follower, invalidate_index):
     """Function to send invalidate raft log enty request to a single follower."""
     url = f"http://{follower['host']}:{follower['port']}/invalidate_raft/{invalidate_index}"
     try:
-        response = requests.get(url)
+        response = http_client.get(url)
         response.raise_for_status()  # This will raise an exception for HTTP errors.
         print(f"Successfully propagated invalidate raft entry request to {url}")
     except requests.RequestException as e:
@@ -192,21 +199,6 @@ def fetch_order_details(order_number):
                     return {"number": row[0], "name": row[1], "quantity": row[2]}
     return None
 
-def check_product_availability(product_name, requested_quantity):
-    """Check if the catalog has enough quantity of the product."""
-    response = requests.get(f"http://{CATALOG_HOST}:{CATALOG_PORT}/{product_name}")
-    
-    if response.status_code == 200:
-        product_data = response.json()
-        available_quantity = product_data['quantity']
-        if available_quantity >= requested_quantity:
-            return 200 #indicates product name exists and it is in stock
-        else:
-            return 400 #indicates that product name exists but quantity requested is not in stock
-    else:
-        return response.status_code #any other error code received from catalog like 404 out of stock or bad request
-            
-
 def fetch_latest_order_id():
     """Fetch the latest order ID"""
     with LOCK:
@@ -254,7 +246,7 @@ def request_missed_orders(order_number):
             replica_port = node["port"]
             url = f"http://{replica_host}:{replica_port}/missed_order"
             try:
-                response = requests.post(url, json={"latest_order_id": order_number})
+                response = http_client.post(url, json={"latest_order_id": order_number})
                 if response.status_code == 200:
                     print("No order is missed")
                     return
@@ -294,7 +286,7 @@ def request_missed_raft_entries(raft_index):
             replica_port = node["port"]
             url = f"http://{replica_host}:{replica_port}/missed_raft"
             try:
-                response = requests.post(url, json={"latest_raft_id": raft_index})
+                response = http_client.post(url, json={"latest_raft_id": raft_index})
                 if response.status_code == 200:
                     print("No raft entry is missed")
                     return
@@ -358,9 +350,15 @@ def fetch_missed_raft_entries(start_raft_id):
     
 
 
-class OrderRequestHandler(BaseHTTPRequestHandler):
+class OrderRequestHandler(KeepAliveHandler):
     def do_GET(self):
         global raft_term
+        if self.path == "/stats/http":
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(http_client.stats()).encode())
+            return
         if self.path == "/health":
             self.send_response(200)
             self.send_header("Content-type", "application/json")
@@ -440,58 +438,58 @@ class OrderRequestHandler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps({"error": "This node is not the leader and cannot accept write operations. "}).encode())
             return
         
-        product_status=check_product_availability(product_name, requested_quantity)
-
-        # First check if the quantity is sufficient
-        if product_status==200:
-            raft_index_copy=generate_raft_index()
-            raft_log_status=log_raft(raft_index_copy,fetch_RAFT_TERM(), product_name, requested_quantity,leader_info)
-            if raft_log_status!=200:
-                print(f" Not enough order nodes to process order for Requested qunatity {requested_quantity} for {product_name}")
-                self.send_response(505)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                error_message = {"error": {"code": 505, "message": "Not enough order nodes available"}}
-                self.wfile.write(json.dumps(error_message).encode())
+        # reserve the stock before consensus, so an order that cannot be filled never reaches the raft log
+        # and a failed consensus only has to release the hold
+        catalog_url = f"http://{CATALOG_HOST}:{CATALOG_PORT}"
+        hold_response = http_client.post(f"{catalog_url}/reservations", json=post_data)
+        if hold_response.status_code != 200:
+            #send catalog error in placing order: 400 out of stock, 404 bad request/wrong product name
+            print(f"Reserving {requested_quantity} of {product_name} rejected by the catalog: {hold_response.status_code}")
+            self.send_response(hold_response.status_code)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(hold_response.json()).encode())
+            return
+        reservation_id = hold_response.json()["reservation_id"]
 
-            else:
-                #then place order-item available
-                print(f"{product_name} is in stock, placing order for {requested_quantity} quantity")
-                catalog_response = requests.post(f"http://{CATALOG_HOST}:{CATALOG_PORT}/orders", json=post_data)
-                if catalog_response.status_code == 200:
-                    order_number = generate_order_number()
-                    log_order(order_number, product_name, requested_quantity, leader_info)
-                    self.send_response(200)
-                    self.send_header("Content-type", "application/json")
-                    self.end_headers()
-                    response_data = {"order_number": order_number}
-                    self.wfile.write(json.dumps(response_data).encode())
-                #send catalog error in placing order
-                else:
-                    #send invalidate raft log request to followers
-                    invalidate_raft_index(raft_index_copy)
-                    propagate_invalidate_raft_to_followers(raft_index_copy,leader_info)
-                    self.send_response(catalog_response.status_code)
-                    self.send_header('Content-Type', 'application/json')
-                    self.end_headers()
-                    error_info = catalog_response.json()  # Assuming the catalog provides JSON error details
-                    self.wfile.write(json.dumps(error_info).encode())
-        #check if quantity is out of stock
-        elif product_status==400:
-            print(f"Requested qunatity {requested_quantity} is greater than available qunatity for {product_name}")
-            self.send_response(400)
+        raft_index_copy=generate_raft_index()
+        raft_log_status=log_raft(raft_index_copy,fetch_RAFT_TERM(), product_name, requested_quantity,leader_info)
+        if raft_log_status!=200:
+            print(f" Not enough order nodes to process order for Requested qunatity {requested_quantity} for {product_name}")
+            try:
+                http_client.post(f"{catalog_url}/reservations/{reservation_id}/release")
+            except requests.RequestException as e:
+                # the hold still expires after its ttl
+                print(f"Releasing reservation {reservation_id} failed: {e}")
+            self.send_response(505)
             self.send_header("Content-type", "application/json")
             self.end_headers()
-            error_message = {"error": {"code": 400, "message": "Insufficient product stock"}}
+            error_message = {"error": {"code": 505, "message": "Not enough order nodes available"}}
             self.wfile.write(json.dumps(error_message).encode())
-        #else return bad request/wrong product name error
+
         else:
-            print(f"Bad Request/Product name does not exist ")
-            self.send_response(product_status)
-            self.send_header("Content-type", "application/json")
-            self.end_headers()
-            error_message = {"error": {"code": product_status, "message": "bad request/wrong product name"}}
-            self.wfile.write(json.dumps(error_message).encode())
+            #then place order, the stock is held for it
+            print(f"{product_name} is reserved, placing order for {requested_quantity} quantity")
+            catalog_response = http_client.post(f"{catalog_url}/reservations/{reservation_id}/confirm")
+            if catalog_response.status_code == 200:
+                order_number = generate_order_number()
+                log_order(order_number, product_name, requested_quantity, leader_info)
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+                # the product's new quantity and version, for the front end's cache
+                response_data = {"order_number": order_number, "products": catalog_response.json()["products"]}
+                self.wfile.write(json.dumps(response_data).encode())
+            #the reservation expired before consensus finished
+            else:
+                #send invalidate raft log request to followers
+                invalidate_raft_index(raft_index_copy)
+                propagate_invalidate_raft_to_followers(raft_index_copy,leader_info)
+                self.send_response(catalog_response.status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.end_headers()
+                error_info = catalog_response.json()  # the catalog provides JSON error details
+                self.wfile.write(json.dumps(error_info).encode())
     
     def handle_replication(self):
         """Handle replication request from the leader."""
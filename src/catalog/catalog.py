@@ -1,160 +1,952 @@
 import json
 import threading
-import requests
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import ThreadingHTTPServer
 import urllib.parse
 import csv
 import os
+import sys
 import time
+import heapq
+import uuid
+from collections import OrderedDict, deque
+from itertools import islice
+from contextlib import contextmanager
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.group_commit import GroupCommitWriter
+from common.shard_map import ShardMap
+from common.http_client import PooledClient
+from common.http_server import KeepAliveHandler
+from mmap_catalog import MmapCatalog
 
 # Initializing catalog service host and port, lock, catalog file
 CATALOG_PORT = int(os.getenv('CATALOG_LISTENING_PORT', 12501))
-CATALOG_FILE = "catalog_data/catalog.csv"
-LOCK = threading.Lock()
 CATALOG_HOST = os.getenv('CATALOG_HOST', 'localhost')
+# Shard of the product names this process owns, when the catalog is split over several processes
+SHARD_MAP = ShardMap.load(CATALOG_HOST, CATALOG_PORT)
+CATALOG_SHARD_ID = int(os.getenv('CATALOG_SHARD_ID', 0))
+SHARD_SUFFIX = f"_shard{CATALOG_SHARD_ID}" if len(SHARD_MAP) > 1 else ""
+CATALOG_FILE = f"catalog_data/catalog{SHARD_SUFFIX}.csv"
+# Append-only delta log of every quantity change since the last snapshot of CATALOG_FILE
+CATALOG_LOG_FILE = f"catalog_data/catalog{SHARD_SUFFIX}_log.csv"
+# Log being folded into a new snapshot by the compaction thread
+CATALOG_COMPACTING_LOG_FILE = f"catalog_data/catalog{SHARD_SUFFIX}_log.compacting.csv"
+# Storage backend: "csv" keeps the catalog in a dict snapshotted to CATALOG_FILE,
+# "mmap" keeps it in fixed-width binary slots of CATALOG_MMAP_FILE updated in place (for very large catalogs)
+CATALOG_BACKEND = os.getenv('CATALOG_BACKEND', 'csv')
+CATALOG_MMAP_FILE = f"catalog_data/catalog{SHARD_SUFFIX}.bin"
+CATALOG_MMAP_INDEX_FILE = f"catalog_data/catalog{SHARD_SUFFIX}_index.txt"
+COMPACTION_INTERVAL = float(os.getenv('CATALOG_COMPACTION_INTERVAL', 5))  # seconds between compaction checks
+COMPACTION_THRESHOLD = int(os.getenv('CATALOG_COMPACTION_THRESHOLD', 1000))  # log entries that trigger a snapshot
+CATALOG_LOCK_STRIPES = int(os.getenv('CATALOG_LOCK_STRIPES', 16))  # number of per-product lock stripes
+LOCK = threading.Lock()  # guards the log sequence number and entry count
+STRIPE_LOCKS = [threading.Lock() for _ in range(CATALOG_LOCK_STRIPES)]  # a product is guarded by the stripe its name hashes to
 FRONTEND_HOST = os.getenv('FRONTEND_HOST', 'localhost')
 FRONT_END_PORT = int(os.getenv('FRONTEND_LISTENING_PORT',12503))
+INVALIDATION_QUEUE_SIZE = int(os.getenv('INVALIDATION_QUEUE_SIZE', 1024))  # distinct products waiting to be invalidated
+INVALIDATION_BATCH_SIZE = int(os.getenv('INVALIDATION_BATCH_SIZE', 64))  # products per invalidation request
+INVALIDATION_TIMEOUT = float(os.getenv('INVALIDATION_TIMEOUT', 2))  # seconds per invalidation request
+# stream: front ends subscribe to /invalidations/stream, post: invalidations are POSTed to FRONTEND_HOST
+INVALIDATION_MODE = os.getenv('INVALIDATION_MODE', 'stream')
+INVALIDATION_STREAM_HEARTBEAT = float(os.getenv('INVALIDATION_STREAM_HEARTBEAT', 5))  # idle seconds between keepalives
+# Default restock policy: once a buy leaves RESTOCK_LOW_WATERMARK or less, refill to RESTOCK_TARGET after RESTOCK_DELAY seconds
+RESTOCK_POLICY_FILE = "catalog_data/restock_policy.csv"  # optional per-product overrides
+RESTOCK_LOW_WATERMARK = int(os.getenv('RESTOCK_LOW_WATERMARK', 0))
+RESTOCK_TARGET = int(os.getenv('RESTOCK_TARGET', 100))
+RESTOCK_DELAY = float(os.getenv('RESTOCK_DELAY', 0))
+# How long a reservation holds stock unless confirmed or released, by default and at most, in seconds
+RESERVATION_TTL = float(os.getenv('RESERVATION_TTL', 30))
+RESERVATION_MAX_TTL = float(os.getenv('RESERVATION_MAX_TTL', 300))
+# Change stream tailed by read-only replicas: recent changes kept for them, and how long a replica's poll waits for one
+CHANGE_STREAM_SIZE = int(os.getenv('CHANGE_STREAM_SIZE', 10000))
+CHANGE_STREAM_WAIT = float(os.getenv('CHANGE_STREAM_WAIT', 1))
+# "host:port" of the catalog to follow; when set this process is a read-only replica serving queries only
+CATALOG_PRIMARY = os.getenv('CATALOG_PRIMARY', '')
+
+# Keep-alive connections for invalidations to the front end and, on a replica, to the primary
+http_client = PooledClient()
 
-# Making a public catalog dictionary
+# Making a public catalog dictionary. Entries are replaced, never mutated, once the service is running
+# so a reader that fetched an entry always sees a consistent price/quantity/seq snapshot without locking.
 catalog = {}
 
+# Sequence number of the latest delta appended to the log, group commit writer of the log and its entry count
+log_seq = 0
+log_writer = None
+log_entries = 0
+
+# Sequence number of the latest change from the primary applied by a replica, -1 until its first snapshot
+replica_seq = -1
+
+def stripe_lock(product_name):
+    """Lock guarding a single product."""
+    return STRIPE_LOCKS[hash(product_name) % len(STRIPE_LOCKS)]
+
+@contextmanager
+def stripes_locked(product_names):
+    """Hold the stripes of several products, taken in stripe order so concurrent multi-item buys cannot deadlock."""
+    locks = [STRIPE_LOCKS[i] for i in sorted({hash(name) % len(STRIPE_LOCKS) for name in product_names})]
+    for lock in locks:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(locks):
+            lock.release()
+
+@contextmanager
+def all_stripes_locked():
+    """Hold every stripe, always in the same order, for operations that span the whole catalog."""
+    for lock in STRIPE_LOCKS:
+        lock.acquire()
+    try:
+        yield
+    finally:
+        for lock in reversed(STRIPE_LOCKS):
+            lock.release()
+
+def default_catalog():
+    return {
+        "Tux": {"price": 15.99, "quantity": 100, "seq": 0},
+        "Whale": {"price": 25.99, "quantity": 100, "seq": 0},
+        "Fox": {"price": 12.99, "quantity": 100, "seq": 0},
+        "Python": {"price": 20.99, "quantity": 100, "seq": 0},
+        "Barbie": {"price": 55.99, "quantity": 100, "seq": 0},
+        "Lego": {"price": 45.99, "quantity": 100, "seq": 0},
+        "Monopoly": {"price": 10.99, "quantity": 100, "seq": 0},
+        "Frisbee": {"price": 5.99, "quantity": 100, "seq": 0},
+        "Marbles": {"price": 7.99, "quantity": 100, "seq": 0},
+        "Giraffe": {"price": 75.99, "quantity": 100, "seq": 0}
+    }
+
+def write_snapshot(snapshot):
+    """Atomically replace the catalog snapshot file. Every row records the last log sequence number it includes.
+    The mmap store is its own snapshot and only needs its dirty pages flushed."""
+    if CATALOG_BACKEND == 'mmap':
+        snapshot.flush()
+        return
+    tmp_file = CATALOG_FILE + ".tmp"
+    with open(tmp_file, 'w', newline='') as file:
+        writer = csv.DictWriter(file, fieldnames=['name', 'price', 'quantity', 'seq'])
+        writer.writeheader()
+        for name, details in snapshot.items():
+            writer.writerow({'name': name, 'price': details['price'], 'quantity': details['quantity'], 'seq': details['seq']})
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(tmp_file, CATALOG_FILE)
+
+def replay_log(path, entries=None):
+    """Apply logged deltas newer than the snapshot row they belong to, to entries or by default to the live catalog.
+    Returns the highest sequence number seen.
+    Rows of a multi-item buy carry the seq of the group's last row and are applied only if the whole group is present."""
+    if entries is None:
+        entries = catalog
+    highest_seq = 0
+    if not os.path.exists(path):
+        return highest_seq
+    group = []
+    with open(path, 'r', newline='') as file:
+        for row in csv.reader(file):
+            if len(row) not in (3, 4):
+                continue  # torn last line from a crash mid-append
+            if group and (len(row) == 3 or row[3] != group[-1][3]):
+                group = []  # incomplete group from a torn write
+            group.append(row)
+            if len(row) == 4 and row[0] != row[3]:
+                continue  # rest of the group follows
+            for seq, product_name, delta, *_ in group:
+                seq = int(seq)
+                highest_seq = max(highest_seq, seq)
+                details = entries.get(product_name)
+                if details is not None and seq > details['seq']:
+                    entries[product_name] = {'price': details['price'], 'quantity': details['quantity'] + int(delta), 'seq': seq}
+            group = []
+    return highest_seq
+
+def read_snapshot(path=CATALOG_FILE):
+    try:
+        with open(path, 'r') as file:
+            reader = csv.DictReader(file)
+            return {row['name']: {'price': float(row['price']), 'quantity': int(row['quantity']), 'seq': int(row.get('seq') or 0)} for row in reader}
+    except FileNotFoundError:
+        # a shard starts with its own partition of the default toys
+        return {name: details for name, details in default_catalog().items() if SHARD_MAP.shard_id(name) == CATALOG_SHARD_ID}
+
 def load_catalog():
-    global catalog
+    """Load the snapshot, replay the delta log on top of it and start a fresh log."""
+    global catalog, log_seq, log_writer, log_entries
+    with all_stripes_locked(), LOCK:
+        if CATALOG_BACKEND == 'mmap':
+            if os.path.exists(CATALOG_MMAP_FILE):
+                catalog = MmapCatalog(CATALOG_MMAP_FILE, CATALOG_MMAP_INDEX_FILE)
+            else:
+                # first start on the mmap backend, import the CSV snapshot
+                catalog = MmapCatalog.create(CATALOG_MMAP_FILE, CATALOG_MMAP_INDEX_FILE, read_snapshot())
+            snapshot_seq = catalog.seq
+        else:
+            catalog = read_snapshot()
+            snapshot_seq = max((details['seq'] for details in catalog.values()), default=0)
+        # a compacting log is left behind only if the service crashed in the middle of a compaction
+        log_seq = max(snapshot_seq, replay_log(CATALOG_COMPACTING_LOG_FILE), replay_log(CATALOG_LOG_FILE))
+        if CATALOG_BACKEND == 'mmap':
+            catalog.write_back_all()  # every replayed change is durable in the log already
+        write_snapshot(catalog)
+        if os.path.exists(CATALOG_COMPACTING_LOG_FILE):
+            os.remove(CATALOG_COMPACTING_LOG_FILE)
+        log_writer = GroupCommitWriter(CATALOG_LOG_FILE, mode='w',
+                                       on_durable=write_back_rows if CATALOG_BACKEND == 'mmap' else None)
+        log_entries = 0
+        change_stream.reset(log_seq)
+
+def write_back_rows(rows):
+    """Write the mmap slots of changes whose delta log rows are now durable."""
+    for seq, product_name, *_ in rows:
+        catalog.write_back(product_name, seq)
+
+def apply_delta(product_name, delta):
+    """Change a product's quantity and queue the change for the delta log. Caller must hold the product's stripe
+    so changes to one product reach the log in sequence order. Returns the group commit to wait on once the
+    stripe is released."""
+    return apply_deltas({product_name: delta})
+
+def apply_deltas(deltas):
+    """Change several products' quantities and queue them as one all-or-nothing group of delta log rows.
+    Caller must hold the stripes of all the products."""
+    global log_seq, log_entries
+    rows, changes = [], []
     with LOCK:
+        first_seq = log_seq + 1
+        log_seq += len(deltas)
+        log_entries += len(deltas)
+        last_seq = log_seq
+        # entries change under LOCK so the change stream sees every seq in order, after the entry it describes
+        for seq, (product_name, delta) in enumerate(deltas.items(), first_seq):
+            details = catalog[product_name]
+            catalog[product_name] = {'price': details['price'], 'quantity': details['quantity'] + delta, 'seq': seq}
+            rows.append([seq, product_name, delta] if len(deltas) == 1 else [seq, product_name, delta, last_seq])
+            changes.append({'seq': seq, 'name': product_name, 'quantity': details['quantity'] + delta, 'price': details['price']})
+        change_stream.append(changes)
+    return log_writer.submit(rows)
+
+def compact_catalog_log():
+    """Fold the current delta log into a new snapshot without blocking buys while the snapshot is written."""
+    global log_entries
+    with all_stripes_locked():
+        if log_entries == 0:
+            return
+        # the mmap store is updated in place, flushing it later covers at least everything up to now
+        snapshot = catalog if CATALOG_BACKEND == 'mmap' else dict(catalog)
+        # deltas still queued for the writer land in the new log, replay skips them as the snapshot covers them
+        log_writer.rotate(CATALOG_COMPACTING_LOG_FILE)
+        with LOCK:
+            log_entries = 0
+            snapshot_seq = log_seq
+    write_snapshot(snapshot)
+    os.remove(CATALOG_COMPACTING_LOG_FILE)
+    print(f"Compacted catalog log into snapshot at seq {snapshot_seq}")
+
+def compaction_loop():
+    while True:
+        time.sleep(COMPACTION_INTERVAL)
+        if log_entries >= COMPACTION_THRESHOLD:
+            try:
+                compact_catalog_log()
+            except Exception as e:
+                print(f"Catalog log compaction failed: {e}")
+
+class ChangeStream:
+    """ The most recent catalog changes in sequence order, tailed by read-only replicas """
+    def __init__(self, capacity=CHANGE_STREAM_SIZE):
+        self.changes = deque(maxlen=capacity)
+        self.base_seq = 0  # seq just before the oldest retained change
+        self.seq = 0  # seq of the newest change
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+
+    def reset(self, seq):
+        """Start an empty stream after seq, e.g. once the catalog is loaded."""
+        with self.lock:
+            self.changes.clear()
+            self.base_seq = self.seq = seq
+
+    def append(self, changes):
+        """Add changes whose seqs directly follow the newest one."""
+        with self.lock:
+            for change in changes:
+                if len(self.changes) == self.changes.maxlen:
+                    self.base_seq = self.changes[0]['seq']
+                self.changes.append(change)
+            if changes:
+                self.seq = changes[-1]['seq']
+                self.appended.notify_all()
+
+    def since(self, seq, limit, wait=0):
+        """Up to limit changes after seq, waiting up to wait seconds for one if there are none yet.
+        Returns None when seq is outside the retained window and the caller has to start from a snapshot."""
+        with self.lock:
+            if seq < self.base_seq or seq > self.seq:
+                return None
+            self.appended.wait_for(lambda: self.seq > seq, wait)
+            if seq < self.base_seq:
+                return None
+            return list(islice(self.changes, seq - self.base_seq, seq - self.base_seq + limit))
+
+change_stream = ChangeStream()
+
+def handle_changes(since, limit, wait):
+    """Changes after since for a replica, or a reset when it has fallen out of the stream's window."""
+    changes = change_stream.since(since, limit, min(wait, CHANGE_STREAM_WAIT))
+    if changes is None:
+        return {"reset": True, "seq": change_stream.seq}
+    return {"changes": changes, "seq": change_stream.seq}
+
+def handle_changes_snapshot():
+    """Every product with the seq of its last change, and a stream seq to follow the changes from.
+    Every change up to that seq is already in the entries, later ones may be too; a replica applies a change
+    only if it is newer than the entry's seq."""
+    seq = change_stream.seq
+    return {"seq": seq, "products": dict(catalog)}
+
+def follow_primary():
+    """Replica mode: load a snapshot from the primary, then keep applying its change stream."""
+    global catalog, replica_seq
+    primary_url = f"http://{CATALOG_PRIMARY}"
+    needs_snapshot = True
+    while True:
         try:
-            with open(CATALOG_FILE, 'r') as file:
-                reader = csv.DictReader(file)
-                catalog = {row['name']: {'price': float(row['price']), 'quantity': int(row['quantity'])} for row in reader}
-        except FileNotFoundError:
-            catalog = {
-                "Tux": {"price": 15.99, "quantity": 100},
-                "Whale": {"price": 25.99, "quantity": 100},
-                "Fox": {"price": 12.99, "quantity": 100},
-                "Python": {"price": 20.99, "quantity": 100},
-                "Barbie": {"price": 55.99, "quantity": 100},
-                "Lego": {"price": 45.99, "quantity": 100},
-                "Monopoly": {"price": 10.99, "quantity": 100},
-                "Frisbee": {"price": 5.99, "quantity": 100},
-                "Marbles": {"price": 7.99, "quantity": 100},
-                "Giraffe": {"price": 75.99, "quantity": 100}
+            if needs_snapshot:
+                response = http_client.get(f"{primary_url}/changes/snapshot")
+                response.raise_for_status()
+                snapshot = response.json()
+                catalog = snapshot["products"]
+                replica_seq = snapshot["seq"]
+                needs_snapshot = False
+                print(f"Replica loaded {len(catalog)} products from {CATALOG_PRIMARY} at seq {replica_seq}")
+            response = http_client.get(f"{primary_url}/changes", params={"since": replica_seq, "wait": CHANGE_STREAM_WAIT},
+                                   timeout=CHANGE_STREAM_WAIT + INVALIDATION_TIMEOUT)
+            response.raise_for_status()
+            batch = response.json()
+            if batch.get("reset"):
+                needs_snapshot = True
+                continue
+            for change in batch["changes"]:
+                details = catalog.get(change['name'])
+                if details is not None and change['seq'] > details['seq']:
+                    catalog[change['name']] = {'price': change['price'], 'quantity': change['quantity'], 'seq': change['seq']}
+                replica_seq = change['seq']
+        except Exception as e:
+            print(f"Following catalog primary {CATALOG_PRIMARY} failed: {e}")
+            time.sleep(CHANGE_STREAM_WAIT)
+
+def catalog_seq():
+    """Seq of the latest change reflected in this process's catalog."""
+    return replica_seq if CATALOG_PRIMARY else log_seq
+
+class InvalidationDispatcher:
+    """ Sends front-end cache invalidations from a background thread, merging repeats of the same product """
+    def __init__(self, url, capacity=INVALIDATION_QUEUE_SIZE, batch_size=INVALIDATION_BATCH_SIZE, timeout=INVALIDATION_TIMEOUT,
+                 enabled=True):
+        self.url = url
+        self.enabled = enabled  # a disabled dispatcher ignores invalidations, front ends follow the stream instead
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.pending = OrderedDict()  # product name -> version (seq) of its latest change, oldest first
+        self.flush_all = False  # set when an invalidation had to be dropped, the next batch clears the whole cache
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        # counters
+        self.enqueued = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.sent = 0
+        self.batches = 0
+        self.failures = 0
+
+    def start(self):
+        if self.enabled:
+            threading.Thread(target=self.dispatch_loop, daemon=True).start()
+
+    def invalidate(self, product_versions):
+        """Queue invalidations of {product name: version of the change} without blocking the caller.
+        Names queued together share a batch when they fit in one."""
+        if not self.enabled:
+            return
+        with self.lock:
+            for product_name, version in product_versions.items():
+                self.enqueued += 1
+                if product_name in self.pending:
+                    self.coalesced += 1
+                    self.pending[product_name] = max(self.pending[product_name], version)
+                elif len(self.pending) >= self.capacity:
+                    self.dropped += 1
+                    self.flush_all = True
+                else:
+                    self.pending[product_name] = version
+            self.not_empty.notify()
+
+    def invalidate_all(self):
+        """Queue a flush of the whole front-end cache, found-product and unknown-product entries alike."""
+        if not self.enabled:
+            return
+        with self.lock:
+            self.flush_all = True
+            self.not_empty.notify()
+
+    def dispatch_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.flush_all:
+                    self.not_empty.wait()
+                if self.flush_all:
+                    # a full flush covers everything queued so far
+                    batch = dict(self.pending)
+                    self.pending.clear()
+                    self.flush_all = False
+                    payload = {"all": True}
+                else:
+                    batch = dict(self.pending.popitem(last=False) for _ in range(min(self.batch_size, len(self.pending))))
+                    # a front end keeps a cache entry that is already at the version of the change
+                    payload = {"names": list(batch), "versions": list(batch.values())}
+            # a replica that has applied this seq reflects every change behind the batch
+            payload.update({"seq": max(batch.values()) if "names" in payload else log_seq, "shard": CATALOG_SHARD_ID})
+            try:
+                response = http_client.post(self.url, json=payload, timeout=self.timeout)
+                response.raise_for_status()
+                with self.lock:
+                    self.sent += len(batch)
+                    self.batches += 1
+            except Exception as e:
+                print(f"Invalidation batch to {self.url} failed: {e}")
+                with self.lock:
+                    self.failures += 1
+                    # put the batch back unless the queue filled up meanwhile, then fall back to a full flush
+                    if payload.get("all") or len(self.pending) + len(batch) > self.capacity:
+                        self.flush_all = True
+                    else:
+                        for name, version in batch.items():
+                            self.pending[name] = max(self.pending.get(name, version), version)
+                time.sleep(self.timeout)  # back off while the front end is unreachable
+
+    def stats(self):
+        with self.lock:
+            return {
+                "enabled": self.enabled,
+                "queue_depth": len(self.pending),
+                "capacity": self.capacity,
+                "enqueued": self.enqueued,
+                "coalesced": self.coalesced,
+                "dropped": self.dropped,
+                "sent": self.sent,
+                "batches": self.batches,
+                "failures": self.failures,
+                "flush_all_pending": self.flush_all,
             }
-            with open(CATALOG_FILE, 'w', newline='') as file:
-                writer = csv.DictWriter(file, fieldnames=['name', 'price', 'quantity'])
-                writer.writeheader()
-                for name, details in catalog.items():
-                    writer.writerow({'name': name, 'price': details['price'], 'quantity': details['quantity']})
-
-def send_invalidation_request(product_name):
-    url = f"http://{FRONTEND_HOST}:{FRONT_END_PORT}/invalidate/{product_name}"
-    try:
-        response = requests.post(url)  # Added timeout for network calls
-        response_data = response.json()
-        if response.status_code == 200:
-            print(f"{response_data}")
-        else:
-            print(f"{response_data}")
-    except Exception as e:
-        print(f"Unexpected error during invalidation request for {product_name}: {e}")
 
-def restock_catalog():
-    while True:
-        with LOCK:
-            updated = False
-            for product, details in catalog.items():
-                if details['quantity'] == 0:
-                    print(f"Restocking {product}")
-                    details['quantity'] = 100
-                    updated = True
-                    send_invalidation_request(product)  # Invalidate the front-end cache for this product
-            if updated:
-                with open(CATALOG_FILE, 'w', newline='') as file:
-                    writer = csv.DictWriter(file, fieldnames=['name', 'price', 'quantity'])
-                    writer.writeheader()
-                    for name, details in catalog.items():
-                        writer.writerow({'name': name, 'price': details['price'], 'quantity': details['quantity']})
-        time.sleep(10)  # Rest for 10 seconds after processing any necessary restocking
+invalidation_dispatcher = InvalidationDispatcher(f"http://{FRONTEND_HOST}:{FRONT_END_PORT}/invalidate/",
+                                                 enabled=INVALIDATION_MODE == "post")
+
+class InvalidationStream:
+    """ Pushes the change stream to any number of subscribed front ends as server-sent events, one connection each.
+    A subscriber gets a hello with this process's epoch and the current seq, then batches of invalidations
+    {"names", "versions", "first_seq", "seq", "shard"} whose seqs follow each other without gaps. A subscriber
+    resumes after the seq it last applied; when that seq has left the change stream's window it gets a reset
+    instead and has to flush the shard's entries. A new epoch tells it the catalog restarted. """
+    def __init__(self, changes, batch_size=INVALIDATION_BATCH_SIZE, heartbeat=INVALIDATION_STREAM_HEARTBEAT):
+        self.changes = changes
+        self.batch_size = batch_size
+        self.heartbeat = heartbeat
+        self.epoch = uuid.uuid4().hex
+        self.lock = threading.Lock()
+        # counters
+        self.subscribers = 0
+        self.connections = 0
+        self.batches = 0
+        self.resets = 0
+
+    def serve(self, wfile, since=None):
+        """Write events to a subscriber from the change after since, or from now, until it disconnects."""
+        with self.lock:
+            self.subscribers += 1
+            self.connections += 1
+        try:
+            seq = self.changes.seq
+            self.send(wfile, "hello", {"epoch": self.epoch, "seq": seq, "shard": CATALOG_SHARD_ID})
+            if since is not None:
+                seq = since
+            while True:
+                changes = self.changes.since(seq, self.batch_size, self.heartbeat)
+                if changes is None:
+                    seq = self.changes.seq
+                    self.send(wfile, "reset", {"seq": seq, "shard": CATALOG_SHARD_ID}, seq)
+                    with self.lock:
+                        self.resets += 1
+                elif not changes:
+                    # lets a subscriber tell an idle stream from a dead connection
+                    wfile.write(b": keepalive\n\n")
+                else:
+                    versions = {}
+                    for change in changes:
+                        versions[change['name']] = change['seq']
+                    seq = changes[-1]['seq']
+                    self.send(wfile, "invalidate", {"names": list(versions), "versions": list(versions.values()),
+                                                    "first_seq": changes[0]['seq'], "seq": seq, "shard": CATALOG_SHARD_ID}, seq)
+                    with self.lock:
+                        self.batches += 1
+        except OSError:
+            pass  # the subscriber went away
+        finally:
+            with self.lock:
+                self.subscribers -= 1
+
+    def send(self, wfile, event, data, event_id=None):
+        lines = f"event: {event}\n" + (f"id: {event_id}\n" if event_id is not None else "") + f"data: {json.dumps(data)}\n\n"
+        wfile.write(lines.encode('utf-8'))
+
+    def stats(self):
+        with self.lock:
+            return {"epoch": self.epoch, "subscribers": self.subscribers, "connections": self.connections,
+                    "batches": self.batches, "resets": self.resets}
+
+invalidation_stream = InvalidationStream(change_stream)
+
+class RestockScheduler:
+    """ Restocks products once a buy takes them down to their low watermark, after the policy's delay.
+    Products that come due together are restocked with one durable write and one invalidation batch. """
+    def __init__(self, low_watermark=RESTOCK_LOW_WATERMARK, target=RESTOCK_TARGET, delay=RESTOCK_DELAY):
+        self.default_policy = (low_watermark, target, delay)
+        self.policies = {}  # product name -> (low watermark, target level, delay in seconds)
+        self.due = []  # heap of (due time, product name)
+        self.scheduled = set()  # products waiting in the heap
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+
+    def load_policies(self, path=RESTOCK_POLICY_FILE):
+        """Per-product policies from an optional CSV file with name,low_watermark,target,delay columns."""
+        if not os.path.exists(path):
+            return
+        with open(path, 'r') as file:
+            for row in csv.DictReader(file):
+                self.policies[row['name']] = (int(row['low_watermark']), int(row['target']), float(row['delay']))
+
+    def policy(self, product_name):
+        return self.policies.get(product_name, self.default_policy)
+
+    def check(self, product_name, quantity):
+        """Schedule a restock if the product is at or below its low watermark. Called after every buy."""
+        low_watermark, target, delay = self.policy(product_name)
+        if quantity > low_watermark:
+            return
+        with self.lock:
+            if product_name in self.scheduled:
+                return
+            self.scheduled.add(product_name)
+            heapq.heappush(self.due, (time.monotonic() + delay, product_name))
+            self.wakeup.notify()
+
+    def start(self):
+        threading.Thread(target=self.schedule_loaded, daemon=True).start()
+        threading.Thread(target=self.restock_loop, daemon=True).start()
+
+    def schedule_loaded(self):
+        """Schedule products already at their watermark when the catalog was loaded, in the background so a
+        large catalog does not delay startup."""
+        for product_name, details in catalog.items():
+            self.check(product_name, details['quantity'])
+
+    def restock_loop(self):
+        while True:
+            with self.lock:
+                while not self.due or self.due[0][0] > time.monotonic():
+                    self.wakeup.wait(self.due[0][0] - time.monotonic() if self.due else None)
+                product_names = []
+                while self.due and self.due[0][0] <= time.monotonic():
+                    product_names.append(heapq.heappop(self.due)[1])
+            try:
+                self.restock(product_names)
+            except Exception as e:
+                print(f"Restocking {', '.join(product_names)} failed: {e}")
+
+    def restock(self, product_names):
+        with stripes_locked(product_names):
+            deltas = {}
+            for product_name in product_names:
+                target = self.policy(product_name)[1]
+                if catalog[product_name]['quantity'] < target:
+                    deltas[product_name] = target - catalog[product_name]['quantity']
+            # buys from now on may schedule these products again
+            with self.lock:
+                self.scheduled.difference_update(product_names)
+            if not deltas:
+                return
+            print(f"Restocking {', '.join(deltas)}")
+            commit = apply_deltas(deltas)  # Record the restocks in the catalog delta log as one write
+            invalidation_dispatcher.invalidate({name: catalog[name]['seq'] for name in deltas})  # Invalidate the front-end cache for these products
+        commit.wait()
+
+restock_scheduler = RestockScheduler()
+
+class ReservationTable:
+    """ Stock held for orders that are not placed yet. A hold takes its quantities out of what buys and other
+    holds can get until it is confirmed, released, or expires after its TTL. Holds live in memory only, a
+    restarted catalog has none, as if they had all expired. """
+    def __init__(self):
+        self.holds = {}  # reservation id -> (line items, expiry time)
+        self.reserved = {}  # product name -> quantity held, changed only under the product's stripe
+        self.expiries = []  # heap of (expiry time, reservation id), holds confirmed or released early stay until popped
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        # counters
+        self.counts = {"held": 0, "confirmed": 0, "released": 0, "expired": 0}
+
+    def available(self, product_name):
+        """Stock of a product that is not held. Caller must hold the product's stripe."""
+        return catalog[product_name]['quantity'] - self.reserved.get(product_name, 0)
+
+    def hold(self, line_items, ttl):
+        """Hold the line items for ttl seconds and return the reservation id. Caller must hold their stripes."""
+        reservation_id = uuid.uuid4().hex
+        expires_at = time.monotonic() + ttl
+        with self.lock:
+            self.holds[reservation_id] = (line_items, expires_at)
+            for product_name, quantity in line_items.items():
+                self.reserved[product_name] = self.reserved.get(product_name, 0) + quantity
+            heapq.heappush(self.expiries, (expires_at, reservation_id))
+            self.counts["held"] += 1
+            if self.expiries[0][1] == reservation_id:
+                self.wakeup.notify()  # expires before anything the sweeper waits for
+        return reservation_id
+
+    def line_items(self, reservation_id):
+        with self.lock:
+            hold = self.holds.get(reservation_id)
+            return hold[0] if hold else None
+
+    def take(self, reservation_id):
+        """Remove a hold and give its quantities back. Caller must hold the stripes of its products.
+        Returns (line items, expiry time), or None if the hold is already gone."""
+        with self.lock:
+            hold = self.holds.pop(reservation_id, None)
+            if hold is None:
+                return None
+            for product_name, quantity in hold[0].items():
+                self.reserved[product_name] -= quantity
+                if not self.reserved[product_name]:
+                    del self.reserved[product_name]
+            return hold
+
+    def record(self, outcome):
+        with self.lock:
+            self.counts[outcome] += 1
+
+    def start(self):
+        threading.Thread(target=self.expiry_loop, daemon=True).start()
+
+    def expiry_loop(self):
+        """Release holds as they expire, sleeping until the earliest expiry instead of scanning for them."""
+        while True:
+            with self.lock:
+                while not self.expiries or self.expiries[0][0] > time.monotonic():
+                    self.wakeup.wait(self.expiries[0][0] - time.monotonic() if self.expiries else None)
+                reservation_id = heapq.heappop(self.expiries)[1]
+                hold = self.holds.get(reservation_id)
+            if hold is None:
+                continue  # confirmed or released before it expired
+            with stripes_locked(hold[0]):
+                if self.take(reservation_id) is not None:
+                    self.record("expired")
+                    print(f"Reservation {reservation_id} expired")
+
+    def stats(self):
+        with self.lock:
+            return dict(self.counts, active=len(self.holds), reserved_quantity=sum(self.reserved.values()))
+
+reservation_table = ReservationTable()
 
 def handle_query(product_name):
-    with LOCK:
-        if product_name in catalog:
-            product_info = catalog[product_name]
-            response_data = {'name': product_name, 'price': product_info['price'], 'quantity': product_info['quantity']}
-            return response_data, 200
+    # lock-free: entries are replaced as a whole, so this is a consistent snapshot of the product
+    product_info = catalog.get(product_name)
+    if product_info is not None:
+        response_data = {'name': product_name, 'price': product_info['price'], 'quantity': product_info['quantity'], 'version': product_info['seq']}
+        return response_data, 200
+    else:
+        print(f"query error for {product_name}")
+        return None, 404
+
+def handle_bulk_query(product_names=None):
+    """Lock-free lookup of several products, or of the whole catalog when no names are given."""
+    if product_names is None:
+        product_names = list(catalog)
+    products, not_found = [], []
+    for product_name in product_names:
+        product_info, response_code = handle_query(product_name)
+        if response_code == 200:
+            products.append(product_info)
         else:
-            print(f"query error for {product_name}")
-            return None, 404
+            not_found.append(product_name)
+    return {"products": products, "not_found": not_found}
+
+def parse_line_items(order_data):
+    """Quantities to buy per product, from {"name", "quantity"} or {"items": [{"name", "quantity"}, ...]}.
+    Returns None for a malformed request."""
+    if not isinstance(order_data, dict):
+        return None
+    items = order_data.get("items", [order_data])
+    if not isinstance(items, list) or not items:
+        return None
+    line_items = {}
+    for item in items:
+        if not isinstance(item, dict):
+            return None
+        product_name = item.get("name")
+        quantity = item.get("quantity")
+        # bool is an int subclass, "quantity": true is not a quantity of 1
+        if not isinstance(product_name, str) or not product_name or not is_count(quantity) or quantity <= 0:
+            return None
+        line_items[product_name] = line_items.get(product_name, 0) + quantity
+    return line_items
+
+def check_line_items(line_items, expected_versions):
+    """Error response for line items that cannot be bought or held right now, None if they all can.
+    Caller must hold the stripes of all the products."""
+    for product_name in line_items:
+        if product_name not in catalog:
+            return {"error": {"code": 404, "message": f"product {product_name} not found"}}, 404
+    for product_name, version in expected_versions.items():
+        if catalog[product_name]['seq'] != version:
+            return {"error": {"code": 409, "message": f"product {product_name} changed since version {version}"}}, 409
+    for product_name, quantity in line_items.items():
+        if reservation_table.available(product_name) < quantity:
+            return {"error": {"code": 400, "message": f"product {product_name} is out of stock"}}, 400
+    return None
+
+def apply_buy(line_items):
+    """Subtract the bought quantities, invalidate them and check for restocks. Caller must hold the stripes of
+    all the products. Returns the commit to wait on and the products' new quantity and version."""
+    # Subtract the requested quantities and append them to the delta log as one write instead of rewriting the catalog CSV file
+    commit = apply_deltas({product_name: -quantity for product_name, quantity in line_items.items()})
+    products = []
+    for product_name in line_items:
+        details = catalog[product_name]
+        products.append({'name': product_name, 'price': details['price'], 'quantity': details['quantity'], 'version': details['seq']})
+    #invalidate products from cache when the catalog is successfully updated
+    invalidation_dispatcher.invalidate({product['name']: product['version'] for product in products})
+    for product in products:
+        restock_scheduler.check(product['name'], product['quantity'])
+    return commit, products
+
+def is_count(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def expected_versions_of(order_data):
+    """{product name: version} of the line items that carry one, for a request parse_line_items accepted."""
+    items = order_data.get("items", [order_data]) if isinstance(order_data, dict) else []
+    return {item["name"]: item["version"] for item in items if isinstance(item, dict) and is_count(item.get("version"))}
 
 def handle_buy(order_data):
-    global catalog
-    product_name = order_data.get("name")
-    quantity = order_data.get("quantity")
-    
-    if not product_name or not quantity:
+    """Buy one product, or several products atomically: either every decrement is applied or none is.
+    A decrement applies only if the product has enough unreserved stock and, when the line item carries a
+    "version", the product is still at that version. Returns (response data, response code); on success the
+    data holds every bought product's new quantity and version so callers need no separate lookup."""
+    line_items = parse_line_items(order_data)
+    if not line_items:
         print("Incomplete arguments/ Bad req")
-        return 404
+        return {"error": {"code": 400, "message": "malformed line items"}}, 400
     try:
-        with LOCK:
-            if product_name in catalog:
-                if catalog[product_name]['quantity'] >= quantity:
-                    print("product is in stock, updating catalog")
-                    catalog[product_name]['quantity'] -= quantity  # Subtract the requested quantity from catalog
-                    # Update catalog CSV file with new corresponding quantity
-                    with open(CATALOG_FILE, 'r') as file:
-                        reader = csv.DictReader(file)
-                        rows = list(reader)
-
-                    # corresponding row to the product name is found and its quantity is updated
-                    for row in rows:
-                        if row['name'] == product_name:
-                            row['quantity'] = str(int(row['quantity']) - int(quantity))
-                            break
-
-                    # modified rows written back to the catalog disk csv file
-                    with open(CATALOG_FILE, 'w', newline='') as file:
-                        writer = csv.DictWriter(file, fieldnames=['name', 'price', 'quantity'])
-                        writer.writeheader()
-                        writer.writerows(rows)
-                    #invalidate product from cache when the catalog is successfully updated
-                    send_invalidation_request(product_name)
-
-                    return 200
-                else:
-                    return 400
-            else:
-                return 404
+        # only buys of products sharing these stripes wait for each other
+        with stripes_locked(line_items):
+            error = check_line_items(line_items, expected_versions_of(order_data))
+            if error:
+                return error
+            print(f"{', '.join(line_items)} in stock, updating catalog")
+            commit, products = apply_buy(line_items)
+        # acknowledge the buy only once its log batch is durable, without holding the stripes
+        commit.wait()
+        return {"products": products}, 200
     except Exception as e:
-            print(f"Error occurred during purchase of for {product_name}: {e}")
-            return 404
+            print(f"Error occurred during purchase of {', '.join(line_items)}: {e}")
+            return {"error": {"code": 404, "message": "updating catalog failed"}}, 404
+
+def handle_hold(order_data):
+    """Reserve the line items of a buy request for "ttl" seconds (RESERVATION_TTL by default)."""
+    line_items = parse_line_items(order_data)
+    ttl = order_data.get("ttl", RESERVATION_TTL) if line_items else None
+    if not line_items or not isinstance(ttl, (int, float)) or isinstance(ttl, bool) or not 0 < ttl <= RESERVATION_MAX_TTL:
+        return {"error": {"code": 400, "message": "bad reservation request"}}, 400
+    with stripes_locked(line_items):
+        error = check_line_items(line_items, expected_versions_of(order_data))
+        if error:
+            return error
+        reservation_id = reservation_table.hold(line_items, ttl)
+    print(f"Reserved {', '.join(line_items)} as {reservation_id} for {ttl}s")
+    return {"reservation_id": reservation_id, "ttl": ttl}, 200
 
-class CatalogRequestHandler(BaseHTTPRequestHandler):
+def handle_confirm(reservation_id):
+    """Turn a reservation into a buy. The stock was held for it, so this only fails if the hold is gone."""
+    line_items = reservation_table.line_items(reservation_id)
+    if line_items is None:
+        return {"error": {"code": 404, "message": f"reservation {reservation_id} not found"}}, 404
+    with stripes_locked(line_items):
+        hold = reservation_table.take(reservation_id)
+        if hold is None:
+            return {"error": {"code": 404, "message": f"reservation {reservation_id} not found"}}, 404
+        if hold[1] <= time.monotonic():
+            # expired, but taken before the sweeper got to it
+            reservation_table.record("expired")
+            return {"error": {"code": 410, "message": f"reservation {reservation_id} expired"}}, 410
+        commit, products = apply_buy(line_items)
+        reservation_table.record("confirmed")
+    commit.wait()
+    return {"products": products}, 200
+
+def handle_release(reservation_id):
+    """Give a reservation's stock back before it expires."""
+    line_items = reservation_table.line_items(reservation_id)
+    if line_items is None:
+        return {"error": {"code": 404, "message": f"reservation {reservation_id} not found"}}, 404
+    with stripes_locked(line_items):
+        if reservation_table.take(reservation_id) is None:
+            return {"error": {"code": 404, "message": f"reservation {reservation_id} not found"}}, 404
+        reservation_table.record("released")
+    return {"released": reservation_id}, 200
+
+class CatalogRequestHandler(KeepAliveHandler):
     def do_GET(self):
         parsed_path = urllib.parse.urlparse(self.path)
+        if parsed_path.path == "/stats/commit":
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(log_writer.stats()).encode('utf-8'))
+            return
+        if parsed_path.path == "/stats/invalidation":
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(dict(invalidation_dispatcher.stats(), mode=INVALIDATION_MODE,
+                                             stream=invalidation_stream.stats())).encode('utf-8'))
+            return
+        if parsed_path.path == "/invalidations/stream":
+            # front-end subscription: /invalidations/stream?since=<seq>, or a Last-Event-ID header on reconnect
+            query = urllib.parse.parse_qs(parsed_path.query)
+            since = query.get("since", [self.headers.get("Last-Event-ID")])[0]
+            try:
+                since = int(since) if since is not None else None
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            invalidation_stream.serve(self.start_stream("text/event-stream"), since)
+            return
+        if parsed_path.path == "/stats/http":
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(http_client.stats()).encode('utf-8'))
+            return
+        if parsed_path.path == "/stats/reservations":
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(reservation_table.stats()).encode('utf-8'))
+            return
+        if parsed_path.path == "/changes/snapshot":
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(handle_changes_snapshot()).encode('utf-8'))
+            return
+        if parsed_path.path == "/changes":
+            # change stream: /changes?since=<seq>&limit=<n>&wait=<seconds>
+            query = urllib.parse.parse_qs(parsed_path.query)
+            try:
+                since = int(query.get("since", ["0"])[0])
+                limit = int(query.get("limit", ["1000"])[0])
+                wait = float(query.get("wait", ["0"])[0])
+            except ValueError:
+                self.send_response(400)
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(handle_changes(since, limit, wait)).encode('utf-8'))
+            return
+        if CATALOG_PRIMARY and replica_seq < 0:
+            self.send_response(503)
+            self.send_header('Content-Type', 'text/plain')
+            self.end_headers()
+            self.wfile.write(f"Replica has not loaded {CATALOG_PRIMARY} yet".encode('utf-8'))
+            return
+        if parsed_path.path == "/products":
+            # bulk query: /products?names=a,b,c or the full listing for /products
+            query = urllib.parse.parse_qs(parsed_path.query)
+            product_names = [name for name in ",".join(query["names"]).split(",") if name] if "names" in query else None
+            # read before the lookup, so the answer reflects at least this seq
+            seq = catalog_seq()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('X-Catalog-Seq', str(seq))
+            self.end_headers()
+            self.wfile.write(json.dumps(handle_bulk_query(product_names)).encode('utf-8'))
+            return
         product_name = parsed_path.path.split("/")[-1]
+        seq = catalog_seq()
         product_info, response_code = handle_query(product_name)
         self.send_response(response_code)
         self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Catalog-Seq', str(seq))
         self.end_headers()
         if product_info:
             product_response = json.dumps(product_info)
             self.wfile.write(product_response.encode('utf-8'))
 
     def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = json.loads(self.rfile.read(content_length))
-        response_code = handle_buy(post_data)
-        self.send_response(response_code)
-        if response_code == 200:
-            self.send_header('Content-Type', 'application/json')
-            self.end_headers()
-        else:
+        content_length = int(self.headers.get('Content-Length', 0))
+        request_body = self.rfile.read(content_length)
+        if CATALOG_PRIMARY:
+            self.send_response(405)
             self.send_header('Content-Type', 'text/plain')
             self.end_headers()
-            self.wfile.write(f"Updating catalog failed: {response_code}".encode('utf-8'))
+            self.wfile.write(f"Read-only replica of {CATALOG_PRIMARY}".encode('utf-8'))
+            return
+        path = urllib.parse.urlparse(self.path).path.rstrip("/").split("/")
+        try:
+            post_data = json.loads(request_body) if request_body else {}
+        except ValueError:
+            post_data = None  # answered as malformed below
+        # reservations: POST /reservations holds stock, /reservations/<id>/confirm buys it, /reservations/<id>/release frees it
+        if path[1:2] == ["reservations"] and len(path) == 2:
+            response_data, response_code = handle_hold(post_data)
+        elif path[1:2] == ["reservations"] and len(path) == 4 and path[3] == "confirm":
+            response_data, response_code = handle_confirm(path[2])
+        elif path[1:2] == ["reservations"] and len(path) == 4 and path[3] == "release":
+            response_data, response_code = handle_release(path[2])
+        else:
+            response_data, response_code = handle_buy(post_data)
+        self.send_response(response_code)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(json.dumps(response_data).encode('utf-8'))
 
 def start_catalog_service():
+    if CATALOG_PRIMARY:
+        # a replica keeps no files and runs no background jobs of its own, it only mirrors the primary
+        threading.Thread(target=follow_primary, daemon=True).start()
+        catalog_server = ThreadingHTTPServer((CATALOG_HOST, CATALOG_PORT), CatalogRequestHandler)
+        print(f"Starting catalog replica of {CATALOG_PRIMARY} on {CATALOG_HOST}:{CATALOG_PORT}...")
+        catalog_server.serve_forever()
+        return
     load_catalog()
-    restock_thread = threading.Thread(target=restock_catalog, daemon=True)
-    restock_thread.start()
+    invalidation_dispatcher.start()
+    # announce this catalog's products: it may have come up with products the front end has cached as unknown.
+    # Stream subscribers see the new epoch instead.
+    invalidation_dispatcher.invalidate_all()
+    restock_scheduler.load_policies()
+    restock_scheduler.start()
+    reservation_table.start()
+    compaction_thread = threading.Thread(target=compaction_loop, daemon=True)
+    compaction_thread.start()
     catalog_server = ThreadingHTTPServer((CATALOG_HOST, CATALOG_PORT), CatalogRequestHandler)
     print(f"Starting catalog service on {CATALOG_HOST}:{CATALOG_PORT}...")
     catalog_server.serve_forever()
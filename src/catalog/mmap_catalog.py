@@ -0,0 +1,136 @@
+import mmap
+import os
+import struct
+import threading
+from collections import deque
+from collections.abc import Mapping
+
+# File layout: a header followed by one fixed-width slot per product.
+# header: magic, format version, number of slots, highest seq ever written to a slot
+# Header and slots are padded to 32 bytes, a divisor of the page size, so no slot straddles two pages and
+# a crash can never leave half of a slot written.
+HEADER = struct.Struct('<4sIQQ8x')
+# slot: quantity, price, seq of the last change applied to the slot
+SLOT = struct.Struct('<qdq8x')
+MAGIC = b'CATB'
+VERSION = 2
+# version 1 layout, unpadded, upgraded on open
+V1_HEADER = struct.Struct('<4sIQQ')
+V1_SLOT = struct.Struct('<qdq')
+
+
+def upgrade_v1(data_path, index_path):
+    """Rewrite a version 1 store in the current layout, leaving any other file alone."""
+    with open(data_path, 'rb') as file:
+        data = file.read()
+    if len(data) < V1_HEADER.size:
+        return
+    magic, version, slots, _ = V1_HEADER.unpack_from(data, 0)
+    if magic != MAGIC or version != 1:
+        return
+    with open(index_path, 'r') as file:
+        names = file.read().splitlines()
+    entries = {}
+    for slot, name in enumerate(names[:slots]):
+        quantity, price, seq = V1_SLOT.unpack_from(data, V1_HEADER.size + slot * V1_SLOT.size)
+        entries[name] = {'price': price, 'quantity': quantity, 'seq': seq}
+    store = MmapCatalog.create(data_path, index_path, entries)
+    store.map.close()
+    store.file.close()
+
+
+class MmapCatalog(Mapping):
+    """ Catalog kept in a memory-mapped file of fixed-width binary slots with a name -> slot index.
+    Reads return a fresh {'price', 'quantity', 'seq'} dict. A write is only staged in memory until write_back()
+    is called once the change's log row is durable: dirty pages of the mapping survive a killed process, so a
+    slot written earlier could keep a change that was never logged nor acknowledged. """
+    def __init__(self, data_path, index_path):
+        self.data_path = data_path
+        self.index_path = index_path
+        # the index file lists one product name per line, the line number is the product's slot
+        with open(index_path, 'r') as file:
+            self.index = {name: slot for slot, name in enumerate(file.read().splitlines())}
+        upgrade_v1(data_path, index_path)
+        self.file = open(data_path, 'r+b')
+        self.map = mmap.mmap(self.file.fileno(), 0)
+        magic, version, slots, self.seq = HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or version != VERSION or slots != len(self.index):
+            raise ValueError(f"{data_path} does not match {index_path}")
+        self.header_lock = threading.Lock()
+        self.staged = {}  # product name -> values written but not yet durable in the log, oldest first
+        self.staged_lock = threading.Lock()
+
+    @classmethod
+    def create(cls, data_path, index_path, entries):
+        """Write a new store holding entries ({name: {'price', 'quantity', 'seq'}}) and open it."""
+        with open(data_path + ".tmp", 'wb') as file:
+            file.write(HEADER.pack(MAGIC, VERSION, len(entries), max((details['seq'] for details in entries.values()), default=0)))
+            for details in entries.values():
+                file.write(SLOT.pack(details['quantity'], details['price'], details['seq']))
+            file.flush()
+            os.fsync(file.fileno())
+        with open(index_path + ".tmp", 'w') as file:
+            file.write("".join(f"{name}\n" for name in entries))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(index_path + ".tmp", index_path)
+        os.replace(data_path + ".tmp", data_path)
+        return cls(data_path, index_path)
+
+    def offset(self, product_name):
+        return HEADER.size + self.index[product_name] * SLOT.size
+
+    def __getitem__(self, product_name):
+        with self.staged_lock:
+            staged = self.staged.get(product_name)
+            if staged:
+                return dict(staged[-1])
+            quantity, price, seq = SLOT.unpack_from(self.map, self.offset(product_name))
+        return {'price': price, 'quantity': quantity, 'seq': seq}
+
+    def __setitem__(self, product_name, details):
+        """Stage a new value of an existing product. New products can only be added through create()."""
+        if product_name not in self.index:
+            raise KeyError(product_name)
+        with self.staged_lock:
+            self.staged.setdefault(product_name, deque()).append(dict(details))
+
+    def write_back(self, product_name, seq):
+        """Write the latest staged value of product_name up to seq to its slot, once the log holds it durably."""
+        with self.staged_lock:
+            staged = self.staged.get(product_name)
+            details = None
+            while staged and staged[0]['seq'] <= seq:
+                details = staged.popleft()
+            if staged is not None and not staged:
+                del self.staged[product_name]
+            if details is not None:
+                self.write_slot(product_name, details)
+
+    def write_back_all(self):
+        """Write every staged value, e.g. after replaying a log that is durable already."""
+        with self.staged_lock:
+            for product_name, staged in self.staged.items():
+                self.write_slot(product_name, staged[-1])
+            self.staged.clear()
+
+    def write_slot(self, product_name, details):
+        SLOT.pack_into(self.map, self.offset(product_name), details['quantity'], details['price'], details['seq'])
+        with self.header_lock:
+            # keep the highest seq in the header so startup does not have to scan every slot
+            if details['seq'] > self.seq:
+                self.seq = details['seq']
+                HEADER.pack_into(self.map, 0, MAGIC, VERSION, len(self.index), self.seq)
+
+    def __contains__(self, product_name):
+        return product_name in self.index
+
+    def __iter__(self):
+        return iter(self.index)
+
+    def __len__(self):
+        return len(self.index)
+
+    def flush(self):
+        """Write dirty pages back to the file; this is the mmap store's snapshot. Staged values are not part of it."""
+        self.map.flush()
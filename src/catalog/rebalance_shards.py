@@ -0,0 +1,80 @@
+import csv
+import glob
+import os
+import re
+import sys
+
+import catalog
+from common.shard_map import shard_index
+from mmap_catalog import MmapCatalog
+
+# Offline tool that repartitions the catalog data files over a new number of shards.
+# Stop every catalog process first, then from src/catalog run: python3 rebalance_shards.py <shard_count>
+# It reads the unsharded catalog.csv or the current catalog_shard<N> files (CSV or mmap), replays their delta logs
+# and writes catalog_shard<i>.csv for each new shard (catalog.csv again for a single shard).
+DATA_DIR = "catalog_data"
+
+
+def current_suffixes():
+    """'' for an unsharded catalog, '_shard<N>' for every shard with a snapshot on disk."""
+    suffixes = set()
+    for path in glob.glob(f"{DATA_DIR}/catalog*"):
+        match = re.fullmatch(r"catalog(_shard\d+)?\.(csv|bin)", os.path.basename(path))
+        if match:
+            suffixes.add(match.group(1) or "")
+    return sorted(suffixes)
+
+
+def data_files(suffix):
+    return [f"{DATA_DIR}/catalog{suffix}{name}" for name in
+            (".csv", "_log.csv", "_log.compacting.csv", ".bin", "_index.txt")]
+
+
+def read_current(suffix):
+    """Products of one current shard, with its delta logs applied."""
+    snapshot, log, compacting_log, data, index = data_files(suffix)
+    if os.path.exists(data):
+        # an mmap store is newer than the CSV snapshot it was imported from
+        store = MmapCatalog(data, index)
+        entries = dict(store.items())
+        store.map.close()
+    else:
+        entries = catalog.read_snapshot(snapshot)
+    catalog.replay_log(compacting_log, entries)
+    catalog.replay_log(log, entries)
+    return entries
+
+
+def rebalance(shard_count):
+    products = {}
+    suffixes = current_suffixes()
+    for suffix in suffixes:
+        products.update(read_current(suffix))
+    new_suffixes = [f"_shard{i}" for i in range(shard_count)] if shard_count > 1 else [""]
+    partitions = {suffix: {} for suffix in new_suffixes}
+    for name, details in products.items():
+        partitions[new_suffixes[shard_index(name, shard_count)]][name] = details
+    # every old log has been folded into the new snapshots. Each new shard continues from the highest seq of all
+    # the old ones: front ends and replicas only trust seqs that move forward, and a product's version must not
+    # go back either, wherever it lands.
+    seq = max((details['seq'] for details in products.values()), default=0)
+    for suffix, partition in partitions.items():
+        with open(f"{DATA_DIR}/catalog{suffix}.csv.tmp", 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=['name', 'price', 'quantity', 'seq'])
+            writer.writeheader()
+            for name, details in partition.items():
+                writer.writerow({'name': name, 'price': details['price'], 'quantity': details['quantity'], 'seq': seq})
+    for suffix in suffixes:
+        for path in data_files(suffix):
+            if os.path.exists(path):
+                os.remove(path)
+    for suffix, partition in partitions.items():
+        os.replace(f"{DATA_DIR}/catalog{suffix}.csv.tmp", f"{DATA_DIR}/catalog{suffix}.csv")
+        print(f"catalog{suffix}.csv: {len(partition)} products")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or not sys.argv[1].isdigit() or int(sys.argv[1]) < 1:
+        print("usage: python3 rebalance_shards.py <shard_count>")
+        sys.exit(1)
+    rebalance(int(sys.argv[1]))
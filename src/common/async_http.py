@@ -0,0 +1,220 @@
+import asyncio
+import json
+import urllib.parse
+from http import HTTPStatus
+
+from common.http_client import HTTP_POOL_SIZE, HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT, HTTP_RETRIES
+from common.http_server import HTTP_IDLE_TIMEOUT, HTTP_MAX_REQUESTS_PER_CONNECTION
+
+# Minimal HTTP/1.1 server and pooled client on asyncio streams, for services that run on an event loop
+# instead of a thread per request. Bodies are delimited by Content-Length (the client also reads chunked
+# and close-delimited responses); connections are kept alive on both sides.
+
+
+class UpstreamError(Exception):
+    """ A request to another service failed after it may have been sent """
+
+
+class UpstreamConnectError(UpstreamError):
+    """ No connection to the other service could be opened, so nothing was sent """
+
+
+class Request:
+    def __init__(self, method, target, headers, body):
+        self.method = method
+        parsed = urllib.parse.urlsplit(target)
+        self.path = parsed.path
+        self.query = parsed.query
+        self.headers = headers  # lower-case names
+        self.body = body
+
+    def json(self):
+        return json.loads(self.body.decode('utf-8'))
+
+
+def json_response(status, data):
+    return status, json.dumps(data).encode('utf-8'), "application/json"
+
+
+async def read_headers(reader):
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode('latin-1').partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def serve(handler, host, port, idle_timeout=HTTP_IDLE_TIMEOUT, max_requests=HTTP_MAX_REQUESTS_PER_CONNECTION):
+    """Serve handler(request) -> (status, body bytes, content type) on host:port until cancelled."""
+    async def handle_connection(reader, writer):
+        served = 0
+        try:
+            while served < max_requests:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                parts = request_line.decode('latin-1').split()
+                if len(parts) != 3:
+                    writer.write(b"HTTP/1.1 400 Bad Request\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+                    break
+                method, target, version = parts
+                headers = await read_headers(reader)
+                if headers.get("expect", "").lower() == "100-continue":
+                    writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+                body = await reader.readexactly(int(headers.get("content-length") or 0))
+                served += 1
+                connection = headers.get("connection", "").lower()
+                keep_alive = (connection != "close" if version == "HTTP/1.1" else connection == "keep-alive") and served < max_requests
+                try:
+                    status, response_body, content_type = await handler(Request(method, target, headers, body))
+                except Exception as e:
+                    print(f"Error handling {method} {target}: {e}")
+                    status, response_body, content_type = 500, b"", "text/plain"
+                head = f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {content_type}\r\nContent-Length: {len(response_body)}\r\n"
+                if not keep_alive:
+                    head += "Connection: close\r\n"
+                writer.write(head.encode('latin-1') + b"\r\n" + response_body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_connection, host, port, backlog=1024)
+    async with server:
+        await server.serve_forever()
+
+
+class Response:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers  # lower-case names
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise UpstreamError(f"HTTP {self.status_code}")
+
+
+class AsyncPooledClient:
+    """ Keep-alive HTTP client for an event loop, with a pool of idle connections per upstream.
+    Counterpart of common.http_client.PooledClient, with the same stats. """
+    def __init__(self, pool_size=HTTP_POOL_SIZE, connect_timeout=HTTP_CONNECT_TIMEOUT, read_timeout=HTTP_READ_TIMEOUT,
+                 retries=HTTP_RETRIES):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries  # connection attempts only, as in PooledClient
+        self.idle = {}  # (host, port) -> [(reader, writer)], most recently used last
+        # at most pool_size requests in flight per upstream, the rest wait here rather than pile onto the upstream
+        self.slots = {}  # (host, port) -> asyncio.Semaphore
+        self.counts = {}  # (host, port) -> {"requests", "connects"}
+
+    async def request(self, method, url, json_body=None, params=None, timeout=None):
+        parsed = urllib.parse.urlsplit(url)
+        upstream = (parsed.hostname, parsed.port or 80)
+        target = parsed.path or "/"
+        query = "&".join(part for part in (parsed.query, urllib.parse.urlencode(params or {})) if part)
+        if query:
+            target += "?" + query
+        body = json.dumps(json_body).encode('utf-8') if json_body is not None else b""
+        head = (f"{method} {target} HTTP/1.1\r\nHost: {parsed.netloc}\r\nContent-Length: {len(body)}\r\n"
+                + ("Content-Type: application/json\r\n" if json_body is not None else "") + "\r\n")
+        counts = self.counts.setdefault(upstream, {"requests": 0, "connects": 0})
+        counts["requests"] += 1
+        slots = self.slots.get(upstream)
+        if slots is None:
+            slots = self.slots[upstream] = asyncio.Semaphore(self.pool_size)
+        async with slots:
+            reader, writer = await self.acquire(upstream, counts)
+            released = False
+            try:
+                writer.write(head.encode('latin-1') + body)
+                response, reusable = await asyncio.wait_for(self.read_response(reader), timeout or self.read_timeout)
+                if reusable:
+                    self.release(upstream, reader, writer)
+                    released = True
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError, ValueError) as e:
+                raise UpstreamError(f"{method} {url} failed: {e!r}") from e
+            finally:
+                # also on cancellation, which would otherwise leave the socket and an unread response open
+                if not released:
+                    writer.close()
+        return response
+
+    async def get(self, url, params=None, timeout=None):
+        return await self.request("GET", url, params=params, timeout=timeout)
+
+    async def post(self, url, json=None, timeout=None):
+        return await self.request("POST", url, json_body=json, timeout=timeout)
+
+    async def acquire(self, upstream, counts):
+        idle = self.idle.get(upstream, [])
+        while idle:
+            reader, writer = idle.pop()
+            # skip connections the upstream closed while they sat in the pool
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer
+            writer.close()
+        counts["connects"] += 1
+        for attempt in range(self.retries + 1):
+            try:
+                return await asyncio.wait_for(asyncio.open_connection(*upstream), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError) as e:
+                if attempt == self.retries:
+                    raise UpstreamConnectError(f"connecting to {upstream[0]}:{upstream[1]} failed: {e!r}") from e
+
+    def release(self, upstream, reader, writer):
+        self.idle.setdefault(upstream, []).append((reader, writer))
+
+    async def read_response(self, reader):
+        """Read one response. Returns it and whether the connection can carry another request."""
+        status_line = await reader.readline()
+        if not status_line:
+            raise asyncio.IncompleteReadError(b"", None)
+        version, status = status_line.decode('latin-1').split()[:2]
+        headers = await read_headers(reader)
+        reusable = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+        if "content-length" in headers:
+            content = await reader.readexactly(int(headers["content-length"]))
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            content = b""
+            while True:
+                size = int((await reader.readline()).split(b";")[0], 16)
+                content += await reader.readexactly(size)
+                await reader.readline()
+                if size == 0:
+                    await read_headers(reader)  # trailers
+                    break
+        else:
+            content = await reader.read()
+            reusable = False
+        return Response(int(status), headers, content), reusable
+
+    def stats(self):
+        """Same layout as PooledClient.stats(): misses are TCP connects, hits are requests on a reused connection."""
+        upstreams = {}
+        for (host, port), counts in self.counts.items():
+            misses = min(counts["connects"], counts["requests"])
+            upstreams[f"{host}:{port}"] = {
+                "requests": counts["requests"],
+                "hits": counts["requests"] - misses,
+                "misses": misses,
+                "idle_connections": len(self.idle.get((host, port), [])),
+            }
+        return {
+            "pool_size": self.pool_size,
+            "hits": sum(upstream["hits"] for upstream in upstreams.values()),
+            "misses": sum(upstream["misses"] for upstream in upstreams.values()),
+            "upstreams": upstreams,
+        }
@@ -0,0 +1,136 @@
+import csv
+import os
+import threading
+import time
+from collections import deque
+
+# Default group commit bounds, shared by the catalog delta log and the order log
+GROUP_COMMIT_MAX_BATCH = int(os.getenv('GROUP_COMMIT_MAX_BATCH', 64))  # requests per fsync
+GROUP_COMMIT_MAX_WAIT_US = int(os.getenv('GROUP_COMMIT_MAX_WAIT_US', 200))  # how long a batch waits for more requests
+
+
+class Commit:
+    """ One batch of queued records, handed to every request that joined it """
+    def __init__(self):
+        self.rows = []
+        self.requests = 0
+        self.enqueued_at = []
+        self.done = threading.Event()
+        self.error = None
+
+    def wait(self):
+        """Block until the batch holding this request is written and fsynced."""
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+
+
+class GroupCommitWriter:
+    """ Appends CSV rows from many handler threads with one write and fsync per batch.
+    on_durable(rows), if given, is called with each batch's rows once they are fsynced and before rotate() can
+    move the file, so whatever it records covers exactly the rows in the file. """
+    def __init__(self, path, mode='a', max_batch=GROUP_COMMIT_MAX_BATCH, max_wait_us=GROUP_COMMIT_MAX_WAIT_US,
+                 on_durable=None):
+        self.path = path
+        self.on_durable = on_durable
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_us / 1_000_000
+        self.file = open(path, mode, newline='')
+        self.writer = csv.writer(self.file)
+        self.lock = threading.Lock()  # guards the pending batch
+        self.io_lock = threading.Lock()  # guards the open file
+        self.batch_ready = threading.Condition(self.lock)
+        self.pending = deque()  # batches waiting for the flusher, each at most max_batch requests
+        # statistics
+        self.batches = 0
+        self.committed_requests = 0
+        self.committed_rows = 0
+        self.max_batch_seen = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.recent_latencies = deque(maxlen=1024)
+        self.flusher = threading.Thread(target=self.flush_loop, daemon=True)
+        self.flusher.start()
+
+    def submit(self, rows):
+        """Queue rows that must become durable together and return the Commit to wait on."""
+        with self.lock:
+            if not self.pending or self.pending[-1].requests >= self.max_batch:
+                self.pending.append(Commit())
+            commit = self.pending[-1]
+            commit.rows.extend(rows)
+            commit.requests += 1
+            commit.enqueued_at.append(time.perf_counter())
+            if commit.requests == 1 or commit.requests >= self.max_batch:
+                self.batch_ready.notify()
+            return commit
+
+    def write(self, rows):
+        """Queue rows and block until they are durable."""
+        self.submit(rows).wait()
+
+    def flush_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending:
+                    self.batch_ready.wait()
+                # hold the batch open until it is full or the oldest request has waited max_wait
+                commit = self.pending[0]
+                deadline = commit.enqueued_at[0] + self.max_wait
+                while commit.requests < self.max_batch:
+                    remaining = deadline - time.perf_counter()
+                    if remaining <= 0:
+                        break
+                    self.batch_ready.wait(remaining)
+                self.pending.popleft()
+            try:
+                with self.io_lock:
+                    self.writer.writerows(commit.rows)
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                    if self.on_durable is not None:
+                        self.on_durable(commit.rows)
+            except Exception as e:
+                print(f"Group commit to {self.path} failed: {e}")
+                commit.error = e
+            self.record_stats(commit)
+            commit.done.set()
+
+    def record_stats(self, commit):
+        now = time.perf_counter()
+        with self.lock:
+            self.batches += 1
+            self.committed_requests += commit.requests
+            self.committed_rows += len(commit.rows)
+            self.max_batch_seen = max(self.max_batch_seen, commit.requests)
+            for enqueued_at in commit.enqueued_at:
+                latency = now - enqueued_at
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+                self.recent_latencies.append(latency)
+
+    def rotate(self, rotated_path):
+        """Move the current file to rotated_path and continue appending to a fresh file."""
+        with self.io_lock:
+            self.file.close()
+            os.replace(self.path, rotated_path)
+            self.file = open(self.path, 'w', newline='')
+            self.writer = csv.writer(self.file)
+
+    def stats(self):
+        """Batch size and commit latency (milliseconds) statistics."""
+        with self.lock:
+            recent = sorted(self.recent_latencies)
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_us": int(self.max_wait * 1_000_000),
+                "batches": self.batches,
+                "requests": self.committed_requests,
+                "rows": self.committed_rows,
+                "avg_batch_size": self.committed_requests / self.batches if self.batches else 0,
+                "max_batch_size": self.max_batch_seen,
+                "avg_commit_latency_ms": 1000 * self.total_latency / self.committed_requests if self.committed_requests else 0,
+                "p99_commit_latency_ms": 1000 * recent[int(0.99 * (len(recent) - 1))] if recent else 0,
+                "max_commit_latency_ms": 1000 * self.max_latency,
+                "queued_requests": sum(commit.requests for commit in self.pending),
+            }
@@ -0,0 +1,120 @@
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.util.retry import Retry
+
+# Defaults for the pooled client every service uses for its calls to the other services
+HTTP_POOL_SIZE = int(os.getenv('HTTP_POOL_SIZE', 32))  # kept-alive connections per upstream host:port
+HTTP_POOL_UPSTREAMS = int(os.getenv('HTTP_POOL_UPSTREAMS', 16))  # upstreams with a pool of their own
+HTTP_CONNECT_TIMEOUT = float(os.getenv('HTTP_CONNECT_TIMEOUT', 2))  # seconds
+HTTP_READ_TIMEOUT = float(os.getenv('HTTP_READ_TIMEOUT', 20))  # seconds
+# Connection attempts are retried: nothing has reached the upstream yet, so this is safe for POSTs too.
+# Requests that were sent are never retried here, callers decide whether repeating them is safe.
+HTTP_RETRIES = int(os.getenv('HTTP_RETRIES', 1))
+HTTP_RETRY_BACKOFF = float(os.getenv('HTTP_RETRY_BACKOFF', 0))  # seconds, doubled per retry
+
+
+class UpstreamCounters:
+    """ Requests sent, TCP connections opened and connections open now, per upstream host:port.
+    Kept by the client rather than its pools, which the pool manager may drop and recreate. """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}  # upstream -> {"requests", "connects", "open"}
+
+    def add(self, upstream, counter, amount=1):
+        with self.lock:
+            counts = self.counts.setdefault(upstream, {"requests": 0, "connects": 0, "open": 0})
+            counts[counter] += amount
+
+    def snapshot(self):
+        with self.lock:
+            return {upstream: dict(counts) for upstream, counts in self.counts.items()}
+
+
+class CountingHTTPConnection(HTTPConnection):
+    """ Connection that reports every request it sends and every TCP connect, including reconnects after the
+    server closed it, to its client's UpstreamCounters """
+    counters = None  # set on the subclass each PooledClient makes for itself
+    is_open = False
+
+    def connect(self):
+        self.counters.add(f"{self.host}:{self.port}", "connects")
+        super().connect()
+        if not self.is_open:
+            self.is_open = True
+            self.counters.add(f"{self.host}:{self.port}", "open")
+
+    def request(self, *args, **kwargs):
+        self.counters.add(f"{self.host}:{self.port}", "requests")
+        return super().request(*args, **kwargs)
+
+    def close(self):
+        if self.is_open:
+            self.is_open = False
+            self.counters.add(f"{self.host}:{self.port}", "open", -1)
+        super().close()
+
+
+class CountingHTTPConnectionPool(HTTPConnectionPool):
+    """ Connection pool of one upstream whose connections count into their client's UpstreamCounters """
+    ConnectionCls = CountingHTTPConnection
+
+
+class PooledClient:
+    """ Keep-alive HTTP client shared by all threads of a service, with one connection pool per upstream.
+    Takes the same arguments as requests.get/post and raises the same exceptions. """
+    def __init__(self, pool_size=HTTP_POOL_SIZE, upstreams=HTTP_POOL_UPSTREAMS, connect_timeout=HTTP_CONNECT_TIMEOUT,
+                 read_timeout=HTTP_READ_TIMEOUT, retries=HTTP_RETRIES, backoff=HTTP_RETRY_BACKOFF):
+        self.timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.counters = UpstreamCounters()
+        retry = Retry(total=retries, connect=retries, read=0, status=0, other=0, backoff_factor=backoff, raise_on_status=False)
+        # the adapter's pools are thread-safe and shared; sessions are not, so every thread gets its own on top of them
+        self.adapter = HTTPAdapter(pool_connections=upstreams, pool_maxsize=pool_size, max_retries=retry)
+        connection_class = type("CountingHTTPConnection", (CountingHTTPConnection,), {"counters": self.counters})
+        pool_class = type("CountingHTTPConnectionPool", (CountingHTTPConnectionPool,), {"ConnectionCls": connection_class})
+        self.adapter.poolmanager.pool_classes_by_scheme = dict(self.adapter.poolmanager.pool_classes_by_scheme,
+                                                               http=pool_class)
+        self.local = threading.local()
+
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            session = requests.Session()
+            session.mount('http://', self.adapter)
+            session.mount('https://', self.adapter)
+            self.local.session = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return self.session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def stats(self):
+        """Per upstream: requests sent, TCP connections opened for them (pool misses), requests that reused a
+        kept-alive connection (pool hits) and connections open now."""
+        upstreams = {}
+        for upstream, counts in self.counters.snapshot().items():
+            misses = min(counts["connects"], counts["requests"])
+            upstreams[upstream] = {
+                "requests": counts["requests"],
+                "hits": counts["requests"] - misses,
+                "misses": misses,
+                "open_connections": counts["open"],
+            }
+        return {
+            "pool_size": self.pool_size,
+            "hits": sum(upstream["hits"] for upstream in upstreams.values()),
+            "misses": sum(upstream["misses"] for upstream in upstreams.values()),
+            "upstreams": upstreams,
+        }
@@ -0,0 +1,89 @@
+import io
+import os
+import re
+from http.server import BaseHTTPRequestHandler
+
+# Persistent connections accepted by every service
+HTTP_IDLE_TIMEOUT = float(os.getenv('HTTP_IDLE_TIMEOUT', 30))  # seconds a kept-alive connection may sit idle
+HTTP_MAX_REQUESTS_PER_CONNECTION = int(os.getenv('HTTP_MAX_REQUESTS_PER_CONNECTION', 1000))
+
+CONTENT_LENGTH = re.compile(rb'^content-length:', re.IGNORECASE | re.MULTILINE)
+CONNECTION_CLOSE = re.compile(rb'^connection:\s*close', re.IGNORECASE | re.MULTILINE)
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """ HTTP/1.1 request handler that keeps connections open between requests.
+    A handler writes its response as usual; the response is buffered and sent with a Content-Length
+    computed from the body, so every response, error and empty ones included, delimits itself.
+    A connection is closed after HTTP_IDLE_TIMEOUT idle seconds or HTTP_MAX_REQUESTS_PER_CONNECTION requests. """
+    protocol_version = "HTTP/1.1"
+    timeout = HTTP_IDLE_TIMEOUT
+    max_requests = HTTP_MAX_REQUESTS_PER_CONNECTION
+
+    def setup(self):
+        super().setup()
+        self.requests_on_connection = 0
+
+    def handle_one_request(self):
+        socket_rfile, socket_wfile = self.rfile, self.wfile
+        self.wfile = io.BytesIO()
+        self.socket_wfile = socket_wfile
+        try:
+            super().handle_one_request()
+        finally:
+            response = self.wfile.getvalue()
+            self.rfile, self.wfile = socket_rfile, socket_wfile
+        if not response:
+            # no request (idle timeout or closed by the client), or a handler that answered nothing,
+            # which the client can only notice by the connection closing
+            self.close_connection = True
+            return
+        self.requests_on_connection += 1
+        if self.requests_on_connection >= self.max_requests:
+            self.close_connection = True
+        socket_wfile.write(self.delimit(response))
+        socket_wfile.flush()
+
+    def parse_request(self):
+        if not super().parse_request():
+            return False
+        # read the whole body up front, so a handler that ignores it cannot leave it in front of the next request
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, "Bad Content-Length")
+            return False
+        self.rfile = io.BytesIO(self.rfile.read(content_length))
+        return True
+
+    def delimit(self, response):
+        """Add the Content-Length, and Connection: close if this is the connection's last response."""
+        head, separator, body = response.partition(b"\r\n\r\n")
+        extra = b""
+        status = head[9:12]
+        if not CONTENT_LENGTH.search(head) and not (status.startswith(b"1") or status in (b"204", b"304")):
+            extra += b"Content-Length: " + str(len(body)).encode() + b"\r\n"
+        if self.close_connection and not CONNECTION_CLOSE.search(head):
+            extra += b"Connection: close\r\n"
+        if CONNECTION_CLOSE.search(head):
+            self.close_connection = True
+        return head + b"\r\n" + extra + separator[2:] + body
+
+    def start_stream(self, content_type):
+        """Send a 200 head for a body written as it is produced, e.g. server-sent events, and return the socket's
+        file to write the body to. The body bypasses the buffer and ends when the connection closes."""
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.socket_wfile.write(self.wfile.getvalue())
+        self.socket_wfile.flush()
+        self.wfile = io.BytesIO()
+        return self.socket_wfile
+
+    def handle_expect_100(self):
+        # the interim response has to reach the client before the body is sent, so it bypasses the buffer
+        self.socket_wfile.write(f"{self.protocol_version} 100 Continue\r\n\r\n".encode())
+        self.socket_wfile.flush()
+        return True
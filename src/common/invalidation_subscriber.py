@@ -0,0 +1,109 @@
+import http.client
+import json
+import os
+import threading
+import time
+
+# Subscriptions of the front ends to the catalog's GET /invalidations/stream
+INVALIDATION_STREAM_HEARTBEAT = float(os.getenv('INVALIDATION_STREAM_HEARTBEAT', 5))  # the catalog's keepalive interval
+INVALIDATION_RETRY_INTERVAL = float(os.getenv('INVALIDATION_RETRY_INTERVAL', 1))  # seconds before reconnecting
+
+
+class InvalidationSubscriber:
+    """ Follows one catalog shard's invalidation stream from a background thread, reconnecting after the last seq
+    it applied. When invalidations may have been missed, because of a gap in the seqs, a reset from a catalog that
+    no longer has the changes after that seq, or a catalog restart, the shard's cached products are flushed. """
+    def __init__(self, shard_id, host, port, heartbeat=INVALIDATION_STREAM_HEARTBEAT,
+                 retry_interval=INVALIDATION_RETRY_INTERVAL):
+        self.shard_id = shard_id
+        self.host, self.port = host, port
+        self.heartbeat = heartbeat
+        self.retry_interval = retry_interval
+        self.apply_batch = None
+        self.seq = None  # seq of the last batch applied
+        self.epoch = None  # the catalog process the stream came from
+        self.connected = False
+        # counters
+        self.connects = 0
+        self.batches = 0
+        self.gaps = 0
+        self.resets = 0
+        self.restarts = 0
+        self.failures = 0
+
+    def start(self, apply_batch):
+        """Follow the stream, handing each batch to apply_batch in stream order."""
+        self.apply_batch = apply_batch
+        threading.Thread(target=self.follow, daemon=True).start()
+
+    def follow(self):
+        while True:
+            try:
+                self.subscribe()
+            except Exception as e:
+                print(f"Invalidation stream of catalog shard {self.shard_id} failed: {e}")
+                self.failures += 1
+            self.connected = False
+            time.sleep(self.retry_interval)
+
+    def subscribe(self):
+        # a stream without a keepalive for a few heartbeats is taken for a dead connection
+        connection = http.client.HTTPConnection(self.host, self.port, timeout=3 * self.heartbeat)
+        try:
+            headers = {"Accept": "text/event-stream"}
+            if self.seq is not None:
+                headers["Last-Event-ID"] = str(self.seq)
+            connection.request("GET", "/invalidations/stream", headers=headers)
+            response = connection.getresponse()
+            if response.status != 200:
+                raise ConnectionError(f"status {response.status}")
+            self.connects += 1
+            self.connected = True
+            event, data = None, []
+            while True:
+                line = response.readline()
+                if not line:
+                    raise ConnectionError("stream closed by the catalog")
+                line = line.decode('utf-8').rstrip("\r\n")
+                if not line:
+                    if data:
+                        self.on_event(event, json.loads("\n".join(data)))
+                    event, data = None, []
+                elif not line.startswith(":"):  # lines starting with a colon are keepalives
+                    field, _, value = line.partition(":")
+                    if field == "event":
+                        event = value.strip()
+                    elif field == "data":
+                        data.append(value[1:] if value.startswith(" ") else value)
+        finally:
+            connection.close()
+
+    def on_event(self, event, data):
+        if event == "hello":
+            if self.epoch is not None and data["epoch"] != self.epoch:
+                # the catalog may have come up with other products, or without changes it never streamed
+                self.restarts += 1
+                self.flush()
+            self.epoch = data["epoch"]
+            if self.seq is None:
+                self.seq = data["seq"]
+        elif event == "reset":
+            self.resets += 1
+            self.flush()
+            self.seq = data["seq"]
+        elif event == "invalidate":
+            if data["first_seq"] != self.seq + 1:
+                self.gaps += 1
+                self.flush()
+            self.apply_batch(data)
+            self.seq = data["seq"]
+            self.batches += 1
+
+    def flush(self):
+        print(f"Flushing the cached products of catalog shard {self.shard_id}")
+        self.apply_batch({"all": True, "shard": self.shard_id})
+
+    def stats(self):
+        return {"shard": self.shard_id, "connected": self.connected, "seq": self.seq, "connects": self.connects,
+                "batches": self.batches, "gaps": self.gaps, "resets": self.resets, "restarts": self.restarts,
+                "failures": self.failures}
@@ -0,0 +1,56 @@
+import json
+import os
+import zlib
+
+# JSON file listing the catalog shards, shared by the catalog, order and front-end services:
+# {"shards": [{"host": "localhost", "port": 12501, "replicas": [{"host": "localhost", "port": 12521}]},
+#             {"host": "localhost", "port": 12511}]}
+# Without it there is a single catalog at the service's CATALOG_HOST/CATALOG_PORT.
+CATALOG_SHARD_MAP = os.getenv('CATALOG_SHARD_MAP')
+# Read-only replicas of the single catalog when there is no shard map, as "host:port,host:port"
+CATALOG_REPLICAS = os.getenv('CATALOG_REPLICAS', '')
+
+
+def shard_index(product_name, shard_count):
+    """Shard owning a product. crc32 is stable across processes and restarts, unlike hash()."""
+    return zlib.crc32(product_name.encode('utf-8')) % shard_count
+
+
+class ShardMap:
+    """ Hash partitioning of product names over the catalog shards """
+    def __init__(self, shards):
+        self.shards = shards
+
+    @classmethod
+    def load(cls, default_host, default_port, path=CATALOG_SHARD_MAP):
+        if not path:
+            replicas = [{"host": host, "port": int(port)} for host, port in
+                        (replica.rsplit(":", 1) for replica in CATALOG_REPLICAS.split(",") if replica)]
+            return cls([{"host": default_host, "port": default_port, "replicas": replicas}])
+        with open(path, 'r') as file:
+            return cls(json.load(file)["shards"])
+
+    def __len__(self):
+        return len(self.shards)
+
+    def shard_id(self, product_name):
+        return shard_index(product_name, len(self.shards))
+
+    def url(self, shard_id):
+        shard = self.shards[shard_id]
+        return f"http://{shard['host']}:{shard['port']}"
+
+    def replica_urls(self, shard_id):
+        """Base URLs of the read-only replicas of a shard, possibly none."""
+        return [f"http://{replica['host']}:{replica['port']}" for replica in self.shards[shard_id].get("replicas", [])]
+
+    def url_for(self, product_name):
+        """Base URL of the catalog shard owning product_name."""
+        return self.url(self.shard_id(product_name))
+
+    def group_by_shard(self, product_names):
+        """{shard id: [product names owned by it]}, keeping the order of product_names."""
+        groups = {}
+        for product_name in product_names:
+            groups.setdefault(self.shard_id(product_name), []).append(product_name)
+        return groups
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """ Runs at most one call per key at a time. Threads asking for a key whose call is in flight wait for that
+    call and share its result, or its exception, instead of repeating it. """
+    def __init__(self):
+        self.lock = threading.Lock()  # guards calls and the counters
+        self.calls = {}  # key -> Call in flight
+        self.executions = 0
+        self.merged = 0  # callers that waited for another caller's call
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            if call is not None:
+                self.merged += 1
+                leader = False
+            else:
+                call = self.calls[key] = Call()
+                self.executions += 1
+                leader = True
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def in_flight(self, key):
+        with self.lock:
+            return key in self.calls
+
+    def forget(self, key=None):
+        """Let the next caller for key, or for every key, start a call of its own even if one is in flight,
+        e.g. because that call may return data older than an invalidation that just arrived."""
+        with self.lock:
+            if key is None:
+                self.calls.clear()
+            else:
+                self.calls.pop(key, None)
+
+    def stats(self):
+        with self.lock:
+            return {"executions": self.executions, "merged": self.merged, "in_flight": len(self.calls)}
+
+
+class AsyncSingleFlight:
+    """ SingleFlight for coroutines on one event loop: fn is a coroutine function, waiters await its result. """
+    def __init__(self):
+        self.calls = {}  # key -> asyncio.Future of the call in flight
+        self.executions = 0
+        self.merged = 0
+
+    async def do(self, key, fn):
+        future = self.calls.get(key)
+        if future is not None:
+            self.merged += 1
+            # one waiter being cancelled must not cancel the call for the others
+            return await asyncio.shield(future)
+        future = self.calls[key] = asyncio.get_running_loop().create_future()
+        self.executions += 1
+        try:
+            result = await fn()
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # retrieved, so an error nobody waited for is not logged as unhandled
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            if self.calls.get(key) is future:
+                del self.calls[key]
+
+    def in_flight(self, key):
+        return key in self.calls
+
+    def forget(self, key=None):
+        if key is None:
+            self.calls.clear()
+        else:
+            self.calls.pop(key, None)
+
+    def stats(self):
+        return {"executions": self.executions, "merged": self.merged, "in_flight": len(self.calls)}
@@ -0,0 +1,287 @@
+import asyncio
+import json
+import urllib.parse
+
+import front_end_service as fe
+from common.async_http import AsyncPooledClient, UpstreamError, json_response, serve
+from common.single_flight import AsyncSingleFlight
+
+# Front end on a single asyncio event loop, selected with FRONTEND_MODE=asyncio. It serves the same routes
+# with the same responses as the threaded FrontendHandler and shares its cache, shard map, catalog seqs and
+# order leader cache; only the request handling and the calls to the other services are non-blocking.
+
+# Keep-alive connections to the catalog and order services, used by the event loop only
+async_client = AsyncPooledClient()
+
+cache = fe.FrontendHandler.cache
+# cache misses in flight, by product name
+product_fetches = AsyncSingleFlight()
+refreshes = set()  # background refreshes of stale products
+# warm-up runs in its own thread with the blocking catalog client, the cache is thread-safe
+cache_warmer = fe.cache_warmer
+
+
+async def get_leader():
+    """The cached order leader. Finding a new one probes the replicas with blocking calls, so that runs in a thread."""
+    leader = fe.leader_cache.leader
+    if leader is not None:
+        return leader
+    return await asyncio.get_running_loop().run_in_executor(None, fe.leader_cache.get)
+
+
+async def catalog_get(shard_id, path, params=None):
+    """Non-blocking front_end_service.catalog_get: the next replica of a catalog shard if it is fresh enough,
+    otherwise the shard's primary."""
+    replica_urls = fe.CATALOG_SHARDS.replica_urls(shard_id)
+    if replica_urls:
+        replica_url = replica_urls[next(fe.replica_turns) % len(replica_urls)]
+        try:
+            response = await async_client.get(f"{replica_url}{path}", params=params)
+            replica_seq = int(response.headers.get('x-catalog-seq', -1))
+            if response.status_code in (200, 404) and replica_seq >= fe.catalog_seqs.get(shard_id, 0) - fe.CATALOG_REPLICA_MAX_LAG:
+                return response
+            print(f"***** REPLICA {replica_url} AT SEQ {replica_seq} IS STALE *****")
+        except UpstreamError as e:
+            print(f"Catalog replica {replica_url} failed: {e}")
+    response = await async_client.get(f"{fe.CATALOG_SHARDS.url(shard_id)}{path}", params=params)
+    fe.observe_catalog_seq(shard_id, int(response.headers.get('x-catalog-seq', 0)))
+    return response
+
+
+async def fetch_product(product_name):
+    """Fetch a product missing from the cache and cache it, or remember that the catalog does not know it.
+    Returns the catalog's status code and the product info."""
+    # an invalidation that arrives while the product is fetched turns away what the fetch returns
+    generation = cache.generation()
+    response = await catalog_get(fe.CATALOG_SHARDS.shard_id(product_name), f"/{product_name}")
+    if response.status_code == 404:
+        cache.discard(product_name)  # a stale entry of a product that is gone
+        fe.unknown_products.put(product_name, True, generation)
+    if response.status_code != 200:
+        return response.status_code, None
+    # the catalog's bytes become the response body as they are, decoding is only needed to index the product
+    product_info = fe.CachedProduct(response.json(), response.content)
+    cache.put(product_name, product_info, generation)
+    return 200, product_info
+
+
+async def refresh(product_name):
+    try:
+        await product_fetches.do(product_name, lambda: fetch_product(product_name))
+    except Exception as e:
+        print(f"Refreshing {product_name} failed: {e}")
+
+
+def refresh_product(product_name):
+    """Fetch a stale product again in the background, unless a fetch of it is already in flight."""
+    if not product_fetches.in_flight(product_name):
+        task = asyncio.create_task(refresh(product_name))
+        # the loop only keeps weak references to tasks
+        refreshes.add(task)
+        task.add_done_callback(refreshes.discard)
+
+
+def invalidate_product(product_name, version=None):
+    cache.invalidate(product_name, version)
+    fe.unknown_products.discard(product_name)  # a product that changed exists
+    # a fetch already in flight may return the product as it was before this change, later misses fetch it anew
+    product_fetches.forget(product_name)
+
+
+async def handle(request):
+    if request.method == "GET":
+        return await handle_get(request)
+    if request.method == "POST":
+        return await handle_post(request)
+    return json_response(501, {"error": {"code": 501, "message": f"Unsupported method {request.method}"}})
+
+
+async def handle_get(request):
+    if request.path == "/stats/http":
+        return json_response(200, async_client.stats())
+    if request.path == "/cache/stats":
+        return json_response(200, dict(cache.stats(), negative=fe.unknown_products.stats(), orders=fe.orders.stats(),
+                                   single_flight=product_fetches.stats(), warmup=cache_warmer.stats(),
+                                   invalidation_stream=[subscriber.stats() for subscriber in fe.invalidation_subscribers]))
+    if request.path in ("/products", "/products/"):
+        return await handle_bulk_query(request)
+    if request.path.startswith("/products/"):
+        product_name = request.path.split("/")[-1]
+        # ?consistency=strict never gets a product invalidated since it was cached, e.g. to check its quantity
+        strict = urllib.parse.parse_qs(request.query).get("consistency") == ["strict"]
+        product_info, stale = cache.get_or_stale(product_name, allow_stale=not strict)
+        if product_info:
+            if stale:
+                refresh_product(product_name)
+            return 200, product_info.body, "application/json"
+        if fe.unknown_products.get(product_name):
+            return json_response(404, {"error": {"code": 404, "message": "product not found"}})
+        # concurrent misses for the same product share a single catalog request
+        status_code, product_info = await product_fetches.do(product_name, lambda: fetch_product(product_name))
+        if status_code == 200:
+            return 200, product_info.body, "application/json"
+        if status_code == 404:
+            return json_response(404, {"error": {"code": 404, "message": "product not found"}})
+        return json_response(400, {"error": {"code": 400, "message": "bad request"}})
+    if request.path.startswith("/orders/"):
+        order_number = request.path.split("/")[-1]
+        body = fe.orders.get(order_number)
+        if body is not None:
+            return 200, body, "application/json"
+        order_info = None
+        # a lookup is safe to repeat, so an unreachable or deposed leader is replaced and asked again once
+        for attempt in range(2):
+            leader = await get_leader()
+            if leader is None:
+                break
+            try:
+                order_info = await async_client.get(f"http://{leader['host']}:{leader['port']}/orders/{order_number}")
+            except UpstreamError:
+                fe.leader_cache.invalidate(leader)
+                continue
+            if order_info.status_code != 403:
+                break
+            fe.leader_cache.invalidate(leader)
+            order_info = None
+        if order_info is None:
+            return json_response(503, {"error": {"code": 503, "message": "Order service unavailable. No leader found."}})
+        if order_info.status_code == 200:
+            body = fe.order_body(order_info.json())
+            fe.orders.put(order_number, body)
+            return 200, body, "application/json"
+        if order_info.status_code == 404:
+            return json_response(404, {"error": {"code": 404, "message": "Order not found"}})
+        return json_response(400, {"error": {"code": 400, "message": "Bad request"}})
+    return 404, b"", "text/plain"
+
+
+async def handle_bulk_query(request):
+    """Serve cached products from the cache and fetch the misses from all their catalog shards at once."""
+    query = urllib.parse.parse_qs(request.query)
+    try:
+        if "names" in query:
+            product_names = list(dict.fromkeys(name for name in ",".join(query["names"]).split(",") if name))
+            found = {}
+            for product_name in product_names:
+                product_info = cache.get(product_name)
+                if product_info:
+                    found[product_name] = product_info
+            misses = [product_name for product_name in product_names if product_name not in found]
+            generation = cache.generation()
+            shard_misses = fe.CATALOG_SHARDS.group_by_shard(misses)
+            responses = await asyncio.gather(*(catalog_get(shard_id, "/products", params={"names": ",".join(names)})
+                                               for shard_id, names in shard_misses.items()))
+            for response in responses:
+                response.raise_for_status()
+                for product_info in response.json()["products"]:
+                    product_info = fe.CachedProduct(product_info)
+                    cache.put(product_info["name"], product_info, generation)
+                    found[product_info["name"]] = product_info
+            response_data = {"data": [found[name] for name in product_names if name in found],
+                             "not_found": [name for name in product_names if name not in found]}
+        else:
+            responses = await asyncio.gather(*(catalog_get(shard_id, "/products") for shard_id in range(len(fe.CATALOG_SHARDS))))
+            response_data = {"data": [], "not_found": []}
+            for response in responses:
+                response.raise_for_status()
+                response_data["data"].extend(response.json()["products"])
+        return json_response(200, response_data)
+    except (UpstreamError, KeyError, ValueError):
+        return json_response(400, {"error": {"code": 400, "message": "bad request"}})
+
+
+async def handle_post(request):
+    if request.path.startswith("/orders/"):
+        return await handle_order(request)
+    if request.path.startswith("/invalidate/"):
+        product_name = request.path.split("/")[-1]
+        if not product_name:
+            return handle_invalidation_batch(request)
+        invalidate_product(product_name)
+        return json_response(200, {"data": f"Cache successfully invalidated for {product_name}"})
+    return 404, b"", "text/plain"
+
+
+async def handle_order(request):
+    try:
+        order_data = request.json()
+        # a bare list of line items is a multi-item order, bought atomically by the catalog
+        if isinstance(order_data, list):
+            order_data = {"items": order_data}
+        order_info = None
+        # a replica that answers 403 is not the leader and placed nothing, the order goes to the new leader once
+        for attempt in range(2):
+            leader = await get_leader()
+            if leader is None:
+                break
+            order_data['leader'] = leader
+            try:
+                order_info = await async_client.post(f"http://{leader['host']}:{leader['port']}/orders", json=order_data)
+            except UpstreamError:
+                # the order may have reached the leader, so it is not sent again
+                fe.leader_cache.invalidate(leader)
+                break
+            if order_info.status_code != 403:
+                break
+            fe.leader_cache.invalidate(leader)
+            order_info = None
+        if order_info is None:
+            return json_response(503, {"error": {"code": 503, "message": "Service unavailable. No leader found."}})
+        if order_info.status_code == 200:
+            order_response = order_info.json()
+            fe.cache_bought_products(cache, order_response.pop("products", []))
+            order = order_response.pop("order", None)
+            if order is not None:
+                fe.orders.put(order["number"], fe.order_body({"data": order}))
+            return json_response(200, {"data": order_response})
+        if order_info.status_code in (400, 409):
+            # the order service explains rejections other than stock, e.g. items spanning catalog shards
+            message = order_info.json().get("error", {}).get("message") if order_info.content else None
+            return json_response(order_info.status_code,
+                                 {"error": {"code": order_info.status_code, "message": message or "product is out of stock"}})
+        return json_response(404, {"error": {"code": 404, "message": "bad request/product name not found"}})
+    except Exception:
+        return json_response(404, {"error": {"code": 404, "message": "Bad Request"}})
+
+
+def handle_invalidation_batch(request):
+    """Handle a batch of invalidations POSTed by the catalog, see apply_invalidation_batch."""
+    try:
+        apply_invalidation_batch(request.json())
+        return json_response(200, {"data": "Cache successfully invalidated"})
+    except Exception as e:
+        return json_response(400, {"error": {"code": 400, "message": f"Invalid invalidation batch: {str(e)}"}})
+
+
+def apply_invalidation_batch(batch):
+    """front_end_service.apply_invalidation_batch for this module's cache and single flight. Runs on the loop."""
+    if "seq" in batch:
+        fe.observe_catalog_seq(batch.get("shard", 0), batch["seq"])
+    if batch.get("all"):
+        fe.flush_products(cache, batch.get("shard"))
+        product_fetches.forget()
+    names = batch.get("names", [])
+    for product_name, version in zip(names, batch.get("versions") or [None] * len(names)):
+        invalidate_product(product_name, version)
+
+
+async def serve_front_end():
+    loop = asyncio.get_running_loop()
+    # subscribers read their streams on threads of their own, the batches are applied on the loop in stream order
+    fe.start_invalidation_subscribers(lambda batch: loop.call_soon_threadsafe(apply_invalidation_batch, batch))
+    await serve(handle, fe.FRONTEND_HOST, fe.FRONT_END_PORT)
+
+
+def start_async_front_end():
+    fe.leader_cache.start()
+    fe.stop_on_sigterm()
+    cache_warmer.start()
+    print(f'Starting asyncio front-end server on {fe.FRONTEND_HOST}:{fe.FRONT_END_PORT}...')
+    try:
+        asyncio.run(serve_front_end())
+    finally:
+        cache_warmer.save_snapshot()
+
+
+if __name__ == "__main__":
+    start_async_front_end()
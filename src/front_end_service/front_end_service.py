@@ -1,16 +1,43 @@
 import json
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import ThreadingHTTPServer
 import urllib.parse
 import threading
 import requests
 import os
-from collections import OrderedDict
+import sys
+import itertools
+import signal
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.shard_map import ShardMap
+from common.http_client import PooledClient
+from common.http_server import KeepAliveHandler
+from common.invalidation_subscriber import InvalidationSubscriber
+from common.single_flight import SingleFlight
+from product_cache import CacheWarmer, CachedProduct, new_cache, new_negative_cache, new_order_cache
 
 #initializing front_end_service host and port
 FRONT_END_PORT = int(os.getenv('FRONTEND_LISTENING_PORT',12503))
 CATALOG_PORT = int(os.getenv('CATALOG_PORT',12501))
 FRONTEND_HOST = os.getenv('FRONTEND_HOST', 'localhost')
 CATALOG_HOST = os.getenv('CATALOG_HOST', 'localhost')
+# Catalog shard owning each product, a single catalog at CATALOG_HOST:CATALOG_PORT unless CATALOG_SHARD_MAP is set
+CATALOG_SHARDS = ShardMap.load(CATALOG_HOST, CATALOG_PORT)
+# A read-only catalog replica may answer a cache miss once it has applied every change up to
+# CATALOG_REPLICA_MAX_LAG seqs before the latest catalog seq this front end has heard of
+CATALOG_REPLICA_MAX_LAG = int(os.getenv('CATALOG_REPLICA_MAX_LAG', 0))
+# "threaded": a thread per connection (ThreadingHTTPServer), "asyncio": every connection on one event loop
+FRONTEND_MODE = os.getenv('FRONTEND_MODE', 'threaded')
+# "stream": subscribe to every catalog shard's invalidation stream, "post": wait for the catalog to POST invalidations
+INVALIDATION_MODE = os.getenv('INVALIDATION_MODE', 'stream')
+
+# Seconds between the failure detector's leader checks, and per health probe
+LEADER_CHECK_INTERVAL = float(os.getenv('LEADER_CHECK_INTERVAL', 1))
+LEADER_PROBE_TIMEOUT = float(os.getenv('LEADER_PROBE_TIMEOUT', 2))
+
+# Keep-alive connections to the catalog and order services, shared by all handler threads
+http_client = PooledClient()
 
 # Configuration of Order Service Replicas
 ORDER_REPLICAS = {
@@ -24,7 +51,7 @@ def notify_replica(replica, leader_info, leader_id):
     url = f"http://{replica['host']}:{replica['port']}/notify_leader_info_to_replica"
     data = {"leader": leader_info, "leader_id": leader_id}
     try:
-        response = requests.post(url, json=data, timeout=20)
+        response = http_client.post(url, json=data)
         response_data = response.json()
         if response.status_code == 200:
             print(f"Successfully notified {url}. Leader ID: {leader_id} accepted. {response_data}")
@@ -53,88 +80,285 @@ def notify_replicas_of_leader(leader_info, replicas, leader_id):
     for thread in threads:
         thread.join()  # Wait for all threads to complete
 
+class LeaderCache:
+    """ The order leader, kept between requests. A background failure detector probes the replicas and
+    replaces the leader when it stops answering or a replica with a higher ID comes back; requests that
+    cannot reach the leader drop it so the next one finds a new leader right away. """
+    def __init__(self, replicas, check_interval=LEADER_CHECK_INTERVAL, probe_timeout=LEADER_PROBE_TIMEOUT):
+        self.replicas = replicas
+        self.check_interval = check_interval
+        self.probe_timeout = probe_timeout
+        self.leader = None
+        self.leader_id = None  # the leader replicas were last notified of
+        self.lock = threading.Lock()  # guards leader and leader_id
+        self.refresh_lock = threading.Lock()  # one probe round at a time
+        # the latest leader still to be announced to the replicas, sent by the notifier thread so that
+        # requests waiting for a probe round never wait for the notifications too
+        self.announcement = None
+        self.announcement_ready = threading.Condition()
+
+    def get(self):
+        """The cached leader, found first if there is none. None if no replica is healthy."""
+        leader = self.leader
+        if leader is not None:
+            return leader
+        with self.refresh_lock:
+            # another request may have found the leader while this one waited
+            if self.leader is not None:
+                return self.leader
+            return self.probe()
+
+    def invalidate(self, leader):
+        """Forget leader after a connection error or a "not leader" reply, unless it was already replaced."""
+        with self.lock:
+            if self.leader is leader:
+                print(f"Dropping order leader {leader['host']}:{leader['port']}")
+                self.leader = None
+
+    def probe(self):
+        """Make the highest-ID healthy replica the leader. Replicas are notified only when the leader changes.
+        Caller must hold refresh_lock."""
+        leader_id, leader = None, None
+        for replica_id in sorted(self.replicas.keys(), reverse=True):
+            replica = self.replicas[replica_id]
+            try:
+                if http_client.get(f"http://{replica['host']}:{replica['port']}/health", timeout=self.probe_timeout).status_code == 200:
+                    leader_id, leader = replica_id, replica
+                    break
+            except requests.RequestException:
+                print(f"Failed to connect to Order Service {replica_id} at {replica['host']}:{replica['port']}")
+        if leader is not None and leader_id != self.leader_id:
+            print(f"Leader found: Order Service {leader_id}.")
+            # Notify other replicas about the leader and send the leader's replica ID
+            with self.announcement_ready:
+                self.announcement = (leader, leader_id)
+                self.announcement_ready.notify()
+        with self.lock:
+            self.leader = leader
+            if leader is not None:
+                self.leader_id = leader_id
+        return leader
+
+    def start(self):
+        threading.Thread(target=self.monitor, daemon=True).start()
+        threading.Thread(target=self.announce, daemon=True).start()
+
+    def announce(self):
+        """Notifier: send each new leader to the replicas, in order, skipping leaders already replaced."""
+        while True:
+            with self.announcement_ready:
+                while self.announcement is None:
+                    self.announcement_ready.wait()
+                leader, leader_id = self.announcement
+                self.announcement = None
+            notify_replicas_of_leader(leader, self.replicas.values(), leader_id)
+
+    def monitor(self):
+        """Failure detector: re-probe every check_interval seconds, off the request path."""
+        while True:
+            time.sleep(self.check_interval)
+            with self.refresh_lock:
+                self.probe()
+
+leader_cache = LeaderCache(ORDER_REPLICAS)
+
 def get_leader():
-    """ Find the leader, notify others, and include the leader ID. """
-    for replica_id in sorted(ORDER_REPLICAS.keys(), reverse=True):
-        replica = ORDER_REPLICAS[replica_id]
+    """ The current order leader from the leader cache, None if there is none. """
+    return leader_cache.get()
+
+# shard id -> highest catalog seq seen in an invalidation batch or a primary's response
+catalog_seqs = {}
+catalog_seqs_lock = threading.Lock()
+replica_turns = itertools.count()  # round robin over a shard's replicas
+
+def observe_catalog_seq(shard_id, seq):
+    with catalog_seqs_lock:
+        if seq > catalog_seqs.get(shard_id, 0):
+            catalog_seqs[shard_id] = seq
+
+def catalog_get(shard_id, path, params=None):
+    """GET path from the next replica of a catalog shard, or from the shard's primary when it has no replicas
+    or the replica is unreachable or further behind than CATALOG_REPLICA_MAX_LAG."""
+    replica_urls = CATALOG_SHARDS.replica_urls(shard_id)
+    if replica_urls:
+        replica_url = replica_urls[next(replica_turns) % len(replica_urls)]
         try:
-            response = requests.get(f"http://{replica['host']}:{replica['port']}/health", timeout=20)
-            response_data = response.json()
-            if response.status_code == 200:
-                
-                print(f"Leader found: Order Service {replica_id}. {response_data}")
-                # Notify other replicas about the leader and send the leader's replica ID
-                notify_replicas_of_leader(replica, ORDER_REPLICAS.values(), replica_id)
-                return replica
-        except requests.ConnectionError:
-            print(f"Failed to connect to Order Service {replica_id} at {replica['host']}:{replica['port']}")
-    return None
-
-class LRUCache:
-    """ LRU Cache to hold the product data with thread-safe operations """
-    def __init__(self, capacity=5):
-        self.cache = OrderedDict()
-        self.capacity = capacity
-        self.lock = threading.Lock()  # Add a lock for thread safety
-
-    def get(self, key):
-        with self.lock:  # Use the lock when accessing the cache
-            if key not in self.cache:
-                return None
-            else:
-                self.cache.move_to_end(key)  # Mark as recently used
-                return self.cache[key]
-
-    def put(self, key, value):
-        with self.lock:  # Use the lock when modifying the cache
-            if key in self.cache:
-                self.cache.move_to_end(key)
-            self.cache[key] = value
-            if len(self.cache) > self.capacity:
-                self.cache.popitem(last=False)  # Remove least recently used item
-
-    def invalidate(self, key):
-        with self.lock:  # Use the lock when modifying the cache
-            if key in self.cache:
-                del self.cache[key]
-                print(f"Cache successfully invalidated for {key}")
-            else:
-                print(f"No cache entry found for {key} to invalidate.")
+            response = http_client.get(f"{replica_url}{path}", params=params)
+            replica_seq = int(response.headers.get('X-Catalog-Seq', -1))
+            if response.status_code in (200, 404) and replica_seq >= catalog_seqs.get(shard_id, 0) - CATALOG_REPLICA_MAX_LAG:
+                return response
+            print(f"***** REPLICA {replica_url} AT SEQ {replica_seq} IS STALE *****")
+        except requests.RequestException as e:
+            print(f"Catalog replica {replica_url} failed: {e}")
+    response = http_client.get(f"{CATALOG_SHARDS.url(shard_id)}{path}", params=params)
+    observe_catalog_seq(shard_id, int(response.headers.get('X-Catalog-Seq', 0)))
+    return response
 
-class FrontendHandler(BaseHTTPRequestHandler):
+def fetch_products(product_names):
+    """Product info of the named products the catalog knows, with a single request per catalog shard."""
+    products = []
+    for shard_id, shard_names in CATALOG_SHARDS.group_by_shard(product_names).items():
+        response = catalog_get(shard_id, "/products", params={"names": ",".join(shard_names)})
+        response.raise_for_status()
+        products.extend(response.json()["products"])
+    return products
+
+def list_products():
+    """Product info of every product in every catalog shard."""
+    products = []
+    for shard_id in range(len(CATALOG_SHARDS)):
+        response = catalog_get(shard_id, "/products")
+        response.raise_for_status()
+        products.extend(response.json()["products"])
+    return products
+
+def cache_bought_products(cache, products):
+    """Store the new quantity and version of products returned by a buy instead of waiting for a cache miss.
+    A product is skipped when this front end has already seen a later change in its shard, whose invalidation
+    may have arrived before this response."""
+    for product in products:
+        shard_id = CATALOG_SHARDS.shard_id(product["name"])
+        # hold the lock so an invalidation cannot slip in between the check and the put
+        with catalog_seqs_lock:
+            if product["version"] >= catalog_seqs.get(shard_id, 0):
+                cache.put(product["name"], CachedProduct(product))
+
+# cache misses in flight, by product name
+product_fetches = SingleFlight()
+
+# product names the catalog answered with a 404, so repeated lookups of unknown names stay off the catalog
+unknown_products = new_negative_cache()
+
+# GET /orders/<n> response bodies by order number, from order lookups and from the responses of placed orders
+orders = new_order_cache()
+
+def order_body(order_info):
+    """The GET /orders/<n> response body for the order service's answer {"data": order}."""
+    return json.dumps({"data": order_info}).encode('utf-8')
+
+def fetch_product(cache, product_name):
+    """Fetch a product missing from the cache and cache it, or remember that the catalog does not know it.
+    Returns the catalog's status code and the product info."""
+    # an invalidation that arrives while the product is fetched turns away what the fetch returns
+    generation = cache.generation()
+    response = catalog_get(CATALOG_SHARDS.shard_id(product_name), f"/{product_name}")
+    if response.status_code == 404:
+        cache.discard(product_name)  # a stale entry of a product that is gone
+        unknown_products.put(product_name, True, generation)
+    if response.status_code != 200:
+        return response.status_code, None
+    # the catalog's bytes become the response body as they are, decoding is only needed to index the product
+    product_info = CachedProduct(response.json(), response.content)
+    cache.put(product_name, product_info, generation)
+    return 200, product_info
+
+def refresh_product(cache, product_name):
+    """Fetch a stale product again in the background, unless a fetch of it is already in flight."""
+    if product_fetches.in_flight(product_name):
+        return
+    def refresh():
+        try:
+            product_fetches.do(product_name, lambda: fetch_product(cache, product_name))
+        except Exception as e:
+            print(f"Refreshing {product_name} failed: {e}")
+    threading.Thread(target=refresh, daemon=True).start()
+
+def invalidate_product(cache, product_name, version=None):
+    cache.invalidate(product_name, version)
+    unknown_products.discard(product_name)  # a product that changed exists
+    # a fetch already in flight may return the product as it was before this change, later misses fetch it anew
+    product_fetches.forget(product_name)
+
+def flush_products(cache, shard_id=None):
+    """Drop the cached products owned by a catalog shard, or every cached product, found and unknown alike."""
+    for entries in (cache, unknown_products):
+        if shard_id is None or len(CATALOG_SHARDS) == 1:
+            entries.clear()
+            continue
+        # fetches in flight may predate a missed invalidation of a product that is not cached
+        entries.fence_fetches()
+        for product_name in entries.keys():
+            if CATALOG_SHARDS.shard_id(product_name) == shard_id:
+                entries.discard(product_name)
+
+def apply_invalidation_batch(cache, batch):
+    """Apply a batch of invalidations from a catalog shard, posted or streamed: {"names": [...], "versions": [...]}
+    or {"all": true}, which flushes the shard's products, or every product when no shard is given.
+    The shard's seq makes later cache misses skip replicas that have not caught up with it."""
+    if "seq" in batch:
+        observe_catalog_seq(batch.get("shard", 0), batch["seq"])
+    if batch.get("all"):
+        flush_products(cache, batch.get("shard"))
+        product_fetches.forget()
+    names = batch.get("names", [])
+    for product_name, version in zip(names, batch.get("versions") or [None] * len(names)):
+        invalidate_product(cache, product_name, version)
+
+def new_invalidation_subscriber(shard_id):
+    catalog_url = urllib.parse.urlsplit(CATALOG_SHARDS.url(shard_id))
+    return InvalidationSubscriber(shard_id, catalog_url.hostname, catalog_url.port)
+
+invalidation_subscribers = [new_invalidation_subscriber(shard_id) for shard_id in range(len(CATALOG_SHARDS))]
+
+def start_invalidation_subscribers(apply_batch):
+    if INVALIDATION_MODE == "stream":
+        for subscriber in invalidation_subscribers:
+            subscriber.start(apply_batch)
+
+class FrontendHandler(KeepAliveHandler):
     #method to handle all get requests from client. requests forwarded to catalog service
 
-    cache = LRUCache()  # Initialize the cache
+    cache = new_cache()  # policy, capacity and ttl from CACHE_POLICY, CACHE_CAPACITY and CACHE_TTL
 
     def do_GET(self):
         print(f"Thread ID {threading.get_ident()} handling request from {self.client_address}")
         parsed_path = urllib.parse.urlparse(self.path)
 
+        if parsed_path.path == "/stats/http":
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(http_client.stats()).encode('utf-8'))
+            return
+        if parsed_path.path == "/cache/stats":
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            stats = dict(self.cache.stats(), negative=unknown_products.stats(), orders=orders.stats(), single_flight=product_fetches.stats(),
+                         warmup=cache_warmer.stats(), invalidation_stream=[subscriber.stats() for subscriber in invalidation_subscribers])
+            self.wfile.write(json.dumps(stats).encode('utf-8'))
+            return
+        #if bulk query: /products?names=a,b,c or the full listing
+        if parsed_path.path in ("/products", "/products/"):
+            return self.handle_bulk_query(parsed_path)
         #if query product
         if parsed_path.path.startswith("/products/"):
             product_name = parsed_path.path.split("/")[-1]
-            product_info = self.cache.get(product_name)  # Try to get product info from cache
+            # ?consistency=strict never gets a product invalidated since it was cached, e.g. to check its quantity
+            strict = urllib.parse.parse_qs(parsed_path.query).get("consistency") == ["strict"]
+            product_info, stale = self.cache.get_or_stale(product_name, allow_stale=not strict)  # Try to get product info from cache
             if product_info:
-                # Cache hit
-                print("***** CACHE HIT *****")
-                self.send_response(200)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                self.wfile.write(json.dumps({"data": product_info}).encode('utf-8'))
+                if stale:
+                    # serve the invalidated entry now, one background fetch brings the new one
+                    print("***** STALE CACHE HIT *****")
+                    refresh_product(self.cache, product_name)
+                else:
+                    # Cache hit
+                    print("***** CACHE HIT *****")
+                self.send_cached_product(product_info)
             else:
-                # Cache miss
-                print("***** CACHE MISS *****")
-                request = requests.get(f"http://{CATALOG_HOST}:{CATALOG_PORT}/{product_name}", timeout=20)
+                if unknown_products.get(product_name):
+                    print("***** NEGATIVE CACHE HIT *****")
+                    status_code = 404
+                else:
+                    # Cache miss
+                    print("***** CACHE MISS *****")
+                    # concurrent misses for the same product share a single catalog request
+                    status_code, product_info = product_fetches.do(product_name, lambda: fetch_product(self.cache, product_name))
                 #return catalog response to client.
-                if request.status_code==200:   #sends product info in data label if query was successful
-                    product_info = request.json()
-                    # Store to cache
-                    self.cache.put(product_name, product_info)
-                    self.send_response(200)
-                    self.send_header("Content-type", "application/json")
-                    self.end_headers()
-                    self.wfile.write(json.dumps({"data": product_info}).encode('utf-8')) 
-                elif request.status_code==404: #sends error code in error label with corresponding message
+                if status_code==200:   #sends product info in data label if query was successful
+                    self.send_cached_product(product_info)
+                elif status_code==404: #sends error code in error label with corresponding message
                     self.send_response(404)
                     self.send_header("Content-type", "application/json")
                     self.end_headers()
@@ -148,22 +372,44 @@ class FrontendHandler(BaseHTTPRequestHandler):
                     self.wfile.write(json.dumps(error_message).encode('utf-8'))
         #else if query order info
         elif parsed_path.path.startswith("/orders/"):
-            leader = get_leader()
-            if leader is None:
+            order_number = parsed_path.path.split("/")[-1]
+            body = orders.get(order_number)
+            if body is not None:
+                self.send_response(200)
+                self.send_header("Content-type", "application/json")
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            order_info = None
+            # a lookup is safe to repeat, so an unreachable or deposed leader is replaced and asked again once
+            for attempt in range(2):
+                leader = get_leader()
+                if leader is None:
+                    break
+                try:
+                    order_info = http_client.get(f"http://{leader['host']}:{leader['port']}/orders/{order_number}")
+                except requests.ConnectionError:
+                    leader_cache.invalidate(leader)
+                    continue
+                if order_info.status_code != 403:
+                    break
+                leader_cache.invalidate(leader)
+                order_info = None
+            if order_info is None:
                 self.send_response(503)
                 self.send_header("Content-type", "application/json")
                 self.end_headers()
                 error_message = {"error": {"code": 503, "message": "Order service unavailable. No leader found."}}
                 self.wfile.write(json.dumps(error_message).encode())
                 return
-            order_number = parsed_path.path.split("/")[-1]
-            order_info = requests.get(f"http://{leader['host']}:{leader['port']}/orders/{order_number}", timeout=20)
             #return order response
             if order_info.status_code == 200:
+                body = order_body(order_info.json())
+                orders.put(order_number, body)
                 self.send_response(200)
                 self.send_header("Content-type", "application/json")
                 self.end_headers()
-                self.wfile.write(json.dumps({"data": order_info.json()}).encode('utf-8'))
+                self.wfile.write(body)
             elif order_info.status_code == 404:
                 self.send_response(404)
                 self.send_header("Content-type", "application/json")
@@ -177,34 +423,97 @@ class FrontendHandler(BaseHTTPRequestHandler):
                 error_message = {"error": {"code": 400, "message": "Bad request"}}
                 self.wfile.write(json.dumps(error_message).encode('utf-8'))
 
+    def send_cached_product(self, product_info):
+        """Send a cached product's response, serialized when it was cached, in a single write."""
+        self.wfile.write(product_info.response)
+        self.log_request(200, len(product_info.body))
+
+    def handle_bulk_query(self, parsed_path):
+        """Serve cached products from the cache and fetch the misses with a single request per catalog shard."""
+        query = urllib.parse.parse_qs(parsed_path.query)
+        try:
+            if "names" in query:
+                product_names = list(dict.fromkeys(name for name in ",".join(query["names"]).split(",") if name))
+                found = {}
+                for product_name in product_names:
+                    product_info = self.cache.get(product_name)
+                    if product_info:
+                        found[product_name] = product_info
+                misses = [product_name for product_name in product_names if product_name not in found]
+                generation = self.cache.generation()
+                print(f"***** BULK QUERY: {len(found)} CACHE HITS, {len(misses)} CACHE MISSES *****")
+                for product_info in fetch_products(misses):
+                    product_info = CachedProduct(product_info)
+                    self.cache.put(product_info["name"], product_info, generation)
+                    found[product_info["name"]] = product_info
+                response_data = {"data": [found[name] for name in product_names if name in found],
+                                 "not_found": [name for name in product_names if name not in found]}
+            else:
+                # the full listing always comes from the catalog shards, it would only churn a cache smaller than the catalog
+                response_data = {"data": list_products(), "not_found": []}
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(response_data).encode('utf-8'))
+        except (requests.RequestException, KeyError, ValueError):
+            self.send_response(400)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            error_message = {"error": {"code": 400, "message": "bad request"}}
+            self.wfile.write(json.dumps(error_message).encode('utf-8'))
+
     #method to handle all post requests from client. requests forwarded to order service
     def do_POST(self):
         print(f"Thread ID {(threading.get_ident())} handling request from {self.client_address}")
         parsed_path = urllib.parse.urlparse(self.path)
         #place orders, forward to order service
         if parsed_path.path.startswith("/orders/"):
-            leader = get_leader()
-            if leader is None:
-                self.send_response(503)
-                self.send_header("Content-type", "application/json")
-                self.end_headers()
-                error_message = {"error": {"code": 503, "message": "Service unavailable. No leader found."}}
-                self.wfile.write(json.dumps(error_message).encode())
-                return
             order_data = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8'))
-            order_data['leader'] = leader
+            # a bare list of line items is a multi-item order, bought atomically by the catalog
+            if isinstance(order_data, list):
+                order_data = {"items": order_data}
             try:
-                order_info = requests.post(f"http://{leader['host']}:{leader['port']}/orders", json=order_data)
+                order_info = None
+                # a replica that answers 403 is not the leader and placed nothing, the order goes to the new leader once
+                for attempt in range(2):
+                    leader = get_leader()
+                    if leader is None:
+                        break
+                    order_data['leader'] = leader
+                    try:
+                        order_info = http_client.post(f"http://{leader['host']}:{leader['port']}/orders", json=order_data)
+                    except requests.ConnectionError:
+                        # the order may have reached the leader, so it is not sent again
+                        leader_cache.invalidate(leader)
+                        break
+                    if order_info.status_code != 403:
+                        break
+                    leader_cache.invalidate(leader)
+                    order_info = None
+                if order_info is None:
+                    self.send_response(503)
+                    self.send_header("Content-type", "application/json")
+                    self.end_headers()
+                    error_message = {"error": {"code": 503, "message": "Service unavailable. No leader found."}}
+                    self.wfile.write(json.dumps(error_message).encode())
+                    return
                 if order_info.status_code==200: #sends order info in data label if query was successful
+                    order_response = order_info.json()
+                    cache_bought_products(self.cache, order_response.pop("products", []))
+                    order = order_response.pop("order", None)
+                    if order is not None:
+                        orders.put(order["number"], order_body({"data": order}))
                     self.send_response(200)
                     self.send_header("Content-type", "application/json")
                     self.end_headers()
-                    self.wfile.write(json.dumps({"data": order_info.json()}).encode('utf-8'))
-                elif order_info.status_code==400:   #sends error code in error label with corresponding message
+                    self.wfile.write(json.dumps({"data": order_response}).encode('utf-8'))
+                elif order_info.status_code in (400, 409):   #sends error code in error label with corresponding message
                     self.send_response(order_info.status_code)
                     self.send_header("Content-type", "application/json")
                     self.end_headers()
-                    error_message = {"error": {"code": 400, "message": "product is out of stock"}}
+                    # the order service explains rejections other than stock, e.g. items spanning catalog shards
+                    message = order_info.json().get("error", {}).get("message") if order_info.content else None
+                    error_message = {"error": {"code": order_info.status_code, "message": message or "product is out of stock"}}
                     self.wfile.write(json.dumps(error_message).encode('utf-8'))
                 else:
                     self.send_response(404)
@@ -222,8 +531,10 @@ class FrontendHandler(BaseHTTPRequestHandler):
         # handle invalidate requests
         elif parsed_path.path.startswith("/invalidate/"):
             product_name = parsed_path.path.split("/")[-1]
+            if not product_name:
+                return self.handle_invalidation_batch()
             try:
-                self.cache.invalidate(product_name)
+                invalidate_product(self.cache, product_name)
                 self.send_response(200)
                 self.send_header("Content-type", "application/json")
                 self.end_headers()
@@ -242,7 +553,54 @@ class FrontendHandler(BaseHTTPRequestHandler):
                 error_message = json.dumps({"error": {"code": 500, "message": f"An error occurred while invalidating the cache for {product_name}: {str(e)}"}})
                 self.wfile.write(error_message.encode('utf-8'))
 
+    def handle_invalidation_batch(self):
+        """Handle a batch of invalidations POSTed by the catalog, see apply_invalidation_batch."""
+        try:
+            apply_invalidation_batch(self.cache, json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8')))
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps({"data": "Cache successfully invalidated"}).encode('utf-8'))
+        except Exception as e:
+            self.send_response(400)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            error_message = json.dumps({"error": {"code": 400, "message": f"Invalid invalidation batch: {str(e)}"}})
+            self.wfile.write(error_message.encode('utf-8'))
+
+
+# fills FrontendHandler.cache after startup and snapshots its hottest keys
+cache_warmer = CacheWarmer(FrontendHandler.cache, fetch_products, list_products)
+
+def stop_on_sigterm():
+    """Turn SIGTERM into a normal exit, so shutdown steps in finally blocks run."""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+class FrontendServer(ThreadingHTTPServer):
+    # socketserver's default listen backlog of 5 drops connections when many clients connect at once
+    request_queue_size = 1024
+
+
+def start_front_end_service():
+    leader_cache.start()
+    stop_on_sigterm()
+    frontend_server = FrontendServer((FRONTEND_HOST, FRONT_END_PORT), FrontendHandler)
+    start_invalidation_subscribers(lambda batch: apply_invalidation_batch(FrontendHandler.cache, batch))
+    # the cache warms up in the background, requests are served from the start
+    cache_warmer.start()
+    print(f'Starting front-end server on {FRONTEND_HOST}:{FRONT_END_PORT}...')
+    try:
+        frontend_server.serve_forever()
+    finally:
+        cache_warmer.save_snapshot()
+
 
-frontend_server = ThreadingHTTPServer((FRONTEND_HOST, FRONT_END_PORT), FrontendHandler)
-print(f'Starting front-end server on {FRONTEND_HOST}:{FRONT_END_PORT}...')
-frontend_server.serve_forever()
+if __name__ == "__main__":
+    if FRONTEND_MODE == "asyncio":
+        # the asyncio front end imports this module for the cache, shard map and leader cache it shares; this run
+        # of it has to be the one it gets, not a second copy with state of its own
+        sys.modules['front_end_service'] = sys.modules['__main__']
+        import front_end_async
+        front_end_async.start_async_front_end()
+    else:
+        start_front_end_service()
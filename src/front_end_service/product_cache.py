@@ -0,0 +1,592 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from itertools import count, zip_longest
+
+# Front-end product cache settings
+CACHE_POLICY = os.getenv('CACHE_POLICY', 'lru')  # lru, lfu, tinylfu or clock
+CACHE_CAPACITY = int(os.getenv('CACHE_CAPACITY', 5))  # products
+CACHE_SEGMENTS = int(os.getenv('CACHE_SEGMENTS', 1))  # independently locked parts of the cache, each with its share of the capacity
+CACHE_TTL = float(os.getenv('CACHE_TTL', 0))  # seconds an entry may be served, 0 for no limit
+# Seconds an invalidated entry may still be served to relaxed readers while it is refreshed, 0 to drop it right away
+CACHE_STALE_WINDOW = float(os.getenv('CACHE_STALE_WINDOW', 0))
+# Products the catalog did not know, answered with a 404 without asking the catalog again
+NEGATIVE_CACHE_CAPACITY = int(os.getenv('NEGATIVE_CACHE_CAPACITY', 1024))  # product names, 0 to turn it off
+NEGATIVE_CACHE_TTL = float(os.getenv('NEGATIVE_CACHE_TTL', 5))  # seconds
+# Committed orders, answered without asking the order leader again
+ORDER_CACHE_CAPACITY = int(os.getenv('ORDER_CACHE_CAPACITY', 1024))  # orders, 0 to turn it off
+# Warm-up at startup: "auto" loads the products of the last snapshot, or the catalog's listing if there is none;
+# "snapshot" and "catalog" use only that source, "off" starts empty
+CACHE_WARMUP = os.getenv('CACHE_WARMUP', 'auto')
+CACHE_SNAPSHOT_FILE = os.getenv('CACHE_SNAPSHOT_FILE', 'front_end_data/cache_snapshot.json')
+CACHE_SNAPSHOT_INTERVAL = float(os.getenv('CACHE_SNAPSHOT_INTERVAL', 60))  # seconds, the snapshot also survives a crash
+CACHE_WARMUP_TARGET_HIT_RATE = float(os.getenv('CACHE_WARMUP_TARGET_HIT_RATE', 0.9))
+CACHE_WARMUP_BATCH_SIZE = 100  # products per catalog request while warming up
+INVALIDATION_HISTORY_SIZE = 4096  # invalidated keys a cache remembers, to turn away values fetched before the invalidation
+
+# shared by every cache, so one token covers a fetch whose result may go to several caches
+GENERATIONS = count(1)
+
+
+class CachedProduct(dict):
+    """ Product info as the front end caches it, with its GET /products/<name> response serialized once.
+    payload is the product's JSON as the catalog sent it, passed through instead of encoded again. """
+    def __init__(self, product_info, payload=None):
+        super().__init__(product_info)
+        if payload is None:
+            payload = json.dumps(product_info).encode('utf-8')
+        self.body = b'{"data": ' + payload + b'}'
+        # the whole response of a cache hit, the keep-alive handler adds Connection: close when needed
+        self.response = (b"HTTP/1.1 200 OK\r\nContent-type: application/json\r\nContent-Length: "
+                         + str(len(self.body)).encode() + b"\r\n\r\n" + self.body)
+
+
+class ProductCache:
+    """ Thread-safe cache of product name -> product info, bounded by capacity and optionally by a TTL.
+    Subclasses pick the entry to evict; all of them count hits, misses, evictions and expirations.
+    With a stale_window, an invalidation only marks an entry stale: get() no longer returns it, but
+    get_or_stale() does until the window has passed or a fresh value is put.
+    A value fetched from the catalog is put with the generation() taken before the fetch, and is turned away
+    if its key was invalidated after that: it may predate the change behind the invalidation. """
+    policy = None
+
+    def __init__(self, capacity=CACHE_CAPACITY, ttl=CACHE_TTL, stale_window=CACHE_STALE_WINDOW):
+        self.cache = OrderedDict()
+        self.capacity = capacity
+        self.ttl = ttl
+        self.stale_window = stale_window
+        self.expires = {}  # key -> time.monotonic() deadline, only with a ttl
+        self.stale_until = {}  # key -> time.monotonic() deadline for serving an invalidated entry
+        self.invalidated = OrderedDict()  # key -> generation of its last invalidation, oldest first
+        self.fence = 0  # values fetched before this generation are turned away whatever their key
+        self.lock = threading.Lock()  # Add a lock for thread safety
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # entries dropped to make room
+        self.expirations = 0  # entries dropped because their ttl ran out
+        self.invalidations = 0  # entries dropped by the catalog's invalidations
+        self.rejections = 0  # new entries the admission policy kept out
+        self.stale_hits = 0  # invalidated entries served within the stale window
+        self.outdated = 0  # fetched values turned away because their key was invalidated during the fetch
+
+    def get(self, key):
+        """The cached value of key, None if it is not cached or stale."""
+        return self.get_or_stale(key, allow_stale=False)[0]
+
+    def get_or_stale(self, key, allow_stale=True):
+        """The cached value of key and whether it is stale, (None, False) if there is none to serve."""
+        with self.lock:  # Use the lock when accessing the cache
+            self.record_access(key)
+            now = time.monotonic()
+            if key in self.cache and self.ttl and self.expires[key] <= now:
+                self.remove(key)
+                self.expirations += 1
+            if key in self.stale_until and self.stale_until[key] <= now:
+                self.remove(key)
+                self.expirations += 1
+            if key not in self.cache or (key in self.stale_until and not allow_stale):
+                self.misses += 1
+                return None, False
+            if key in self.stale_until:
+                self.stale_hits += 1
+            else:
+                self.hits += 1
+            self.touch(key)
+            return self.cache[key], key in self.stale_until
+
+    def generation(self):
+        """A token to take before fetching a value to put."""
+        return next(GENERATIONS)
+
+    def put(self, key, value, generation=None):
+        """Cache value, unless it was fetched since generation and key has been invalidated since."""
+        with self.lock:  # Use the lock when modifying the cache
+            if self.is_outdated(key, generation):
+                self.outdated += 1
+                return
+            self.store(key, value)
+
+    def is_outdated(self, key, generation):
+        return generation is not None and (generation < self.fence or self.invalidated.get(key, 0) > generation)
+
+    def mark_invalidated(self, key):
+        """Turn away values of key fetched before now. Caller must hold the lock."""
+        self.invalidated[key] = next(GENERATIONS)
+        self.invalidated.move_to_end(key)
+        if len(self.invalidated) > INVALIDATION_HISTORY_SIZE:
+            # a key that is no longer remembered could have been invalidated as late as the oldest one left
+            _, oldest = self.invalidated.popitem(last=False)
+            self.fence = max(self.fence, oldest)
+
+    def fence_all(self):
+        """Turn away every value fetched before now. Caller must hold the lock."""
+        self.fence = next(GENERATIONS)
+        self.invalidated.clear()
+
+    def store(self, key, value):
+        """Caller must hold the lock."""
+        if self.capacity <= 0:
+            return
+        if key in self.cache:
+            self.touch(key)
+        else:
+            if len(self.cache) >= self.capacity:
+                victim = self.victim()
+                if not self.admit(key, victim):
+                    self.rejections += 1
+                    return
+                self.remove(victim)
+                self.evictions += 1
+            self.insert(key)
+        self.cache[key] = value
+        self.stale_until.pop(key, None)
+        if self.ttl:
+            self.expires[key] = time.monotonic() + self.ttl
+
+    def put_if_absent(self, key, value, generation=None):
+        """Put key unless it is cached already, possibly fresher than value, or put would turn value away.
+        Returns whether it was put."""
+        with self.lock:
+            if key in self.cache:
+                return False
+            if self.is_outdated(key, generation):
+                self.outdated += 1
+                return False
+            self.store(key, value)
+            return key in self.cache
+
+    def invalidate(self, key, version=None):
+        """Drop key, unless version is given and the cached entry is already at that version or a later one."""
+        with self.lock:  # Use the lock when modifying the cache
+            if version is not None and key in self.cache and self.cache[key].get("version", -1) >= version:
+                print(f"Cache entry for {key} is already at version {self.cache[key]['version']}")
+                return
+            self.mark_invalidated(key)
+            if key in self.cache and self.stale_window:
+                self.stale_until.setdefault(key, time.monotonic() + self.stale_window)
+                self.invalidations += 1
+                print(f"Cache entry for {key} marked stale")
+            elif key in self.cache:
+                self.remove(key)
+                self.invalidations += 1
+                print(f"Cache successfully invalidated for {key}")
+            else:
+                print(f"No cache entry found for {key} to invalidate.")
+
+    def discard(self, key):
+        """Drop key if it is cached, without logging."""
+        with self.lock:
+            self.mark_invalidated(key)
+            if key in self.cache:
+                self.remove(key)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.invalidations += len(self.cache)
+            for key in list(self.cache):
+                self.remove(key)
+            self.fence_all()
+            print("Cache cleared")
+
+    def keys(self):
+        """Every cached key, stale ones included."""
+        with self.lock:
+            return list(self.cache)
+
+    def fence_fetches(self):
+        """Turn away every value fetched before now, without dropping what is cached."""
+        with self.lock:
+            self.fence_all()
+
+    def hot_keys(self, limit=None):
+        """Cached keys that are not stale, the ones the policy would keep longest first."""
+        with self.lock:
+            keys = [key for key in self.ranked_keys() if key not in self.stale_until]
+        return keys[:limit]
+
+    def remove(self, key):
+        del self.cache[key]
+        self.expires.pop(key, None)
+        self.stale_until.pop(key, None)
+        self.forget(key)
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.stale_hits + self.misses
+            return {
+                "policy": self.policy,
+                "capacity": self.capacity,
+                "ttl": self.ttl,
+                "stale_window": self.stale_window,
+                "size": len(self.cache),
+                "stale": len(self.stale_until),
+                "hits": self.hits,
+                "stale_hits": self.stale_hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits + self.stale_hits) / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "invalidations": self.invalidations,
+                "rejections": self.rejections,
+                "outdated": self.outdated,
+            }
+
+    # Policy hooks, called with the lock held
+    def record_access(self, key):
+        """Every lookup, hit or miss."""
+
+    def touch(self, key):
+        """A hit on, or an update of, a cached key."""
+
+    def insert(self, key):
+        """key was just added."""
+
+    def forget(self, key):
+        """key was just removed."""
+
+    def victim(self):
+        """The key to evict to make room."""
+        raise NotImplementedError
+
+    def admit(self, key, victim):
+        """Whether key may replace victim."""
+        return True
+
+    def ranked_keys(self):
+        """All keys, the one to evict last first."""
+        return list(reversed(self.cache))
+
+
+class LRUCache(ProductCache):
+    """ Evicts the least recently used product """
+    policy = "lru"
+
+    def touch(self, key):
+        self.cache.move_to_end(key)  # Mark as recently used
+
+    def victim(self):
+        return next(iter(self.cache))
+
+
+class LFUCache(ProductCache):
+    """ Evicts the least frequently used product, the least recently used one among equals.
+    Entries sit in one bucket per use count, so every operation is O(1). """
+    policy = "lfu"
+
+    def __init__(self, capacity=CACHE_CAPACITY, ttl=CACHE_TTL, stale_window=CACHE_STALE_WINDOW):
+        super().__init__(capacity, ttl, stale_window)
+        self.counts = {}  # key -> uses since it was cached
+        self.buckets = {}  # use count -> OrderedDict of its keys, least recently used first
+        self.min_count = 0
+
+    def touch(self, key):
+        count = self.counts[key]
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if self.min_count == count:
+                self.min_count = count + 1
+        self.counts[key] = count + 1
+        self.buckets.setdefault(count + 1, OrderedDict())[key] = None
+
+    def insert(self, key):
+        self.counts[key] = 1
+        self.buckets.setdefault(1, OrderedDict())[key] = None
+        self.min_count = 1
+
+    def forget(self, key):
+        count = self.counts.pop(key)
+        bucket = self.buckets[count]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[count]
+            if self.min_count == count:
+                self.min_count = min(self.buckets, default=0)
+
+    def victim(self):
+        return next(iter(self.buckets[self.min_count]))
+
+    def ranked_keys(self):
+        return [key for count in sorted(self.buckets, reverse=True) for key in reversed(self.buckets[count])]
+
+
+class ClockCache(ProductCache):
+    """ CLOCK, an approximation of LRU in which hits do not reorder anything: a hit on a fresh entry only sets the
+    entry's reference bit and does not take the lock. Eviction sweeps entries oldest first, giving each one whose
+    bit is set a second chance. Hit counts may miss an increment when threads race on the lock-free path. """
+    policy = "clock"
+
+    def __init__(self, capacity=CACHE_CAPACITY, ttl=CACHE_TTL, stale_window=CACHE_STALE_WINDOW):
+        super().__init__(capacity, ttl, stale_window)
+        self.referenced = {}  # key -> reference bit
+
+    def get_or_stale(self, key, allow_stale=True):
+        # single dict reads are atomic; racing an eviction at worst sets the bit of an entry on its way out,
+        # or of one already gone, which victim() prunes
+        value = self.cache.get(key)
+        if value is not None and key not in self.stale_until and not (self.ttl and self.expires.get(key, 0) <= time.monotonic()):
+            if key in self.cache:
+                self.referenced[key] = True
+            self.hits += 1
+            return value, False
+        return super().get_or_stale(key, allow_stale)
+
+    def touch(self, key):
+        self.referenced[key] = True
+
+    def insert(self, key):
+        self.referenced[key] = False
+
+    def forget(self, key):
+        self.referenced.pop(key, None)
+
+    def victim(self):
+        if len(self.referenced) > len(self.cache):
+            # bits a lock-free hit set after its entry was evicted
+            self.referenced = {key: self.referenced.get(key, False) for key in self.cache}
+        while True:
+            key = next(iter(self.cache))
+            if not self.referenced.get(key):
+                return key
+            self.referenced[key] = False
+            self.cache.move_to_end(key)  # second chance
+
+    def ranked_keys(self):
+        keys = list(reversed(self.cache))
+        return [key for key in keys if self.referenced.get(key)] + [key for key in keys if not self.referenced.get(key)]
+
+
+class TinyLFUCache(LRUCache):
+    """ LRU cache behind a TinyLFU admission filter: a new product only replaces the LRU victim if it has been
+    asked for more often recently. Frequencies of all lookups, cached or not, are kept in a count-min sketch
+    that is halved every sample_size lookups, so popularity from long ago fades. """
+    policy = "tinylfu"
+    depth = 4
+
+    def __init__(self, capacity=CACHE_CAPACITY, ttl=CACHE_TTL, stale_window=CACHE_STALE_WINDOW):
+        super().__init__(capacity, ttl, stale_window)
+        self.width = 1 << max(4, (capacity * 4 - 1).bit_length())
+        self.sketch = [[0] * self.width for _ in range(self.depth)]
+        self.sample_size = max(capacity * 10, 100)
+        self.samples = 0
+
+    def record_access(self, key):
+        for row, index in zip(self.sketch, self.indexes(key)):
+            if row[index] < 15:  # 4-bit counters, as in the paper
+                row[index] += 1
+        self.samples += 1
+        if self.samples >= self.sample_size:
+            for row in self.sketch:
+                for index in range(self.width):
+                    row[index] >>= 1
+            self.samples //= 2
+
+    def frequency(self, key):
+        return min(row[index] for row, index in zip(self.sketch, self.indexes(key)))
+
+    def indexes(self, key):
+        return [hash((seed, key)) & (self.width - 1) for seed in range(self.depth)]
+
+    def admit(self, key, victim):
+        return self.frequency(key) > self.frequency(victim)
+
+
+class CacheWarmer:
+    """ Fills a cache in the background after startup, while requests are already served, and measures the time
+    the cache takes to reach a target hit rate. The products come from a snapshot of the hottest keys written
+    periodically and at shutdown, fetched again from the catalog so nothing stale is restored, or from the
+    catalog's full listing. fetch_products(names) and list_products() return lists of product info. """
+    def __init__(self, cache, fetch_products, list_products, mode=CACHE_WARMUP, snapshot_file=CACHE_SNAPSHOT_FILE,
+                 snapshot_interval=CACHE_SNAPSHOT_INTERVAL, target_hit_rate=CACHE_WARMUP_TARGET_HIT_RATE,
+                 batch_size=CACHE_WARMUP_BATCH_SIZE):
+        self.cache = cache
+        self.fetch_products = fetch_products
+        self.list_products = list_products
+        self.mode = mode
+        self.snapshot_file = snapshot_file
+        self.snapshot_interval = snapshot_interval
+        self.target_hit_rate = target_hit_rate
+        self.batch_size = batch_size
+        self.started = None
+        self.source = None  # "snapshot" or "catalog" once warm-up has picked one
+        self.loaded = 0  # products put into the cache
+        self.warmup_seconds = None  # once warm-up is done
+        self.seconds_to_target = None  # once a sample window reached the target hit rate
+        self.error = None
+
+    def start(self):
+        self.started = time.monotonic()
+        if self.mode != "off":
+            threading.Thread(target=self.warm, daemon=True).start()
+        threading.Thread(target=self.watch_hit_rate, daemon=True).start()
+        threading.Thread(target=self.snapshot_loop, daemon=True).start()
+
+    def warm(self):
+        try:
+            names = self.read_snapshot() if self.mode in ("auto", "snapshot") else None
+            if names:
+                self.source = "snapshot"
+                for i in range(0, len(names), self.batch_size):
+                    generation = self.cache.generation()
+                    self.load(self.fetch_products(names[i:i + self.batch_size]), generation)
+            elif self.mode in ("auto", "catalog"):
+                self.source = "catalog"
+                generation = self.cache.generation()
+                self.load(self.list_products()[:self.cache.capacity], generation)
+        except Exception as e:
+            self.error = str(e)
+            print(f"Cache warm-up failed: {e}")
+        self.warmup_seconds = time.monotonic() - self.started
+        print(f"Cache warm-up from {self.source} loaded {self.loaded} products in {self.warmup_seconds:.3f}s")
+
+    def load(self, products, generation=None):
+        for product_info in products:
+            # traffic may have cached a fresher copy meanwhile, or invalidated the product since it was fetched
+            if self.cache.put_if_absent(product_info["name"], CachedProduct(product_info), generation):
+                self.loaded += 1
+
+    def read_snapshot(self):
+        try:
+            with open(self.snapshot_file, 'r') as file:
+                return json.load(file)["names"]
+        except (FileNotFoundError, ValueError, KeyError):
+            return None
+
+    def save_snapshot(self):
+        """Write the names of the products the cache would keep longest, replacing the last snapshot atomically."""
+        names = self.cache.hot_keys(self.cache.capacity)
+        directory = os.path.dirname(self.snapshot_file)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(f"{self.snapshot_file}.tmp", 'w') as file:
+            json.dump({"names": names}, file)
+        os.replace(f"{self.snapshot_file}.tmp", self.snapshot_file)
+
+    def snapshot_loop(self):
+        while True:
+            time.sleep(self.snapshot_interval)
+            try:
+                self.save_snapshot()
+            except OSError as e:
+                print(f"Writing cache snapshot failed: {e}")
+
+    def watch_hit_rate(self, interval=1.0, min_lookups=20):
+        """Sample the hit rate every interval seconds until a window of at least min_lookups reaches the target."""
+        def counts():
+            stats = self.cache.stats()
+            return stats["hits"] + stats["stale_hits"], stats["hits"] + stats["stale_hits"] + stats["misses"]
+        hits, lookups = counts()
+        while True:
+            time.sleep(interval)
+            now_hits, now_lookups = counts()
+            if now_lookups - lookups < min_lookups:
+                continue  # too little traffic to tell, keep the window growing
+            if (now_hits - hits) / (now_lookups - lookups) >= self.target_hit_rate:
+                self.seconds_to_target = time.monotonic() - self.started
+                print(f"Cache reached a {self.target_hit_rate:.0%} hit rate {self.seconds_to_target:.3f}s after startup")
+                return
+            hits, lookups = now_hits, now_lookups
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "source": self.source,
+            "loaded": self.loaded,
+            "warmup_seconds": self.warmup_seconds,
+            "target_hit_rate": self.target_hit_rate,
+            "seconds_to_target_hit_rate": self.seconds_to_target,
+            "error": self.error,
+        }
+
+
+class SegmentedCache:
+    """ A cache split into segments that each have their own lock and their own share of the capacity, a key's
+    segment chosen by its hash, so threads working on different products rarely wait for each other.
+    Each segment evicts on its own, so the cache as a whole only approximates its policy. """
+    def __init__(self, segments):
+        self.segments = segments
+        self.policy = segments[0].policy
+        self.capacity = sum(segment.capacity for segment in segments)
+
+    def segment(self, key):
+        return self.segments[hash(key) % len(self.segments)]
+
+    def get(self, key):
+        return self.segment(key).get(key)
+
+    def get_or_stale(self, key, allow_stale=True):
+        return self.segment(key).get_or_stale(key, allow_stale)
+
+    def generation(self):
+        return next(GENERATIONS)
+
+    def put(self, key, value, generation=None):
+        self.segment(key).put(key, value, generation)
+
+    def put_if_absent(self, key, value, generation=None):
+        return self.segment(key).put_if_absent(key, value, generation)
+
+    def invalidate(self, key, version=None):
+        self.segment(key).invalidate(key, version)
+
+    def discard(self, key):
+        self.segment(key).discard(key)
+
+    def clear(self):
+        for segment in self.segments:
+            segment.clear()
+
+    def keys(self):
+        return [key for segment in self.segments for key in segment.keys()]
+
+    def fence_fetches(self):
+        for segment in self.segments:
+            segment.fence_fetches()
+
+    def hot_keys(self, limit=None):
+        """The segments' hot keys, interleaved."""
+        per_segment = [segment.hot_keys() for segment in self.segments]
+        keys = [key for rank in zip_longest(*per_segment) for key in rank if key is not None]
+        return keys[:limit]
+
+    def stats(self):
+        per_segment = [segment.stats() for segment in self.segments]
+        stats = dict(per_segment[0], capacity=self.capacity, segments=len(self.segments))
+        for counter in ("size", "stale", "hits", "stale_hits", "misses", "evictions", "expirations", "invalidations", "rejections",
+                        "outdated"):
+            stats[counter] = sum(segment_stats[counter] for segment_stats in per_segment)
+        lookups = stats["hits"] + stats["stale_hits"] + stats["misses"]
+        stats["hit_ratio"] = (stats["hits"] + stats["stale_hits"]) / lookups if lookups else 0.0
+        return stats
+
+
+CACHE_POLICIES = {cache_class.policy: cache_class for cache_class in (LRUCache, LFUCache, TinyLFUCache, ClockCache)}
+
+
+def new_negative_cache(capacity=NEGATIVE_CACHE_CAPACITY, ttl=NEGATIVE_CACHE_TTL):
+    """Cache of product names the catalog answered with a 404. The ttl bounds how long a product added to the
+    catalog can stay unknown should its announcement not reach the front end."""
+    return LRUCache(capacity, ttl, stale_window=0)
+
+
+def new_order_cache(capacity=ORDER_CACHE_CAPACITY):
+    """Cache of committed orders by number. An order never changes once committed, so entries never expire
+    and are never invalidated, only evicted."""
+    return LRUCache(capacity, ttl=0, stale_window=0)
+
+
+def new_cache(policy=CACHE_POLICY, capacity=CACHE_CAPACITY, ttl=CACHE_TTL, stale_window=CACHE_STALE_WINDOW,
+              segments=CACHE_SEGMENTS):
+    if policy not in CACHE_POLICIES:
+        raise ValueError(f"Unknown CACHE_POLICY {policy!r}, expected one of {', '.join(CACHE_POLICIES)}")
+    segments = min(segments, capacity)  # so no segment is left without room
+    if segments <= 1:
+        return CACHE_POLICIES[policy](capacity, ttl, stale_window)
+    # the capacity split as evenly as it goes, the first segments taking one more entry
+    segment_capacity, larger = divmod(capacity, segments)
+    return SegmentedCache([CACHE_POLICIES[policy](segment_capacity + (i < larger), ttl, stale_window)
+                           for i in range(segments)])
@@ -1,10 +1,17 @@
 import json
 import threading
-from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from http.server import ThreadingHTTPServer
 import urllib.parse
 import requests
 import csv
 import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.group_commit import GroupCommitWriter
+from common.shard_map import ShardMap
+from common.http_client import PooledClient
+from common.http_server import KeepAliveHandler
 
 # Initializing order service host and port, lock, order file
 REPLICA_ID=int(os.getenv('REPLICA_ID',1))
@@ -13,6 +20,10 @@ CATALOG_PORT = int(os.getenv('CATALOG_LISTENING_PORT', 12501))
 ORDER_FILE = f"order_data/order_log_{str(REPLICA_ID)}.csv"
 LOCK = threading.Lock()
 CATALOG_HOST = os.getenv('CATALOG_HOST', 'localhost')
+# Catalog shard owning each product, a single catalog at CATALOG_HOST:CATALOG_PORT unless CATALOG_SHARD_MAP is set
+CATALOG_SHARDS = ShardMap.load(CATALOG_HOST, CATALOG_PORT)
+# Keep-alive connections to the catalog and the other replicas, shared by all handler threads
+http_client = PooledClient()
 ORDER_HOST = os.getenv('ORDER_HOST', 'localhost')
 #ORDER_NODES = os.getenv('ORDER_NODES', "localhost:12502,localhost:12504,localhost:12505")  # "host1:port1,host2:port2"
 ORDER_NODES = {
@@ -22,6 +33,8 @@ ORDER_NODES = {
 }
 # Initializing global order number variable to 0
 order_number = 0
+# Group commit writer appending to ORDER_FILE, opened when the service starts
+order_log_writer = None
 
 def generate_order_number():
     with LOCK:
@@ -38,17 +51,16 @@ def send_data(follower, data):
     """Function to send data to a single follower."""
     url = f"http://{follower['host']}:{follower['port']}/replicate_order"
     try:
-        response = requests.post(url, json=data)
+        response = http_client.post(url, json=data)
         response.raise_for_status()  # This will raise an exception for HTTP errors.
         print(f"Successfully propagated to {url}")
     except requests.RequestException as e:
         print(f"Error propagating to {url}: {e}")
 
-def propagate_order_to_followers(order_number, product_name, quantity, leader_info):
+def propagate_order_to_followers(order_number, line_items, leader_info):
     data = {
         "order_number": order_number,
-        "product_name": product_name,
-        "quantity": quantity,
+        "items": line_items,
         "leader_id": f"{ORDER_HOST}:{ORDER_PORT}"
     }
     threads = []
@@ -60,15 +72,13 @@ def propagate_order_to_followers(order_number, product_name, quantity, leader_in
     for thread in threads:
         thread.join()  # Wait for all threads to complete
 
-def log_order(order_number, product_name, quantity, leader_info=None):
-    """Log order and optionally propagate to followers."""
-    with LOCK:
-        with open(ORDER_FILE, 'a', newline='') as file:
-            writer = csv.writer(file)
-            writer.writerow([order_number, product_name, quantity])
+def log_order(order_number, line_items, leader_info=None):
+    """Log order durably, one row per line item, and optionally propagate to followers."""
+    # returns once the group commit batch holding this order is fsynced
+    order_log_writer.write([[order_number, item['name'], item['quantity']] for item in line_items])
 
-        if leader_info:
-            propagate_order_to_followers(order_number, product_name, quantity, leader_info)
+    if leader_info:
+        propagate_order_to_followers(order_number, line_items, leader_info)
 
 def load_order_number():
     global order_number
@@ -76,34 +86,31 @@ def load_order_number():
         if os.path.exists(ORDER_FILE) and os.path.getsize(ORDER_FILE) > 0:
             with open(ORDER_FILE, 'r') as file:
                 reader = csv.reader(file)
-                last_row = list(reader)[-1]  # get latest order row
-                order_number = int(last_row[0]) + 1  # latest fetched order number incremented by 1
+                # group commit may append concurrent orders slightly out of order, so take the highest number
+                order_number = max(int(row[0]) for row in reader) + 1
         else:
             order_number = 0
 
 def fetch_order_details(order_number):
-    with LOCK:
+    rows = []
+    # the flusher writes each commit's rows under the writer's io lock, so an order is read whole or not at all
+    with order_log_writer.io_lock:
         with open(ORDER_FILE, 'r') as file:
             reader = csv.reader(file)
             for row in reader:
                 if int(row[0]) == order_number:
-                    return {"number": row[0], "name": row[1], "quantity": row[2]}
-    return None
+                    rows.append(row)
+                elif rows:
+                    break  # the line items of an order are written together
+    if not rows:
+        return None
+    return order_record(rows[0][0], [{"name": row[1], "quantity": row[2]} for row in rows])
 
-def check_product_availability(product_name, requested_quantity):
-    """Check if the catalog has enough quantity of the product."""
-    response = requests.get(f"http://{CATALOG_HOST}:{CATALOG_PORT}/{product_name}")
-    
-    if response.status_code == 200:
-        product_data = response.json()
-        available_quantity = product_data['quantity']
-        if available_quantity >= requested_quantity:
-            return 200 #indicates product name exists and it is in stock
-        else: 
-            return 400 #indicates that product name exists but quantity requested is not in stock
-    else:
-        return response.status_code #any other error code received from catalog like 404 out of stock or bad request
-            
+def order_record(order_number, line_items):
+    """An order as GET /orders/<n> returns it, with the values as strings like in the order log."""
+    if len(line_items) == 1:
+        return {"number": str(order_number), "name": str(line_items[0]["name"]), "quantity": str(line_items[0]["quantity"])}
+    return {"number": str(order_number), "items": [{"name": str(item["name"]), "quantity": str(item["quantity"])} for item in line_items]}
 
 def fetch_latest_order_id():
     """Fetch the latest order ID"""
@@ -123,7 +130,7 @@ def request_missed_orders(order_number):
             replica_port = node["port"]
             url = f"http://{replica_host}:{replica_port}/missed_order"
             try:
-                response = requests.post(url, json={"latest_order_id": order_number})
+                response = http_client.post(url, json={"latest_order_id": order_number})
                 if response.status_code == 200:
                     print("Nothing is missed")
                     return
@@ -157,26 +164,35 @@ def request_missed_orders(order_number):
 def fetch_missed_orders(start_order_id):
     """Fetch missed orders starting from the provided order ID."""
     missed_orders = []
-    with LOCK:
+    with order_log_writer.io_lock:  # only whole orders, see fetch_order_details
         if os.path.exists(ORDER_FILE) and os.path.getsize(ORDER_FILE) > 0:
             with open(ORDER_FILE, 'r') as file:
                 reader = csv.reader(file)
-                found_start_id = False
                 for row in reader:
-                    if found_start_id:
+                    if int(row[0]) > start_order_id:
                         missed_orders.append({"order_number": row[0], "product_name": row[1], "quantity": row[2]})
-                    elif int(row[0]) == start_order_id:
-                        found_start_id = True
     return missed_orders
 
-class OrderRequestHandler(BaseHTTPRequestHandler):
+class OrderRequestHandler(KeepAliveHandler):
     def do_GET(self):
+        if self.path == "/stats/commit":
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(order_log_writer.stats()).encode())
+            return
+        if self.path == "/stats/http":
+            self.send_response(200)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            self.wfile.write(json.dumps(http_client.stats()).encode())
+            return
+
         if self.path == "/health":
             self.send_response(200)
             self.send_header("Content-type", "application/json")
             self.end_headers()
             self.wfile.write(json.dumps({"status": "healthy"}).encode())
-            print("i am now leader")
             return
 
         order_number = self.path.split("/")[-1]
@@ -213,9 +229,21 @@ class OrderRequestHandler(BaseHTTPRequestHandler):
             return self.handle_leader_notification()
         
         content_length = int(self.headers['Content-Length'])
-        post_data = json.loads(self.rfile.read(content_length))
-        product_name = post_data.get("name")
-        requested_quantity = post_data.get("quantity")
+        try:
+            post_data = json.loads(self.rfile.read(content_length))
+        except ValueError:
+            post_data = None
+        # a multi-item order lists its line items, a single-item order is one implicit line item
+        line_items = (post_data.get("items") or [{"name": post_data.get("name"), "quantity": post_data.get("quantity")}]
+                      if isinstance(post_data, dict) else None)
+        # answer a malformed order here: a handler that dies sends nothing, and the front end takes that for a dead leader
+        if not isinstance(line_items, list) or not all(isinstance(item, dict) for item in line_items):
+            self.send_response(400)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            error_message = {"error": {"code": 400, "message": "malformed order"}}
+            self.wfile.write(json.dumps(error_message).encode())
+            return
         leader_info = post_data.get('leader')
 
         if not leader_info:
@@ -225,16 +253,29 @@ class OrderRequestHandler(BaseHTTPRequestHandler):
             self.wfile.write(json.dumps({"error": "This node is not the leader and cannot accept write operations. "}).encode())
             return
         
-        #Placing order
-        print(f"Processing order for{product_name}, {requested_quantity} quantity")
-        catalog_response = requests.post(f"http://{CATALOG_HOST}:{CATALOG_PORT}/orders", json=post_data)
+        # a catalog shard can only apply the line items it owns atomically
+        shards = CATALOG_SHARDS.group_by_shard(str(item.get("name")) for item in line_items)
+        if len(shards) > 1:
+            self.send_response(400)
+            self.send_header("Content-type", "application/json")
+            self.end_headers()
+            error_message = {"error": {"code": 400, "message": "line items span several catalog shards"}}
+            self.wfile.write(json.dumps(error_message).encode())
+            return
+
+        #Placing order, the owning catalog shard applies all line items atomically
+        print(f"Processing order for {line_items}")
+        catalog_response = http_client.post(f"{CATALOG_SHARDS.url(next(iter(shards)))}/orders", json=post_data)
         if catalog_response.status_code == 200:
             order_number = generate_order_number()
-            log_order(order_number, product_name, requested_quantity, leader_info)
+            log_order(order_number, line_items, leader_info)
             self.send_response(200)
             self.send_header("Content-type", "application/json")
             self.end_headers()
-            response_data = {"order_number": order_number}
+            # the catalog returns the bought products' new quantities and versions, the front end caches them,
+            # as it caches the order, which never changes once committed
+            response_data = {"order_number": order_number, "products": catalog_response.json()["products"],
+                             "order": order_record(order_number, line_items)}
             self.wfile.write(json.dumps(response_data).encode())
         #send catalog error in placing order
 
@@ -244,16 +285,19 @@ class OrderRequestHandler(BaseHTTPRequestHandler):
             self.send_response(catalog_response.status_code)
             self.send_header("Content-type", "application/json")
             self.end_headers()
+            self.wfile.write(catalog_response.content)
     
     def handle_replication(self):
         """Handle replication request from the leader."""
         data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
         # Log the order without propagating since this is a follower action
-        log_order(data['order_number'], data['product_name'], data['quantity'])
+        line_items = data.get('items') or [{"name": data['product_name'], "quantity": data['quantity']}]
+        log_order(data['order_number'], line_items)
         received_order_id= int(data['order_number'])
         with LOCK:
             global order_number
-            order_number =received_order_id+1
+            # replications are no longer serialized by the leader, never move the counter backwards
+            order_number = max(order_number, received_order_id+1)
         
         print(f"Order Committed Successfully")
         self.send_response(200)
@@ -308,8 +352,10 @@ class OrderRequestHandler(BaseHTTPRequestHandler):
 
 
 def start_order_service():
+    global order_log_writer
     load_order_number()  # Latest order number loaded from disk
     request_missed_orders(fetch_latest_order_id())
+    order_log_writer = GroupCommitWriter(ORDER_FILE)
     order_server = ThreadingHTTPServer((ORDER_HOST, ORDER_PORT), OrderRequestHandler)
     print(f'Starting order service on {ORDER_HOST}:{ORDER_PORT}...')
     order_server.serve_forever()
@@ -0,0 +1,63 @@
+import os
+import random
+import sys
+import threading
+import time
+
+# Benchmark of front-end cache throughput as the number of threads grows: the OrderedDict LRU cache behind one
+# lock against the same cache split into lock segments, and against CLOCK, whose hits take no lock.
+# No services needed. Run from anywhere: python3 cacheContentionBenchmark.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'front_end_service'))
+
+CAPACITY = 1000
+PRODUCTS = 1200  # a few more than fit, so there are misses and evictions too
+DURATION = float(os.getenv('BENCHMARK_DURATION', 1.0))  # seconds per measurement
+THREAD_COUNTS = [1, 2, 4, 8, 16, 32]
+SEGMENTS = 16
+CACHES = [("lru", 1), ("lru", SEGMENTS), ("clock", 1), ("clock", SEGMENTS)]
+
+
+def worker(cache, keys, start, counts, thread_no):
+    start.wait()
+    # every thread watches the clock itself: a main thread setting a stop flag can be starved of the GIL
+    # by threads convoying on a cache lock for far longer than the measurement
+    deadline = time.perf_counter() + DURATION
+    ops = 0
+    i = thread_no * 997
+    while time.perf_counter() < deadline:
+        key = keys[i % len(keys)]
+        if cache.get(key) is None:
+            cache.put(key, {"name": key, "version": 0})
+        ops += 1
+        i += 1
+    counts[thread_no] = ops
+
+
+def measure(cache, threads, keys):
+    start = threading.Barrier(threads)
+    counts = [0] * threads
+    workers = [threading.Thread(target=worker, args=(cache, keys, start, counts, n)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return sum(counts) / DURATION
+
+
+def main():
+    import product_cache
+    product_cache.print = lambda *args, **kwargs: None  # silence per-invalidation logging
+    # skewed popularity: a few products take most lookups, as in a real catalog
+    rng = random.Random(1)
+    keys = [f"toy{int(PRODUCTS * rng.random() ** 3)}" for _ in range(100000)]
+    print(f"{'threads':>8} " + " ".join(f"{f'{policy} x{segments} ops/s':>18}" for policy, segments in CACHES))
+    for threads in THREAD_COUNTS:
+        results = []
+        for policy, segments in CACHES:
+            cache = product_cache.new_cache(policy, CAPACITY, ttl=0, stale_window=0, segments=segments)
+            results.append(measure(cache, threads, keys))
+        print(f"{threads:>8} " + " ".join(f"{ops:>18.0f}" for ops in results))
+
+
+if __name__ == "__main__":
+    main()
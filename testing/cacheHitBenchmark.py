@@ -0,0 +1,79 @@
+import io
+import json
+import os
+import sys
+import time
+
+# Microbenchmark of the front end's cache hit and miss paths: building the response from the product dict on
+# every request (before) against writing the response serialized when the product was cached (after).
+# No services needed. Run from anywhere: python3 cacheHitBenchmark.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'front_end_service'))
+
+ITERATIONS = int(os.getenv('BENCHMARK_ITERATIONS', 200000))
+CATALOG_PAYLOAD = json.dumps({"name": "Tux", "price": 25.99, "quantity": 100, "version": 42}).encode('utf-8')
+
+
+def new_handler(handler_class):
+    """A handler in the state do_GET sees after parsing a request, writing into a buffer instead of a socket."""
+    handler = handler_class.__new__(handler_class)
+    handler.request_version = "HTTP/1.1"
+    handler.requestline = "GET /products/Tux HTTP/1.1"
+    handler.command = "GET"
+    handler.client_address = ("127.0.0.1", 0)
+    handler.wfile = io.BytesIO()
+    handler.log_message = lambda *args: None
+    return handler
+
+
+def hit_before(handler, product_info):
+    handler.send_response(200)
+    handler.send_header("Content-type", "application/json")
+    handler.end_headers()
+    handler.wfile.write(json.dumps({"data": product_info}).encode('utf-8'))
+
+
+def hit_after(handler, product_info):
+    handler.send_cached_product(product_info)
+
+
+def miss_before(catalog_payload):
+    product_info = json.loads(catalog_payload.decode('utf-8'))
+    return json.dumps({"data": product_info}).encode('utf-8')
+
+
+def miss_after(catalog_payload, cached_product):
+    return cached_product(json.loads(catalog_payload.decode('utf-8')), catalog_payload).response
+
+
+def measure(operation, *args):
+    start = time.perf_counter()
+    for i in range(ITERATIONS):
+        operation(*args)
+    return (time.perf_counter() - start) / ITERATIONS * 1e9
+
+
+def main():
+    import front_end_service
+    handler = new_handler(front_end_service.FrontendHandler)
+    cached = front_end_service.CachedProduct(json.loads(CATALOG_PAYLOAD), CATALOG_PAYLOAD)
+    plain = dict(cached)
+
+    def reset_buffer(operation):
+        # keep the buffer small, so the measurement is not of BytesIO growth
+        def run(*args):
+            operation(*args)
+            handler.wfile.seek(0)
+            handler.wfile.truncate()
+        return run
+
+    results = [
+        ("hit", measure(reset_buffer(hit_before), handler, plain), measure(reset_buffer(hit_after), handler, cached)),
+        ("miss", measure(miss_before, CATALOG_PAYLOAD), measure(miss_after, CATALOG_PAYLOAD, front_end_service.CachedProduct)),
+    ]
+    print(f"{'path':>6} {'before ns/op':>14} {'after ns/op':>14} {'speedup':>9}")
+    for path, before, after in results:
+        print(f"{path:>6} {before:>14.0f} {after:>14.0f} {before / after:>8.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+# Benchmark of catalog query/buy throughput as the number of handler threads grows,
+# with one global lock (1 stripe) against per-product lock stripes.
+# Throughput alone cannot show what the stripes buy: under the GIL only one thread runs Python at a time and every
+# buy also takes the catalog's global LOCK for its seq. The time buys wait for their stripe is measured too, which
+# is the only thing more stripes can reduce.
+# Run from anywhere: python3 catalogLockBenchmark.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'catalog'))
+
+PRODUCTS = 256
+DURATION = float(os.getenv('BENCHMARK_DURATION', 1.0))  # seconds per measurement
+THREAD_COUNTS = [1, 2, 4, 8, 16, 32]
+STRIPE_COUNTS = [1, 16]
+BUY_RATIO = 0.5  # every other operation is a buy
+
+
+class TimedLock:
+    """A stripe lock that adds up how long its acquirers waited for it."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waited = 0.0  # updated by the holder only
+
+    def acquire(self):
+        started = time.perf_counter()
+        self.lock.acquire()
+        self.waited += time.perf_counter() - started
+
+    def release(self):
+        self.lock.release()
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def setup_catalog(catalog):
+    """Start the catalog on a synthetic data directory with enough stock for the whole run."""
+    data_dir = tempfile.mkdtemp()
+    os.chdir(data_dir)
+    os.mkdir("catalog_data")
+    with open(catalog.CATALOG_FILE, 'w') as file:
+        file.write("name,price,quantity,seq\n")
+        for i in range(PRODUCTS):
+            file.write(f"toy{i},9.99,1000000000,0\n")
+    catalog.load_catalog()
+
+
+def worker(catalog, thread_no, stop, counts):
+    ops = 0
+    i = 0
+    every = int(1 / BUY_RATIO)
+    while not stop.is_set():
+        product_name = f"toy{(thread_no * 7 + i) % PRODUCTS}"
+        if i % every == 0:
+            catalog.handle_buy({"name": product_name, "quantity": 1})
+        else:
+            catalog.handle_query(product_name)
+        ops += 1
+        i += 1
+    counts[thread_no] = ops
+
+
+def measure(catalog, threads):
+    """Operations per second, and the average time a buy waited for its stripe in microseconds."""
+    stop = threading.Event()
+    counts = [0] * threads
+    workers = [threading.Thread(target=worker, args=(catalog, n, stop, counts)) for n in range(threads)]
+    for thread in workers:
+        thread.start()
+    time.sleep(DURATION)
+    stop.set()
+    for thread in workers:
+        thread.join()
+    buys = sum(-(-count // int(1 / BUY_RATIO)) for count in counts)
+    waited = sum(lock.waited for lock in catalog.STRIPE_LOCKS)
+    return sum(counts) / DURATION, 1_000_000 * waited / buys if buys else 0
+
+
+def main():
+    import catalog
+    catalog.print = lambda *args, **kwargs: None  # silence per-request logging
+    setup_catalog(catalog)
+    print(f"{'threads':>8} " + " ".join(f"{f'{stripes} stripe(s) ops/s':>20} {'wait us/buy':>12}" for stripes in STRIPE_COUNTS))
+    for threads in THREAD_COUNTS:
+        results = []
+        for stripes in STRIPE_COUNTS:
+            catalog.STRIPE_LOCKS = [TimedLock() for _ in range(stripes)]
+            results.append(measure(catalog, threads))
+        print(f"{threads:>8} " + " ".join(f"{ops:>20.0f} {wait:>12.1f}" for ops, wait in results))
+    print(f"group commit: {catalog.log_writer.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+
+# Benchmark of front-end product query throughput and latency as the number of concurrent clients grows,
+# with the threaded front end against the asyncio one (FRONTEND_MODE). Each client holds one keep-alive
+# connection and sends its next query as soon as the last one is answered.
+# Needs the catalog service running; the front end is started here, once per mode, on BENCHMARK_PORT.
+# Run from anywhere: python3 frontEndBenchmark.py
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+sys.path.append(SRC)
+from common.async_http import AsyncPooledClient
+
+PORT = int(os.getenv('BENCHMARK_PORT', 12513))
+DURATION = float(os.getenv('BENCHMARK_DURATION', 3.0))  # seconds per measurement
+CLIENT_COUNTS = [1, 10, 100, 500]
+MODES = ["threaded", "asyncio"]
+
+
+def start_front_end(mode):
+    env = dict(os.environ, FRONTEND_MODE=mode, FRONTEND_LISTENING_PORT=str(PORT))
+    front_end = subprocess.Popen([sys.executable, "front_end_service.py"], cwd=os.path.join(SRC, "front_end_service"),
+                                 env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for attempt in range(50):
+        try:
+            asyncio.run(AsyncPooledClient().get(f"http://localhost:{PORT}/stats/http"))
+            return front_end
+        except Exception:
+            time.sleep(0.1)
+    front_end.kill()
+    raise RuntimeError(f"{mode} front end did not start on port {PORT}")
+
+
+async def client(client_no, product_names, deadline, latencies):
+    connection = AsyncPooledClient(pool_size=1)
+    i = client_no
+    while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await connection.get(f"http://localhost:{PORT}/products/{product_names[i % len(product_names)]}")
+        if response.status_code != 200:
+            raise RuntimeError(f"query failed with {response.status_code}")
+        latencies.append(time.perf_counter() - start)
+        i += 1
+
+
+async def measure(clients, product_names):
+    latencies = []
+    deadline = time.perf_counter() + DURATION
+    await asyncio.gather(*(client(n, product_names, deadline, latencies) for n in range(clients)))
+    latencies.sort()
+    return (len(latencies) / DURATION, latencies[len(latencies) // 2] * 1000,
+            latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000)
+
+
+def main():
+    results = {}
+    for mode in MODES:
+        front_end = start_front_end(mode)
+        try:
+            listing = asyncio.run(AsyncPooledClient().get(f"http://localhost:{PORT}/products")).json()
+            product_names = [product["name"] for product in listing["data"]]
+            for clients in CLIENT_COUNTS:
+                results[mode, clients] = asyncio.run(measure(clients, product_names))
+        finally:
+            front_end.kill()
+            front_end.wait()
+    print(f"{'clients':>8} " + " ".join(f"{f'{mode} req/s  p50 ms  p99 ms':>32}" for mode in MODES))
+    for clients in CLIENT_COUNTS:
+        print(f"{clients:>8} " + " ".join(f"{results[mode, clients][0]:>15.0f} {results[mode, clients][1]:>7.2f} "
+                                          f"{results[mode, clients][2]:>7.2f}" for mode in MODES))
+
+
+if __name__ == "__main__":
+    main()
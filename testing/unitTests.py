@@ -1,6 +1,22 @@
+import asyncio
 import requests
+from concurrent.futures import ThreadPoolExecutor
+import mmap
+import os
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
+# the front end's cache is tested in-process as well, no services needed for ProductCacheTest
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'front_end_service'))
+import product_cache
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'catalog'))
+import mmap_catalog
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from common.async_http import AsyncPooledClient
+
 #testing frontend microservice with various scenarios
 class FrontEndServiceTest(unittest.TestCase):
     FRONT_END_URL = 'http://localhost:12503'
@@ -16,6 +32,19 @@ class FrontEndServiceTest(unittest.TestCase):
         response = requests.get(f'{self.FRONT_END_URL}/products/Crocodile')
         self.assertEqual(response.status_code, 404)
 
+    def test_front_end_bulk_query(self):
+        requests.get(f'{self.FRONT_END_URL}/products/Tux')  # Tux is now cached, Lego may not be
+        response = requests.get(f'{self.FRONT_END_URL}/products', params={'names': 'Tux,Lego,Crocodile'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([product['name'] for product in data['data']], ['Tux', 'Lego'])
+        self.assertEqual(data['not_found'], ['Crocodile'])
+
+    def test_front_end_full_listing(self):
+        response = requests.get(f'{self.FRONT_END_URL}/products')
+        self.assertEqual(response.status_code, 200)
+        self.assertGreaterEqual(len(response.json()['data']), 10)
+
     def test_front_end_place_order_successfully(self):
 
         order_data = {'name': 'Python', 'quantity': 10}
@@ -25,6 +54,31 @@ class FrontEndServiceTest(unittest.TestCase):
         order_response_data = response.json()
         self.assertTrue('order_number' in order_response_data['data'])
 
+    def test_front_end_place_multi_item_order(self):
+        order_data = [{'name': 'Lego', 'quantity': 1}, {'name': 'Barbie', 'quantity': 2}]
+        response = requests.post(f'{self.FRONT_END_URL}/orders/', json=order_data)
+        self.assertEqual(response.status_code, 200)
+        order_number = response.json()['data']['order_number']
+        response = requests.get(f'{self.FRONT_END_URL}/orders/{order_number}')
+        self.assertEqual(response.status_code, 200)
+        items = response.json()['data']['data']['items']
+        self.assertEqual([item['name'] for item in items], ['Lego', 'Barbie'])
+
+    def test_front_end_multi_item_order_is_all_or_nothing(self):
+        before = requests.get(f'{self.FRONT_END_URL}/products/Whale').json()['data']['quantity']
+        order_data = {'items': [{'name': 'Whale', 'quantity': 1}, {'name': 'Tux', 'quantity': 1000000}]}
+        response = requests.post(f'{self.FRONT_END_URL}/orders/', json=order_data)
+        self.assertEqual(response.status_code, 400)
+        after = requests.get(f'{self.FRONT_END_URL}/products/Whale').json()['data']['quantity']
+        self.assertEqual(before, after)
+
+    def test_front_end_malformed_order(self):
+        response = requests.post(f'{self.FRONT_END_URL}/orders/', json={'items': ['Tux']})
+        self.assertEqual(response.status_code, 400)
+        # a bad request does not cost the order service its leader
+        response = requests.post(f'{self.FRONT_END_URL}/orders/', json={'name': 'Tux', 'quantity': 1})
+        self.assertEqual(response.status_code, 200)
+
     def test_front_end_quantity_more_than_available(self):
         order_data = {'name': 'Tux', 'quantity': 1000000}
         response = requests.post(f'{self.FRONT_END_URL}/orders/', json=order_data)
@@ -43,11 +97,86 @@ class FrontEndServiceTest(unittest.TestCase):
         response = requests.get(f'{self.FRONT_END_URL}/orders/{order_number}')
         self.assertEqual(response.status_code, 200)
 
+    def test_front_end_order_cache(self):
+        order_number = requests.post(f'{self.FRONT_END_URL}/orders/', json={'name': 'Frisbee', 'quantity': 1}).json()['data']['order_number']
+        before = requests.get(f'{self.FRONT_END_URL}/cache/stats').json()['orders']
+        response = requests.get(f'{self.FRONT_END_URL}/orders/{order_number}')
+        self.assertEqual(response.status_code, 200)
+        after = requests.get(f'{self.FRONT_END_URL}/cache/stats').json()['orders']
+        # cached when the order was placed, the lookup never reached the order leader
+        self.assertEqual(after['hits'], before['hits'] + 1)
+        self.assertEqual(response.json()['data'], requests.get(f'http://localhost:12505/orders/{order_number}').json())
+
     def test_front_end_query_nonexisting_order_number(self):
         order_number=10000000000000
         response = requests.get(f'{self.FRONT_END_URL}/orders/{order_number}')
         self.assertEqual(response.status_code, 404)
 
+    def test_front_end_http_pool_stats(self):
+        requests.get(f'{self.FRONT_END_URL}/products', params={'names': 'Frisbee'})
+        response = requests.get(f'{self.FRONT_END_URL}/stats/http')
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertGreaterEqual(stats['hits'] + stats['misses'], 1)
+        self.assertIn('localhost:12501', stats['upstreams'])
+
+    def test_front_end_keep_alive(self):
+        session = requests.Session()
+        response = session.get(f'{self.FRONT_END_URL}/products/Crocodile')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(int(response.headers['Content-Length']), len(response.content))
+        self.assertNotEqual(response.headers.get('Connection'), 'close')
+        response = session.get(f'{self.FRONT_END_URL}/products/Tux')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.raw.version, 11)
+
+    def test_front_end_cache_stats(self):
+        before = requests.get(f'{self.FRONT_END_URL}/cache/stats').json()
+        requests.get(f'{self.FRONT_END_URL}/products/Tux')
+        requests.get(f'{self.FRONT_END_URL}/products/Tux')  # cached by the first query at the latest
+        after = requests.get(f'{self.FRONT_END_URL}/cache/stats').json()
+        self.assertEqual(after['hits'] + after['misses'], before['hits'] + before['misses'] + 2)
+        self.assertGreater(after['hits'], before['hits'])
+        self.assertLessEqual(after['size'], after['capacity'])
+        self.assertIn(after['warmup']['mode'], ('auto', 'snapshot', 'catalog', 'off'))
+        self.assertIn('seconds_to_target_hit_rate', after['warmup'])
+
+    def test_front_end_coalesced_misses(self):
+        requests.post(f'{self.FRONT_END_URL}/invalidate/Lego')
+        before = requests.get(f'{self.FRONT_END_URL}/cache/stats').json()
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            # strict, so that a stale entry is not served while it is refreshed in the background
+            responses = list(pool.map(lambda _: requests.get(f'{self.FRONT_END_URL}/products/Lego', params={'consistency': 'strict'}), range(16)))
+        self.assertTrue(all(response.status_code == 200 for response in responses))
+        after = requests.get(f'{self.FRONT_END_URL}/cache/stats').json()
+        # every miss either fetched the product or waited for another request's fetch
+        fetched = after['single_flight']['executions'] - before['single_flight']['executions']
+        merged = after['single_flight']['merged'] - before['single_flight']['merged']
+        self.assertEqual(fetched + merged, after['misses'] - before['misses'])
+        self.assertGreaterEqual(fetched, 1)
+
+    def test_front_end_strict_query(self):
+        requests.post(f'{self.FRONT_END_URL}/invalidate/', json={'names': ['Tux'], 'versions': [10 ** 9]})
+        response = requests.get(f'{self.FRONT_END_URL}/products/Tux', params={'consistency': 'strict'})
+        self.assertEqual(response.status_code, 200)
+        catalog_quantity = requests.get('http://localhost:12501/Tux').json()['quantity']
+        self.assertEqual(response.json()['data']['quantity'], catalog_quantity)
+
+    def test_front_end_negative_cache(self):
+        requests.get(f'{self.FRONT_END_URL}/products/Unicorn')
+        before = requests.get(f'{self.FRONT_END_URL}/cache/stats').json()['negative']
+        response = requests.get(f'{self.FRONT_END_URL}/products/Unicorn')
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json()['error']['message'], 'product not found')
+        after = requests.get(f'{self.FRONT_END_URL}/cache/stats').json()['negative']
+        self.assertEqual(after['hits'], before['hits'] + 1)
+
+    def test_front_end_invalidation_batch(self):
+        response = requests.post(f'{self.FRONT_END_URL}/invalidate/', json={'names': ['Tux', 'Fox']})
+        self.assertEqual(response.status_code, 200)
+        response = requests.post(f'{self.FRONT_END_URL}/invalidate/', json={'all': True})
+        self.assertEqual(response.status_code, 200)
+
     #assuming all order replicas are active
     def test_health_check(self):
         response = requests.get(f"http://localhost:12505/health")
@@ -74,6 +203,13 @@ class CatalogServiceTest(unittest.TestCase):
         self.assertEqual(data['name'], 'Tux')
 
 
+    def test_bulk_query(self):
+        response = requests.get(f'{self.CATALOG_URL}/products', params={'names': 'Tux,Fox,Crocodile'})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual([product['name'] for product in data['products']], ['Tux', 'Fox'])
+        self.assertEqual(data['not_found'], ['Crocodile'])
+
     def test_buy_product_successfully(self):
         buy_product_data = {'name': 'Fox', 'quantity': 1}
         response = requests.post(f'{self.CATALOG_URL}/buy', json=buy_product_data)
@@ -85,6 +221,100 @@ class CatalogServiceTest(unittest.TestCase):
         response = requests.post(f'{self.CATALOG_URL}/buy', json=buy_product_data)
         self.assertNotEqual(response.status_code, 200)
 
+    def test_buy_returns_new_quantity_and_version(self):
+        before = requests.get(f'{self.CATALOG_URL}/Fox').json()
+        response = requests.post(f'{self.CATALOG_URL}/buy', json={'name': 'Fox', 'quantity': 1})
+        self.assertEqual(response.status_code, 200)
+        product = response.json()['products'][0]
+        self.assertEqual(product['name'], 'Fox')
+        self.assertEqual(product['quantity'], before['quantity'] - 1)
+        self.assertGreater(product['version'], before['version'])
+
+    def test_buy_with_stale_version(self):
+        version = requests.get(f'{self.CATALOG_URL}/Fox').json()['version']
+        requests.post(f'{self.CATALOG_URL}/buy', json={'name': 'Fox', 'quantity': 1})
+        response = requests.post(f'{self.CATALOG_URL}/buy', json={'name': 'Fox', 'quantity': 1, 'version': version})
+        self.assertEqual(response.status_code, 409)
+
+    def test_reservation_hold_confirm_release(self):
+        before = requests.get(f'{self.CATALOG_URL}/Monopoly').json()['quantity']
+        response = requests.post(f'{self.CATALOG_URL}/reservations', json={'name': 'Monopoly', 'quantity': 2})
+        self.assertEqual(response.status_code, 200)
+        response = requests.post(f"{self.CATALOG_URL}/reservations/{response.json()['reservation_id']}/confirm")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['products'][0]['quantity'], before - 2)
+        response = requests.post(f'{self.CATALOG_URL}/reservations', json={'name': 'Monopoly', 'quantity': 1})
+        reservation_id = response.json()['reservation_id']
+        self.assertEqual(requests.post(f'{self.CATALOG_URL}/reservations/{reservation_id}/release').status_code, 200)
+        self.assertEqual(requests.post(f'{self.CATALOG_URL}/reservations/{reservation_id}/confirm').status_code, 404)
+        self.assertEqual(requests.get(f'{self.CATALOG_URL}/Monopoly').json()['quantity'], before - 2)
+
+    def test_reservation_expiry_is_counted(self):
+        before = requests.get(f'{self.CATALOG_URL}/stats/reservations').json()
+        response = requests.post(f'{self.CATALOG_URL}/reservations', json={'name': 'Monopoly', 'quantity': 1, 'ttl': 0.05})
+        reservation_id = response.json()['reservation_id']
+        time.sleep(0.1)
+        # the sweeper or the confirm, whichever comes first, counts the expiry
+        response = requests.post(f'{self.CATALOG_URL}/reservations/{reservation_id}/confirm')
+        self.assertIn(response.status_code, (404, 410))
+        after = requests.get(f'{self.CATALOG_URL}/stats/reservations').json()
+        self.assertEqual(after['expired'], before['expired'] + 1)
+
+    def test_catalog_malformed_buy(self):
+        for order_data in ({'items': ['Tux']}, [{'name': 'Tux', 'quantity': 1}], {'name': 'Tux', 'quantity': True}):
+            response = requests.post(f'{self.CATALOG_URL}/buy', json=order_data)
+            self.assertEqual(response.status_code, 400)
+        response = requests.post(f'{self.CATALOG_URL}/reservations', json=['Tux'])
+        self.assertEqual(response.status_code, 400)
+        response = requests.post(f'{self.CATALOG_URL}/reservations', json={'name': 'Tux', 'quantity': 1, 'ttl': True})
+        self.assertEqual(response.status_code, 400)
+
+    def test_invalidation_stats(self):
+        requests.post(f'{self.CATALOG_URL}/buy', json={'name': 'Fox', 'quantity': 1})
+        response = requests.get(f'{self.CATALOG_URL}/stats/invalidation')
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        if stats['mode'] == 'post':
+            self.assertGreaterEqual(stats['enqueued'], 1)
+        else:
+            self.assertGreaterEqual(stats['stream']['batches'], 1)
+        self.assertIn('dropped', stats)
+        self.assertIn('queue_depth', stats)
+
+    def test_invalidation_stream(self):
+        stats = requests.get(f'{self.CATALOG_URL}/stats/invalidation').json()
+        if stats['mode'] != 'stream':
+            self.skipTest('invalidations are POSTed to the front end')
+        self.assertGreaterEqual(stats['stream']['subscribers'], 1)
+        requests.get('http://localhost:12503/products/Fox')  # cached
+        requests.post(f'{self.CATALOG_URL}/buy', json={'name': 'Fox', 'quantity': 1})
+        catalog_quantity = requests.get(f'{self.CATALOG_URL}/Fox').json()['quantity']
+        # the invalidation reaches the front end over its subscription, shortly after the buy
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if requests.get('http://localhost:12503/products/Fox').json()['data']['quantity'] == catalog_quantity:
+                break
+            time.sleep(0.05)
+        self.assertEqual(requests.get('http://localhost:12503/products/Fox').json()['data']['quantity'], catalog_quantity)
+
+    def test_change_stream(self):
+        snapshot = requests.get(f'{self.CATALOG_URL}/changes/snapshot').json()
+        requests.post(f'{self.CATALOG_URL}/buy', json={'name': 'Fox', 'quantity': 1})
+        response = requests.get(f'{self.CATALOG_URL}/changes', params={'since': snapshot['seq']})
+        self.assertEqual(response.status_code, 200)
+        changes = response.json()['changes']
+        self.assertEqual(changes[0]['seq'], snapshot['seq'] + 1)
+        self.assertEqual(changes[0]['name'], 'Fox')
+        self.assertEqual(changes[0]['quantity'], snapshot['products']['Fox']['quantity'] - 1)
+
+    def test_commit_stats(self):
+        requests.post(f'{self.CATALOG_URL}/buy', json={'name': 'Fox', 'quantity': 1})
+        response = requests.get(f'{self.CATALOG_URL}/stats/commit')
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertGreaterEqual(stats['requests'], 1)
+        self.assertLessEqual(stats['max_batch_size'], stats['max_batch'])
+
 #testing order microservice with various scenarios
 class OrderServiceTest(unittest.TestCase):
     ORDER_URL = 'http://localhost:12505'
@@ -134,12 +364,258 @@ class OrderServiceTest(unittest.TestCase):
         response = requests.post(url, json=data)
         self.assertEqual(response.status_code, 200)
 
+    def test_order_commit_stats(self):
+        response = requests.get(f'{self.ORDER_URL}/stats/commit')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('avg_commit_latency_ms', response.json())
+
     def test_missed_orders(self):
         url = f"http://localhost:12505/missed_order"
         response = requests.post(url, json={"latest_order_id": 0})
         self.assertTrue(response.status_code == 200 or response.status_code == 201)
 
-    
+
+
+#runs against either front end; with the RAFT services: python3 -m unittest unitTests.RaftFrontEndTest
+class RaftFrontEndTest(unittest.TestCase):
+    FRONT_END_URL = 'http://localhost:12503'
+    CATALOG_URL = 'http://localhost:12501'
+
+    def test_front_end_serves_bought_quantity(self):
+        requests.get(f'{self.FRONT_END_URL}/products/Marbles')  # cached
+        # bought at the catalog, so only the catalog's invalidation can tell the front end about it
+        response = requests.post(f'{self.CATALOG_URL}/buy', json={'name': 'Marbles', 'quantity': 1})
+        self.assertEqual(response.status_code, 200)
+        catalog_quantity = requests.get(f'{self.CATALOG_URL}/Marbles').json()['quantity']
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if requests.get(f'{self.FRONT_END_URL}/products/Marbles').json()['data']['quantity'] == catalog_quantity:
+                break
+            time.sleep(0.05)
+        self.assertEqual(requests.get(f'{self.FRONT_END_URL}/products/Marbles').json()['data']['quantity'], catalog_quantity)
+
+
+class ProductCacheTest(unittest.TestCase):
+    def test_fetch_overtaken_by_invalidation_is_not_cached(self):
+        cache = product_cache.new_cache('lru', 10, ttl=0, stale_window=0)
+        generation = cache.generation()  # the fetch starts
+        cache.invalidate('Tux', 5)  # the change arrives while it is in flight
+        cache.put('Tux', {'name': 'Tux', 'version': 4}, generation)
+        self.assertIsNone(cache.get('Tux'))
+        self.assertEqual(cache.stats()['outdated'], 1)
+        # a fetch that started after the invalidation is cached
+        cache.put('Tux', {'name': 'Tux', 'version': 5}, cache.generation())
+        self.assertEqual(cache.get('Tux')['version'], 5)
+
+    def test_fetch_overtaken_by_clear_is_not_cached(self):
+        cache = product_cache.new_cache('lru', 10, ttl=0, stale_window=0, segments=4)
+        generation = cache.generation()
+        cache.clear()
+        cache.put('Tux', {'name': 'Tux', 'version': 4}, generation)
+        self.assertIsNone(cache.get('Tux'))
+
+    def test_restart_warms_from_snapshot(self):
+        catalog = {name: {'name': name, 'price': 1.0, 'quantity': 10, 'version': 1} for name in ('Tux', 'Lego', 'Marbles')}
+        def fetch_products(names):
+            return [catalog[name] for name in names]
+        snapshot_file = os.path.join(tempfile.mkdtemp(), 'snapshot.json')
+        cache = product_cache.new_cache('lru', 10, ttl=0, stale_window=0)
+        for product_info in catalog.values():
+            cache.put(product_info['name'], product_cache.CachedProduct(product_info))
+        product_cache.CacheWarmer(cache, fetch_products, list, mode='snapshot', snapshot_file=snapshot_file).save_snapshot()
+        # the restarted front end starts empty
+        cache = product_cache.new_cache('lru', 10, ttl=0, stale_window=0)
+        warmer = product_cache.CacheWarmer(cache, fetch_products, list, mode='snapshot', snapshot_file=snapshot_file)
+        warmer.started = time.monotonic()
+        warmer.warm()
+        self.assertEqual(warmer.stats()['source'], 'snapshot')
+        self.assertEqual(warmer.stats()['loaded'], 3)
+        for name in catalog:
+            self.assertEqual(cache.get(name)['name'], name)
+
+    def test_warm_up_does_not_overwrite_or_restore_invalidated(self):
+        cache = product_cache.new_cache('lru', 10, ttl=0, stale_window=0)
+        warmer = product_cache.CacheWarmer(cache, None, None, mode='off')
+        generation = cache.generation()  # the warm-up fetch starts
+        cache.put('Tux', {'name': 'Tux', 'version': 5})  # traffic caches a fresher copy
+        cache.invalidate('Lego')  # and a change arrives
+        warmer.load([{'name': 'Tux', 'version': 4}, {'name': 'Lego', 'version': 4}], generation)
+        self.assertEqual(cache.get('Tux')['version'], 5)
+        self.assertIsNone(cache.get('Lego'))
+        self.assertEqual(warmer.stats()['loaded'], 0)
+
+    def test_seconds_to_target_hit_rate_is_reported(self):
+        cache = product_cache.new_cache('lru', 10, ttl=0, stale_window=0)
+        cache.put('Tux', {'name': 'Tux', 'version': 1})
+        warmer = product_cache.CacheWarmer(cache, None, None, mode='off', target_hit_rate=0.9)
+        warmer.started = time.monotonic()
+        watcher = threading.Thread(target=warmer.watch_hit_rate, kwargs={'interval': 0.05, 'min_lookups': 5},
+                                   daemon=True)
+        watcher.start()
+        deadline = time.monotonic() + 5
+        while watcher.is_alive() and time.monotonic() < deadline:
+            cache.get('Tux')
+            time.sleep(0.001)
+        self.assertFalse(watcher.is_alive())
+        self.assertGreater(warmer.stats()['seconds_to_target_hit_rate'], 0)
+
+    def test_clock_gives_referenced_entries_a_second_chance(self):
+        cache = product_cache.new_cache('clock', 3, ttl=0, stale_window=0, segments=1)
+        for name in ('Tux', 'Lego', 'Marbles'):
+            cache.put(name, {'name': name})
+        cache.get('Tux')  # the oldest entry is referenced
+        cache.put('Whale', {'name': 'Whale'})
+        self.assertIsNotNone(cache.get('Tux'))
+        self.assertIsNone(cache.get('Lego'))  # the oldest one without a reference goes instead
+        self.assertIsNotNone(cache.get('Marbles'))
+        self.assertIsNotNone(cache.get('Whale'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_clock_prunes_bits_of_evicted_entries(self):
+        cache = product_cache.new_cache('clock', 2, ttl=0, stale_window=0, segments=1)
+        cache.put('Tux', {'name': 'Tux'})
+        cache.put('Lego', {'name': 'Lego'})
+        cache.referenced['Whale'] = True  # left by a lock-free hit that raced the eviction of Whale
+        cache.put('Marbles', {'name': 'Marbles'})
+        self.assertEqual(set(cache.referenced), set(cache.cache))
+        for i in range(100):
+            cache.get(f'Product{i}')  # misses leave no bits
+        self.assertEqual(set(cache.referenced), set(cache.cache))
+
+    def test_clock_hit_path_expires_entries(self):
+        cache = product_cache.new_cache('clock', 3, ttl=0.05, stale_window=0, segments=1)
+        cache.put('Tux', {'name': 'Tux'})
+        self.assertIsNotNone(cache.get('Tux'))
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('Tux'))
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['expirations'], stats['size']), (1, 1, 1, 0))
+
+    def test_clock_hit_path_does_not_serve_stale_as_fresh(self):
+        cache = product_cache.new_cache('clock', 3, ttl=0, stale_window=5, segments=1)
+        cache.put('Tux', {'name': 'Tux', 'version': 1})
+        cache.invalidate('Tux')
+        self.assertIsNone(cache.get('Tux'))
+        self.assertEqual(cache.get_or_stale('Tux'), ({'name': 'Tux', 'version': 1}, True))
+        cache.put('Tux', {'name': 'Tux', 'version': 2})  # a fresh value ends the stale window
+        self.assertEqual(cache.get('Tux')['version'], 2)
+        stats = cache.stats()
+        self.assertEqual((stats['hits'], stats['stale_hits'], stats['misses']), (1, 1, 1))
+
+    def test_segmented_cache_invalidates_clears_and_sums_stats(self):
+        cache = product_cache.new_cache('lru', 40, ttl=0, stale_window=0, segments=4)
+        names = [f'Product{i}' for i in range(20)]
+        for name in names:
+            cache.put(name, {'name': name})
+        for name in names:
+            self.assertEqual(cache.get(name)['name'], name)
+        self.assertIsNone(cache.get('Crocodile'))
+        cache.invalidate('Product3')
+        self.assertIsNone(cache.get('Product3'))
+        stats = cache.stats()
+        self.assertEqual(stats['segments'], 4)
+        self.assertEqual((stats['size'], stats['hits'], stats['misses'], stats['invalidations']), (19, 20, 2, 1))
+        self.assertEqual(stats['hit_ratio'], 20 / 22)
+        cache.clear()
+        self.assertEqual(cache.stats()['size'], 0)
+        self.assertTrue(all(cache.get(name) is None for name in names))
+
+    def test_segments_keep_the_total_capacity(self):
+        for capacity, segments in ((10, 4), (16, 4), (3, 8), (1000, 16)):
+            cache = product_cache.new_cache('lru', capacity, ttl=0, stale_window=0, segments=segments)
+            self.assertEqual(cache.stats()['capacity'], capacity)
+            if isinstance(cache, product_cache.SegmentedCache):
+                self.assertEqual(sum(segment.capacity for segment in cache.segments), capacity)
+                self.assertTrue(all(segment.capacity > 0 for segment in cache.segments))
+
+    def test_keys_include_stale_entries(self):
+        for segments in (1, 4):
+            cache = product_cache.new_cache('lru', 10, ttl=0, stale_window=5, segments=segments)
+            cache.put('Tux', {'name': 'Tux'})
+            cache.put('Lego', {'name': 'Lego'})
+            cache.invalidate('Tux')
+            self.assertEqual(cache.hot_keys(), ['Lego'])  # not snapshotted
+            self.assertEqual(sorted(cache.keys()), ['Lego', 'Tux'])  # but flushed with its shard
+
+    def test_fence_fetches_keeps_cached_entries(self):
+        cache = product_cache.new_cache('lru', 10, ttl=0, stale_window=0, segments=4)
+        cache.put('Lego', {'name': 'Lego'})
+        generation = cache.generation()
+        cache.fence_fetches()  # a shard flush, with invalidations of products not cached possibly missed
+        cache.put('Tux', {'name': 'Tux'}, generation)
+        self.assertIsNone(cache.get('Tux'))
+        self.assertIsNotNone(cache.get('Lego'))
+
+
+class MmapCatalogTest(unittest.TestCase):
+    def store(self):
+        directory = tempfile.mkdtemp()
+        entries = {'Tux': {'price': 15.99, 'quantity': 100, 'seq': 0}, 'Lego': {'price': 45.99, 'quantity': 100, 'seq': 0}}
+        return mmap_catalog.MmapCatalog.create(os.path.join(directory, 'catalog.bin'),
+                                               os.path.join(directory, 'catalog_index.txt'), entries)
+
+    def on_disk(self, store, product_name):
+        store.flush()
+        return mmap_catalog.MmapCatalog(store.data_path, store.index_path)[product_name]
+
+    def test_change_reaches_the_slot_only_once_logged(self):
+        store = self.store()
+        store['Tux'] = {'price': 15.99, 'quantity': 99, 'seq': 1}
+        store['Tux'] = {'price': 15.99, 'quantity': 98, 'seq': 2}
+        self.assertEqual(store['Tux']['quantity'], 98)  # served before it is durable
+        self.assertEqual(self.on_disk(store, 'Tux'), {'price': 15.99, 'quantity': 100, 'seq': 0})
+        store.write_back('Tux', 1)  # the row of seq 1 is fsynced, the one of seq 2 is not yet
+        self.assertEqual(self.on_disk(store, 'Tux')['quantity'], 99)
+        self.assertEqual(store['Tux']['quantity'], 98)
+        store.write_back('Tux', 2)
+        self.assertEqual(self.on_disk(store, 'Tux'), {'price': 15.99, 'quantity': 98, 'seq': 2})
+        self.assertEqual(store.staged, {})
+
+    def test_slots_do_not_straddle_pages(self):
+        self.assertEqual(mmap.PAGESIZE % mmap_catalog.SLOT.size, 0)
+        self.assertEqual(mmap_catalog.HEADER.size % mmap_catalog.SLOT.size, 0)
+
+    def test_version_1_store_is_upgraded(self):
+        directory = tempfile.mkdtemp()
+        data_path, index_path = os.path.join(directory, 'catalog.bin'), os.path.join(directory, 'catalog_index.txt')
+        with open(data_path, 'wb') as file:
+            file.write(mmap_catalog.V1_HEADER.pack(mmap_catalog.MAGIC, 1, 2, 7))
+            file.write(mmap_catalog.V1_SLOT.pack(93, 15.99, 7))
+            file.write(mmap_catalog.V1_SLOT.pack(100, 45.99, 0))
+        with open(index_path, 'w') as file:
+            file.write("Tux\nLego\n")
+        store = mmap_catalog.MmapCatalog(data_path, index_path)
+        self.assertEqual(store.seq, 7)
+        self.assertEqual(store['Tux'], {'price': 15.99, 'quantity': 93, 'seq': 7})
+        self.assertEqual(store['Lego'], {'price': 45.99, 'quantity': 100, 'seq': 0})
+
+
+class AsyncPooledClientTest(unittest.TestCase):
+    def test_cancelled_request_closes_its_connection(self):
+        async def scenario():
+            closed = asyncio.Event()
+            async def never_answer(reader, writer):
+                await reader.readuntil(b"\r\n\r\n")
+                await reader.read()  # returns once the client closes the connection
+                closed.set()
+                writer.close()
+            server = await asyncio.start_server(never_answer, 'localhost', 0)
+            port = server.sockets[0].getsockname()[1]
+            client = AsyncPooledClient()
+            request = asyncio.ensure_future(client.get(f'http://localhost:{port}/products/Tux'))
+            await asyncio.sleep(0.1)
+            request.cancel()
+            cancelled = None
+            try:
+                await request
+            except asyncio.CancelledError as e:
+                cancelled = e  # its traceback keeps the request's frame, and so its connection, from being collected
+            self.assertIsNotNone(cancelled)
+            await asyncio.wait_for(closed.wait(), 2)
+            self.assertEqual(client.idle.get(('localhost', port), []), [])
+            server.close()
+        asyncio.run(scenario())
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file